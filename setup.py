@@ -21,7 +21,10 @@ setup(
     scripts=[
         'tensor2tensor/bin/t2t-trainer',
         'tensor2tensor/bin/t2t-datagen',
+        'tensor2tensor/bin/t2t-flatten-data',
         'tensor2tensor/bin/t2t-decoder',
+        'tensor2tensor/bin/t2t-decode-server',
+        'tensor2tensor/bin/t2t-input-bench',
         'tensor2tensor/bin/t2t-make-tf-configs',
         'tensor2tensor/bin/t2t-exporter',
         'tensor2tensor/bin/t2t-query-server',
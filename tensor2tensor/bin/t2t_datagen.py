@@ -72,6 +72,18 @@ flags.DEFINE_integer("task_id_end", -1, "For distributed data generation.")
 flags.DEFINE_integer(
     "num_concurrent_processes", 10,
     "Applies only to problems for which multiprocess_generate=True.")
+flags.DEFINE_bool("flat_output", False,
+                  "Also write the data of registered Problems as flat "
+                  "datasets, read with --hparams='dataset_format=flat'.")
+flags.DEFINE_bool("shuffle_across_shards", False,
+                  "Shuffle the records of all shards of a split together, "
+                  "so that every shard samples from the whole split, rather "
+                  "than each shard on its own.")
+flags.DEFINE_integer("shuffle_memory_budget",
+                     generator_utils.SHUFFLE_MEMORY_BUDGET,
+                     "Approximate bytes of records a shuffle holds in memory "
+                     "at once; larger data is shuffled through temporary "
+                     "files.")
 flags.DEFINE_string("t2t_usr_dir", "",
                     "Path to a Python module that will be imported. The "
                     "__init__.py file should include the necessary imports. "
@@ -174,6 +186,10 @@ def main(_):
                                                     starting_spaces=4))
   if FLAGS.only_list:
     return
+  # Also applies to the shuffles of Problem.generate_data.
+  generator_utils.set_shuffle_defaults(
+      memory_budget=FLAGS.shuffle_memory_budget,
+      across_shards=FLAGS.shuffle_across_shards)
   for problem in problems:
     set_random_seed()
 
@@ -230,6 +246,12 @@ def generate_data_for_registered_problem(problem_name):
     pool.map(generate_data_in_process, args)
   else:
     problem.generate_data(data_dir, tmp_dir, task_id)
+  if FLAGS.flat_output:
+    if task_id is None:
+      problem.convert_to_flat(data_dir)
+    else:
+      tf.logging.warning("Not writing flat datasets for one task; run "
+                         "t2t-flatten-data once all tasks are done.")
 
 if __name__ == "__main__":
   tf.app.run()
@@ -0,0 +1,128 @@
+# coding=utf-8
+# Copyright 2017 The Tensor2Tensor Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+r"""Serve a trained T2T model over HTTP with batched in-process decoding.
+
+Example usage:
+
+  t2t-decode-server \
+      --data_dir ~/data \
+      --problems=translate_ende_wmt32k \
+      --model=transformer \
+      --hparams_set=transformer_base_single_gpu \
+      --output_dir ~/train \
+      --port=8888
+
+Add --continuous_batching --decode_hparams=beam_size=1 to batch requests per
+decoding step instead of per decode.
+
+  curl -d '{"inputs": "Hello world."}' localhost:8888/decode
+  curl localhost:8888/metrics
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import os
+
+# Dependency imports
+
+from tensor2tensor.bin import t2t_trainer  # pylint: disable=unused-import
+from tensor2tensor.serving import decode_server
+from tensor2tensor.utils import decoding
+from tensor2tensor.utils import trainer_lib
+from tensor2tensor.utils import usr_dir
+
+import tensorflow as tf
+
+flags = tf.flags
+FLAGS = flags.FLAGS
+
+# Additional flags in bin/t2t_trainer.py and utils/flags.py
+flags.DEFINE_string("checkpoint_path", None,
+                    "Path to the model checkpoint. Overrides output_dir.")
+flags.DEFINE_integer("port", 8888, "Port to serve on.")
+flags.DEFINE_integer("max_batch_size", 32,
+                     "Most requests decoded together in one batch, or the "
+                     "number of slots with --continuous_batching.")
+flags.DEFINE_float("max_wait_ms", 10.0,
+                   "Longest a request waits for its batch to fill up.")
+flags.DEFINE_integer("num_decode_threads", 2,
+                     "Batches decoded concurrently.")
+flags.DEFINE_integer("max_bucket_length", 256,
+                     "Inputs are padded to doubling lengths up to this one. "
+                     "The longest input with --continuous_batching.")
+flags.DEFINE_bool("continuous_batching", False,
+                  "Decode greedily one position at a time, refilling the "
+                  "slots of finished requests between steps. Transformer "
+                  "models only.")
+
+
+def create_hparams():
+  return trainer_lib.create_hparams(
+      FLAGS.hparams_set,
+      FLAGS.hparams,
+      data_dir=os.path.expanduser(FLAGS.data_dir),
+      problem_name=FLAGS.problems)
+
+
+def create_decoder(hparams):
+  """Returns a decoder running FLAGS.model in a persistent session."""
+  checkpoint_path = FLAGS.checkpoint_path
+  if not checkpoint_path and FLAGS.output_dir:
+    checkpoint_path = tf.train.latest_checkpoint(
+        os.path.expanduser(FLAGS.output_dir))
+  decode_hp = decoding.decode_hparams(FLAGS.decode_hparams)
+  if FLAGS.continuous_batching:
+    session = decode_server.StepwiseDecodeSession(
+        FLAGS.model, hparams, decode_hp,
+        num_slots=FLAGS.max_batch_size,
+        max_input_length=FLAGS.max_bucket_length,
+        checkpoint_path=checkpoint_path)
+    return decode_server.ContinuousBatchingDecoder(
+        session, extra_length=decode_hp.extra_length)
+  session = decode_server.FastDecodeSession(
+      FLAGS.model, hparams, decode_hp, checkpoint_path=checkpoint_path)
+  return decode_server.BatchingDecoder(
+      session,
+      max_batch_size=FLAGS.max_batch_size,
+      max_wait_secs=FLAGS.max_wait_ms / 1000.,
+      bucket_boundaries=decode_server.default_bucket_boundaries(
+          FLAGS.max_bucket_length),
+      num_threads=FLAGS.num_decode_threads)
+
+
+def main(_):
+  tf.logging.set_verbosity(tf.logging.INFO)
+  usr_dir.import_usr_dir(FLAGS.t2t_usr_dir)
+
+  hparams = create_hparams()
+  problem = hparams.problem_instances[0]
+  fname = "inputs" if problem.has_inputs else "targets"
+  decoder = create_decoder(hparams)
+  server = decode_server.make_http_server(
+      decoder,
+      input_encoder=problem.feature_info[fname].encoder,
+      output_encoder=problem.feature_info["targets"].encoder,
+      port=FLAGS.port)
+  tf.logging.info("Serving %s on port %d", FLAGS.model, FLAGS.port)
+  try:
+    server.serve_forever()
+  finally:
+    decoder.close()
+
+
+if __name__ == "__main__":
+  tf.app.run()
@@ -0,0 +1,68 @@
+# coding=utf-8
+# Copyright 2017 The Tensor2Tensor Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+r"""Converts the TFRecord files of problems to flat datasets.
+
+A flat dataset stores each integer feature of a split as one contiguous
+array of tokens with an index of the example offsets. Training reads it with
+--hparams='dataset_format=flat', memory-mapping the arrays instead of parsing
+tf.Examples.
+
+Example usage:
+
+  t2t-flatten-data \
+      --data_dir ~/data \
+      --problem=translate_ende_wmt32k
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import os
+
+# Dependency imports
+
+from tensor2tensor.utils import registry
+from tensor2tensor.utils import usr_dir
+
+import tensorflow as tf
+
+flags = tf.flags
+FLAGS = flags.FLAGS
+
+flags.DEFINE_string("data_dir", "", "Data directory.")
+flags.DEFINE_string("problem", "",
+                    "Comma-separated names of the problems to convert.")
+flags.DEFINE_string("t2t_usr_dir", "",
+                    "Path to a Python module that will be imported. The "
+                    "__init__.py file should include the necessary imports. "
+                    "The imported files should contain registrations, "
+                    "e.g. @registry.register_problem calls, that will then be "
+                    "available to t2t-flatten-data.")
+
+
+def main(_):
+  tf.logging.set_verbosity(tf.logging.INFO)
+  usr_dir.import_usr_dir(FLAGS.t2t_usr_dir)
+  if not FLAGS.data_dir or not FLAGS.problem:
+    raise ValueError("--data_dir and --problem are required.")
+  data_dir = os.path.expanduser(FLAGS.data_dir)
+  for problem_name in FLAGS.problem.split(","):
+    tf.logging.info("Converting data of %s.", problem_name)
+    registry.problem(problem_name).convert_to_flat(data_dir)
+
+
+if __name__ == "__main__":
+  tf.app.run()
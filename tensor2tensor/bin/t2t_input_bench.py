@@ -0,0 +1,124 @@
+# coding=utf-8
+# Copyright 2017 The Tensor2Tensor Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+r"""Benchmark a problem's input pipeline without a model.
+
+Builds Problem.input_fn as the trainer would, with the same hparams and data
+parallelism, and reads batches from it as fast as possible. Reports the
+examples and tokens per second of each pipeline stage, the examples dropped
+by the length filter and the padding in the batches.
+
+Example usage:
+
+  t2t-input-bench \
+      --data_dir ~/data \
+      --problems=translate_ende_wmt32k \
+      --model=transformer \
+      --hparams_set=transformer_base_single_gpu \
+      --hparams='batching_mode=sorted_buffer' \
+      --num_batches=2000
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import os
+import time
+
+# Dependency imports
+
+import numpy as np
+import six
+from six.moves import xrange  # pylint: disable=redefined-builtin
+
+from tensor2tensor.bin import t2t_trainer
+from tensor2tensor.utils import data_reader
+from tensor2tensor.utils import trainer_lib
+from tensor2tensor.utils import usr_dir
+
+import tensorflow as tf
+
+flags = tf.flags
+FLAGS = flags.FLAGS
+
+# Additional flags in bin/t2t_trainer.py and utils/flags.py
+flags.DEFINE_integer("num_batches", 1000, "Batches to read.")
+flags.DEFINE_integer("num_warmup_batches", 50,
+                     "Batches read before measuring, e.g. to fill buffers.")
+flags.DEFINE_integer("report_every", 200, "Log the rates every this many "
+                     "batches.")
+flags.DEFINE_string("bench_mode", "train", "Mode of the input pipeline: "
+                    "train or eval.")
+
+
+def log_rates(input_stats):
+  rates = input_stats.rates()
+  for name, value in zip(input_stats.rate_names(), rates):
+    tf.logging.info("  %s: %.1f", name, value)
+
+
+def main(_):
+  tf.logging.set_verbosity(tf.logging.INFO)
+  usr_dir.import_usr_dir(FLAGS.t2t_usr_dir)
+
+  hparams = trainer_lib.create_hparams(
+      FLAGS.hparams_set,
+      FLAGS.hparams,
+      data_dir=os.path.expanduser(FLAGS.data_dir),
+      problem_name=FLAGS.problems)
+  mode = (tf.estimator.ModeKeys.TRAIN if FLAGS.bench_mode == "train" else
+          tf.estimator.ModeKeys.EVAL)
+  config = t2t_trainer.create_run_config(hparams)
+  problem = hparams.problem_instances[0]
+  input_stats = data_reader.InputPipelineStats()
+  features, _ = problem.input_fn(mode, hparams, config=config,
+                                 input_stats=input_stats)
+  features = dict((name, v) for name, v in six.iteritems(features)
+                  if v is not None)
+  nonpadding = dict((name, tf.reduce_mean(tf.to_float(tf.not_equal(v, 0))))
+                    for name, v in six.iteritems(features)
+                    if v.get_shape().ndims > 1)
+
+  padding = dict((name, []) for name in nonpadding)
+  with tf.train.MonitoredSession() as sess:
+    for _ in xrange(FLAGS.num_warmup_batches):
+      sess.run(features)
+    input_stats.rates()
+    start = time.time()
+    num_batches = 0
+    for num_batches in xrange(1, FLAGS.num_batches + 1):
+      try:
+        batch_nonpadding = sess.run(nonpadding)
+      except tf.errors.OutOfRangeError:
+        break
+      for name, fraction in six.iteritems(batch_nonpadding):
+        padding[name].append(1.0 - fraction)
+      if num_batches % FLAGS.report_every == 0:
+        tf.logging.info("After %d batches:", num_batches)
+        log_rates(input_stats)
+    elapsed = time.time() - start
+
+  tf.logging.info("Read %d batches in %.1f secs (%.1f batches/sec).",
+                  num_batches, elapsed, num_batches / max(elapsed, 1e-6))
+  log_rates(input_stats)
+  for name in sorted(padding):
+    if padding[name]:
+      tf.logging.info("  %s padding fraction: mean %.3f, p90 %.3f", name,
+                      np.mean(padding[name]),
+                      np.percentile(padding[name], 90))
+
+
+if __name__ == "__main__":
+  tf.app.run()
@@ -0,0 +1,121 @@
+# coding=utf-8
+# Copyright 2017 The Tensor2Tensor Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+r"""Benchmark for reading flat datasets against TFRecord files.
+
+Reads the same split of a problem through Problem.dataset from its TFRecord
+files and from its flat dataset, and reports examples and tokens per second
+for each. The flat dataset is written first if it does not exist.
+
+Example usage:
+
+python data_generators/flat_dataset_benchmark.py \
+    --data_dir=$DATA_DIR \
+    --problem=translate_ende_wmt32k \
+    --logtostderr
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import os
+import time
+
+# Dependency imports
+
+import six
+from six.moves import xrange  # pylint: disable=redefined-builtin
+
+from tensor2tensor.data_generators import generator_utils
+from tensor2tensor.data_generators import problem as problem_lib
+from tensor2tensor.utils import registry
+
+import tensorflow as tf
+
+tf.flags.DEFINE_string("data_dir", "", "Data directory.")
+tf.flags.DEFINE_string("problem", "", "Problem whose data to read.")
+tf.flags.DEFINE_string("split", "train", "Split to read: train, dev or test.")
+tf.flags.DEFINE_integer("num_examples", 100000, "Examples read per pass.")
+tf.flags.DEFINE_integer("num_repeats", 3, "Timed passes per format.")
+tf.flags.DEFINE_integer("examples_per_run", 1000,
+                        "Examples read per session run, so that the session "
+                        "overhead does not dominate the timings.")
+FLAGS = tf.flags.FLAGS
+
+_SPLIT_MODES = {
+    "train": tf.estimator.ModeKeys.TRAIN,
+    "dev": tf.estimator.ModeKeys.EVAL,
+    "test": "test",
+}
+
+
+def time_format(problem, data_dir, mode, dataset_format, num_examples,
+                num_repeats, examples_per_run=1000):
+  """Returns the best examples/sec and tokens/sec over num_repeats passes.
+
+  Each session run reads examples_per_run examples and only returns their
+  total number of tokens.
+  """
+  hparams = problem_lib.default_model_hparams()
+  hparams.add_hparam("dataset_format", dataset_format)
+  num_runs = max(1, num_examples // examples_per_run)
+  best = None
+  for _ in xrange(num_repeats):
+    with tf.Graph().as_default():
+      dataset = problem.dataset(mode, data_dir=data_dir, hparams=hparams,
+                                preprocess=False, shuffle_files=True,
+                                repeat=True)
+      dataset = dataset.map(lambda example: tf.add_n(
+          [tf.size(v) for v in six.itervalues(example)]))
+      dataset = dataset.batch(examples_per_run)
+      num_tokens = tf.reduce_sum(dataset.make_one_shot_iterator().get_next())
+      with tf.Session() as sess:
+        sess.run(num_tokens)
+        tokens = 0
+        start = time.time()
+        for _ in xrange(num_runs):
+          tokens += sess.run(num_tokens)
+        elapsed = max(time.time() - start, 1e-9)
+    if best is None or elapsed < best[0]:
+      best = (elapsed, tokens)
+  elapsed, tokens = best
+  return num_runs * examples_per_run / elapsed, tokens / elapsed
+
+
+def main(unused_argv):
+  tf.logging.set_verbosity(tf.logging.INFO)
+  data_dir = os.path.expanduser(FLAGS.data_dir)
+  problem = registry.problem(FLAGS.problem)
+  mode = _SPLIT_MODES[FLAGS.split]
+  if not generator_utils.flat_dataset_exists(
+      problem.flat_data_prefix(data_dir, mode)):
+    problem.convert_to_flat(data_dir)
+
+  results = {}
+  for dataset_format in ["tfrecord", "flat"]:
+    results[dataset_format] = time_format(problem, data_dir, mode,
+                                          dataset_format, FLAGS.num_examples,
+                                          FLAGS.num_repeats,
+                                          FLAGS.examples_per_run)
+  record_rate = results["tfrecord"][0]
+  for dataset_format in ["tfrecord", "flat"]:
+    examples_per_sec, tokens_per_sec = results[dataset_format]
+    tf.logging.info("%-8s: %.0f examples/sec, %.0f tokens/sec (%.2fx)",
+                    dataset_format, examples_per_sec, tokens_per_sec,
+                    examples_per_sec / record_rate)
+
+
+if __name__ == "__main__":
+  tf.app.run()
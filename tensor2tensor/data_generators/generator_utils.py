@@ -19,15 +19,23 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
-from collections import defaultdict
+import bisect
+import collections
 import gzip
+import json
+import math
+import multiprocessing
 import os
 import random
+import re
 import stat
+import struct
 import tarfile
+import threading
 
 # Dependency imports
 
+import numpy as np
 import requests
 import six
 from six.moves import xrange  # pylint: disable=redefined-builtin
@@ -63,6 +71,275 @@ def to_example(dictionary):
   return tf.train.Example(features=tf.train.Features(feature=features))
 
 
+# Bytes a TFRecord adds around each record: an 8-byte length, a 4-byte CRC of
+# the length and a 4-byte CRC of the data.
+_TFRECORD_OVERHEAD = 16
+
+
+def record_index_filename(filename):
+  """Name of the sidecar index of a TFRecord file.
+
+  The index is a hidden file next to the data, so that data file patterns
+  such as problem-train* do not match it.
+
+  Args:
+    filename: path of a TFRecord file.
+
+  Returns:
+    path of its index.
+  """
+  dirname, basename = os.path.split(filename)
+  return os.path.join(dirname, ".%s.index" % basename)
+
+
+class IndexedRecordWriter(object):
+  """A TFRecordWriter that also writes an index of its records.
+
+  The index holds the byte offset of every record, followed by the length of
+  the file, as little-endian int64s. It is written when the writer is closed,
+  so an index only exists for a complete file.
+  """
+
+  def __init__(self, filename):
+    self._filename = filename
+    self._writer = tf.python_io.TFRecordWriter(filename)
+    self._offsets = [0]
+
+  def write(self, record):
+    self._writer.write(record)
+    self._offsets.append(self._offsets[-1] + len(record) + _TFRECORD_OVERHEAD)
+
+  def close(self):
+    self._writer.close()
+    with tf.gfile.GFile(record_index_filename(self._filename), "wb") as f:
+      f.write(np.array(self._offsets, dtype="<i8").tobytes())
+
+
+def read_record_index(filename):
+  """Reads the index of a TFRecord file written by IndexedRecordWriter.
+
+  Args:
+    filename: path of a TFRecord file.
+
+  Returns:
+    an int64 numpy array of the offsets of the records followed by the length
+    of the file, or None if there is no index or it does not match the file.
+  """
+  index_filename = record_index_filename(filename)
+  if not tf.gfile.Exists(index_filename):
+    return None
+  with tf.gfile.GFile(index_filename, "rb") as f:
+    offsets = np.frombuffer(f.read(), dtype="<i8")
+  if not offsets.size or offsets[-1] != tf.gfile.Stat(filename).length:
+    tf.logging.warning("Ignoring stale record index %s", index_filename)
+    return None
+  return offsets
+
+
+def num_indexed_records(filename):
+  """Number of records in a TFRecord file per its index, or None."""
+  offsets = read_record_index(filename)
+  return None if offsets is None else len(offsets) - 1
+
+
+def read_records_from(filename, start):
+  """Yields the records of a TFRecord file from record number start on.
+
+  Seeks straight to the record with the file's index, rather than reading and
+  discarding the records before it. CRCs are not checked.
+
+  Args:
+    filename: path of a TFRecord file with an index.
+    start: number of the first record to yield.
+
+  Yields:
+    records, as strings.
+
+  Raises:
+    ValueError: if the file has no valid index.
+  """
+  offsets = read_record_index(filename)
+  if offsets is None:
+    raise ValueError("No record index for %s" % filename)
+  with tf.gfile.GFile(filename, "rb") as f:
+    f.seek(int(offsets[start]))
+    for _ in xrange(start, len(offsets) - 1):
+      length, = struct.unpack("<Q", f.read(8))
+      f.read(4)
+      yield f.read(length)
+      f.read(4)
+
+
+def flat_token_dtype(vocab_size):
+  """Numpy dtype of the tokens of a flat dataset over a vocab_size vocab."""
+  if vocab_size is not None and vocab_size <= 2**16:
+    return np.dtype("<u2")
+  return np.dtype("<i4")
+
+
+def _flat_feature_filenames(prefix, feature):
+  return "%s.%s.tokens" % (prefix, feature), "%s.%s.offsets" % (prefix, feature)
+
+
+def flat_dataset_exists(prefix):
+  return tf.gfile.Exists(prefix + ".json")
+
+
+class FlatDatasetWriter(object):
+  """Writes examples of integer sequences as a flat dataset.
+
+  A flat dataset stores each feature of all its examples as one contiguous
+  array of tokens, in a file of little-endian uint16s if the vocabulary fits
+  and int32s otherwise, with a file of the int64 offsets of the examples in
+  it followed by the number of tokens. A JSON file named prefix.json lists
+  the features; it is written when the writer is closed, so it only exists
+  for a complete dataset.
+  """
+
+  def __init__(self, prefix, features, vocab_size=None):
+    """Create a FlatDatasetWriter.
+
+    Args:
+      prefix: path prefix of the files of the dataset.
+      features: list of the names of the features to write.
+      vocab_size: int, the largest id written is less than this. None means
+        ids may not fit in uint16s.
+    """
+    self._prefix = prefix
+    self.features = list(features)
+    self._dtype = flat_token_dtype(vocab_size)
+    self._token_files = {}
+    self._offsets = {}
+    for feature in self.features:
+      tokens_filename, _ = _flat_feature_filenames(prefix, feature)
+      self._token_files[feature] = tf.gfile.GFile(tokens_filename, "wb")
+      self._offsets[feature] = [0]
+    self.num_examples = 0
+
+  def write(self, example):
+    """Writes an example, a dict from feature name to a list of ints."""
+    iinfo = np.iinfo(self._dtype)
+    for feature in self.features:
+      ids = np.asarray(example.get(feature, []), dtype=np.int64)
+      if ids.size and (ids.min() < iinfo.min or ids.max() > iinfo.max):
+        raise ValueError("Ids of %s do not fit in %s." %
+                         (feature, self._dtype.name))
+      self._token_files[feature].write(ids.astype(self._dtype).tobytes())
+      self._offsets[feature].append(self._offsets[feature][-1] + ids.size)
+    self.num_examples += 1
+
+  def close(self):
+    for feature in self.features:
+      self._token_files[feature].close()
+      _, offsets_filename = _flat_feature_filenames(self._prefix, feature)
+      with tf.gfile.GFile(offsets_filename, "wb") as f:
+        f.write(np.array(self._offsets[feature], dtype="<i8").tobytes())
+    with tf.gfile.GFile(self._prefix + ".json", "w") as f:
+      f.write(json.dumps({"features": self.features,
+                          "dtype": self._dtype.name,
+                          "num_examples": self.num_examples}))
+
+
+def _load_flat_array(filename, dtype):
+  """Memory-maps a local file as a numpy array, or reads a remote one."""
+  if "://" in filename:
+    with tf.gfile.GFile(filename, "rb") as f:
+      return np.frombuffer(f.read(), dtype=dtype)
+  if not os.path.getsize(filename):
+    return np.zeros([0], dtype=dtype)
+  return np.memmap(filename, dtype=dtype, mode="r")
+
+
+class FlatDataset(object):
+  """Reads a flat dataset written by FlatDatasetWriter.
+
+  The token arrays are memory-mapped, so examples are slices of them and are
+  only read from disk when used.
+  """
+
+  def __init__(self, prefix):
+    with tf.gfile.GFile(prefix + ".json") as f:
+      meta = json.loads(f.read())
+    self.features = meta["features"]
+    self.num_examples = meta["num_examples"]
+    dtype = np.dtype(meta["dtype"]).newbyteorder("<")
+    self._tokens = {}
+    self._offsets = {}
+    for feature in self.features:
+      tokens_filename, offsets_filename = _flat_feature_filenames(prefix,
+                                                                  feature)
+      self._tokens[feature] = _load_flat_array(tokens_filename, dtype)
+      self._offsets[feature] = _load_flat_array(offsets_filename, "<i8")
+      if (len(self._offsets[feature]) != self.num_examples + 1 or
+          self._offsets[feature][-1] != len(self._tokens[feature])):
+        raise ValueError("Flat dataset %s: files of %s do not match." %
+                         (prefix, feature))
+
+  def __len__(self):
+    return self.num_examples
+
+  def example(self, i):
+    """Returns example i as a dict from feature name to a numpy array.
+
+    The arrays are views of the memory-mapped tokens, not copies.
+
+    Args:
+      i: int, number of the example.
+    """
+    example = {}
+    for feature in self.features:
+      offsets = self._offsets[feature]
+      example[feature] = self._tokens[feature][offsets[i]:offsets[i + 1]]
+    return example
+
+  def examples(self, indices=None):
+    """Yields examples with int32 features, in the order of indices."""
+    if indices is None:
+      indices = xrange(self.num_examples)
+    for i in indices:
+      yield dict((feature, ids.astype(np.int32, copy=False))
+                 for feature, ids in six.iteritems(self.example(i)))
+
+
+def convert_records_to_flat(filenames, prefix, vocab_size=None):
+  """Writes the tf.Examples of TFRecord files as a flat dataset.
+
+  Only the int64 features are kept; the features of the first example decide
+  which ones are written.
+
+  Args:
+    filenames: list of TFRecord files, read in order.
+    prefix: path prefix of the flat dataset to write.
+    vocab_size: int, the ids of all int64 features are less than this, or
+      None if not known.
+
+  Returns:
+    the number of examples written.
+  """
+  writer = None
+  for filename in filenames:
+    tf.logging.info("Converting %s", filename)
+    for record in tf.python_io.tf_record_iterator(filename):
+      feature_map = tf.train.Example.FromString(record).features.feature
+      if writer is None:
+        features = sorted(name for name in feature_map
+                          if feature_map[name].HasField("int64_list"))
+        skipped = sorted(set(feature_map) - set(features))
+        if skipped:
+          tf.logging.warning("Not converting non-integer features %s",
+                             skipped)
+        writer = FlatDatasetWriter(prefix, features, vocab_size)
+      writer.write(dict((name, feature_map[name].int64_list.value)
+                        for name in writer.features
+                        if name in feature_map))
+      if writer.num_examples % 100000 == 0:
+        tf.logging.info("converted: %d", writer.num_examples)
+  if writer is None:
+    writer = FlatDatasetWriter(prefix, [], vocab_size)
+  writer.close()
+  return writer.num_examples
+
+
 def generate_files_distributed(generator,
                                output_name,
                                output_dir,
@@ -74,7 +351,7 @@ def generate_files_distributed(generator,
   output_filename = sharded_name(output_name, task_id, num_shards)
   output_file = os.path.join(output_dir, output_filename)
   tf.logging.info("Writing to file %s", output_file)
-  writer = tf.python_io.TFRecordWriter(output_file)
+  writer = IndexedRecordWriter(output_file)
 
   counter = 0
   for case in generator:
@@ -132,7 +409,8 @@ def outputs_exist(filenames):
       return out_fname
 
 
-def generate_files(generator, output_filenames, max_cases=None):
+def generate_files(generator, output_filenames, max_cases=None,
+                   num_workers=1, chunk_size=1000):
   """Generate cases from a generator and save as TFRecord files.
 
   Generated cases are transformed to tf.Example protos and saved as TFRecords
@@ -143,19 +421,34 @@ def generate_files(generator, output_filenames, max_cases=None):
     output_filenames: List of output file paths.
     max_cases: maximum number of cases to get from the generator;
       if None (default), we use the generator until StopIteration is raised.
+    num_workers: if greater than 1, build and serialize the tf.Examples in
+      this many processes, with a writer thread per output file. Cases are
+      assigned to output files in the same round-robin order either way.
+    chunk_size: number of cases sent to a worker process at a time.
   """
   if outputs_exist(output_filenames):
     tf.logging.info("Skipping generator because outputs files exist")
     return
+
+  def cases():
+    counter = 0
+    for case in generator:
+      if counter > 0 and counter % 100000 == 0:
+        tf.logging.info("Generating case %d." % counter)
+      counter += 1
+      if max_cases and counter > max_cases:
+        break
+      yield case
+
+  if num_workers > 1:
+    _generate_files_pipelined(cases(), output_filenames, num_workers,
+                              chunk_size)
+    return
+
   num_shards = len(output_filenames)
-  writers = [tf.python_io.TFRecordWriter(fname) for fname in output_filenames]
-  counter, shard = 0, 0
-  for case in generator:
-    if counter > 0 and counter % 100000 == 0:
-      tf.logging.info("Generating case %d." % counter)
-    counter += 1
-    if max_cases and counter > max_cases:
-      break
+  writers = [IndexedRecordWriter(fname) for fname in output_filenames]
+  shard = 0
+  for case in cases():
     sequence_example = to_example(case)
     writers[shard].write(sequence_example.SerializeToString())
     shard = (shard + 1) % num_shards
@@ -164,6 +457,97 @@ def generate_files(generator, output_filenames, max_cases=None):
     writer.close()
 
 
+def _serialize_cases(cases):
+  """Pool worker for generate_files: serializes a chunk of cases."""
+  return [to_example(case).SerializeToString() for case in cases]
+
+
+def _write_queued_records(filename, record_queue, errors):
+  """Writer thread for generate_files: writes records until it gets None.
+
+  If writing fails, the exception is appended to errors and the rest of the
+  records are discarded, so that the producer never blocks on a full queue.
+  """
+  try:
+    writer = IndexedRecordWriter(filename)
+    for record in iter(record_queue.get, None):
+      writer.write(record)
+  except Exception as e:  # pylint: disable=broad-except
+    errors.append(e)
+    for _ in iter(record_queue.get, None):
+      pass
+    return
+  try:
+    writer.close()
+  except Exception as e:  # pylint: disable=broad-except
+    errors.append(e)
+
+
+def _generate_files_pipelined(cases, output_filenames, num_workers,
+                              chunk_size):
+  """Serializes cases in a process pool and writes them from shard threads.
+
+  Chunks are submitted in order and their results consumed in the same order,
+  so the i-th case still goes to output file i % num_shards. At most two
+  chunks per worker are in flight to bound memory use.
+
+  Args:
+    cases: an iterable of (string -> int/float/str list) dictionaries.
+    output_filenames: List of output file paths.
+    num_workers: number of serialization processes.
+    chunk_size: number of cases sent to a worker process at a time.
+
+  Raises:
+    Exception: the first error of the writer threads, if any failed.
+  """
+  num_shards = len(output_filenames)
+  # Fork the pool before starting any thread, so that the worker processes do
+  # not inherit locks held by the writer threads.
+  pool = multiprocessing.Pool(processes=num_workers)
+  queues = [six.moves.queue.Queue(maxsize=chunk_size)
+            for _ in xrange(num_shards)]
+  errors = []
+  writer_threads = [
+      threading.Thread(target=_write_queued_records, args=(fname, q, errors))
+      for fname, q in zip(output_filenames, queues)]
+  for thread in writer_threads:
+    thread.start()
+
+  def enqueue(records, shard):
+    if errors:
+      raise errors[0]
+    for record in records:
+      queues[shard].put(record)
+      shard = (shard + 1) % num_shards
+    return shard
+
+  try:
+    shard = 0
+    pending = collections.deque()
+    chunk = []
+    for case in cases:
+      chunk.append(case)
+      if len(chunk) < chunk_size:
+        continue
+      pending.append(pool.apply_async(_serialize_cases, (chunk,)))
+      chunk = []
+      if len(pending) >= 2 * num_workers:
+        shard = enqueue(pending.popleft().get(), shard)
+    if chunk:
+      pending.append(pool.apply_async(_serialize_cases, (chunk,)))
+    while pending:
+      shard = enqueue(pending.popleft().get(), shard)
+  finally:
+    pool.close()
+    pool.join()
+    for q in queues:
+      q.put(None)
+    for thread in writer_threads:
+      thread.join()
+  if errors:
+    raise errors[0]
+
+
 def download_report_hook(count, block_size, total_size):
   """Report hook for download progress.
 
@@ -278,23 +662,30 @@ def gunzip_file(gz_path, new_path):
 
 
 def get_or_generate_vocab_inner(data_dir, vocab_filename, vocab_size,
-                                generator):
+                                generator, num_workers=1):
   """Inner implementation for vocab generators.
 
+  The token counts are stored next to the vocab file (with a ".token_counts"
+  suffix) so that rebuilding the vocab, e.g. after an interrupted run, does
+  not need to read and tokenize the corpus again.
+
   Args:
     data_dir: The base directory where data and vocab files are stored. If None,
         then do not save the vocab even if it doesn't exist.
     vocab_filename: relative filename where vocab file is stored
     vocab_size: target size of the vocabulary constructed by SubwordTextEncoder
     generator: a generator that produces tokens from the vocabulary
+    num_workers: number of processes used to tokenize and count the generator.
 
   Returns:
     A SubwordTextEncoder vocabulary object.
   """
   if data_dir is None:
     vocab_filepath = None
+    counts_filepath = None
   else:
     vocab_filepath = os.path.join(data_dir, vocab_filename)
+    counts_filepath = vocab_filepath + ".token_counts"
 
   if vocab_filepath is not None and tf.gfile.Exists(vocab_filepath):
     tf.logging.info("Found vocab file: %s", vocab_filepath)
@@ -302,10 +693,14 @@ def get_or_generate_vocab_inner(data_dir, vocab_filename, vocab_size,
     return vocab
 
   tf.logging.info("Generating vocab file: %s", vocab_filepath)
-  token_counts = defaultdict(int)
-  for item in generator:
-    for tok in tokenizer.encode(text_encoder.native_to_unicode(item)):
-      token_counts[tok] += 1
+  if counts_filepath is not None and tf.gfile.Exists(counts_filepath):
+    tf.logging.info("Found token counts file: %s", counts_filepath)
+    token_counts = tokenizer.load_token_counts(counts_filepath)
+  else:
+    token_counts = tokenizer.generator_token_counts(
+        generator, num_workers=num_workers)
+    if counts_filepath is not None:
+      tokenizer.store_token_counts(token_counts, counts_filepath)
 
   vocab = text_encoder.SubwordTextEncoder.build_to_target_size(
       vocab_size, token_counts, 1, 1e3)
@@ -316,7 +711,7 @@ def get_or_generate_vocab_inner(data_dir, vocab_filename, vocab_size,
 
 
 def get_or_generate_vocab(data_dir, tmp_dir, vocab_filename, vocab_size,
-                          sources, file_byte_budget=1e6):
+                          sources, file_byte_budget=1e6, num_workers=1):
   """Generate a vocabulary from the datasets in sources."""
 
   def generate():
@@ -364,11 +759,12 @@ def get_or_generate_vocab(data_dir, tmp_dir, vocab_filename, vocab_size,
               yield line
 
   return get_or_generate_vocab_inner(data_dir, vocab_filename, vocab_size,
-                                     generate())
+                                     generate(), num_workers=num_workers)
 
 
 def get_or_generate_tabbed_vocab(data_dir, tmp_dir, source_filename,
-                                 index, vocab_filename, vocab_size):
+                                 index, vocab_filename, vocab_size,
+                                 num_workers=1):
   r"""Generate a vocabulary from a tabbed source file.
 
   The source is a file of source, target pairs, where each line contains
@@ -382,6 +778,7 @@ def get_or_generate_tabbed_vocab(data_dir, tmp_dir, source_filename,
     index: index.
     vocab_filename: the name of the vocabulary file.
     vocab_size: vocabulary size.
+    num_workers: number of processes used to count tokens.
 
   Returns:
     The vocabulary.
@@ -398,11 +795,11 @@ def get_or_generate_tabbed_vocab(data_dir, tmp_dir, source_filename,
           yield part
 
   return get_or_generate_vocab_inner(data_dir, vocab_filename, vocab_size,
-                                     generate())
+                                     generate(), num_workers=num_workers)
 
 
 def get_or_generate_txt_vocab(data_dir, vocab_filename, vocab_size,
-                              filepatterns):
+                              filepatterns, num_workers=1):
   """Generate a vocabulary from txt files with example-per-line."""
   if isinstance(filepatterns, str):
     filepatterns = [filepatterns]
@@ -416,7 +813,7 @@ def get_or_generate_txt_vocab(data_dir, vocab_filename, vocab_size,
             yield line.strip()
 
   return get_or_generate_vocab_inner(data_dir, vocab_filename, vocab_size,
-                                     generate())
+                                     generate(), num_workers=num_workers)
 
 
 def read_records(filename):
@@ -430,7 +827,7 @@ def read_records(filename):
 
 
 def write_records(records, out_filename):
-  writer = tf.python_io.TFRecordWriter(out_filename)
+  writer = IndexedRecordWriter(out_filename)
   for count, record in enumerate(records):
     writer.write(record)
     if count > 0 and count % 100000 == 0:
@@ -442,24 +839,138 @@ def generate_dataset_and_shuffle(train_gen,
                                  train_paths,
                                  dev_gen,
                                  dev_paths,
-                                 shuffle=True):
-  generate_files(train_gen, train_paths)
-  generate_files(dev_gen, dev_paths)
+                                 shuffle=True,
+                                 num_workers=1):
+  generate_files(train_gen, train_paths, num_workers=num_workers)
+  generate_files(dev_gen, dev_paths, num_workers=num_workers)
   if shuffle:
     shuffle_dataset(train_paths + dev_paths)
 
 
-def shuffle_dataset(filenames):
+# Default bound on the records a shuffle holds in memory at once, in bytes.
+SHUFFLE_MEMORY_BUDGET = 1 << 30
+
+# What shuffle_dataset() does unless told otherwise; see
+# set_shuffle_defaults().
+_shuffle_defaults = {
+    "memory_budget": SHUFFLE_MEMORY_BUDGET,
+    "across_shards": False,
+}
+
+
+def set_shuffle_defaults(memory_budget=SHUFFLE_MEMORY_BUDGET,
+                         across_shards=False):
+  """Sets the defaults of shuffle_dataset() for this process.
+
+  Problems shuffle the files they generate with shuffle_dataset() from
+  generate_data(), where t2t-datagen cannot pass its arguments, so its
+  --shuffle_memory_budget and --shuffle_across_shards flags set them here.
+
+  Args:
+    memory_budget: approximate bytes of records to hold in memory at once.
+    across_shards: whether to shuffle across all shards of a split.
+  """
+  _shuffle_defaults["memory_budget"] = memory_budget
+  _shuffle_defaults["across_shards"] = across_shards
+
+
+def _split_name(filename):
+  """Strips the -NNNNN-of-NNNNN shard suffix from a data filename."""
+  return re.sub(r"-\d{5}-of-\d{5}$", "", filename)
+
+
+def _write_records_round_robin(records, writers, shard):
+  """Writes records to writers in turn starting at shard; returns next shard."""
+  for record in records:
+    writers[shard].write(record)
+    shard = (shard + 1) % len(writers)
+  return shard
+
+
+def _shuffle_records(in_filenames, out_filenames, memory_budget):
+  """Shuffles the records of in_filenames into out_filenames.
+
+  If the input fits in memory_budget, the records are shuffled in memory.
+  Otherwise each record is first scattered to one of K temporary bucket files
+  chosen at random, with K such that a bucket averages half the budget (room
+  for random imbalance). Each bucket is then shuffled in memory and appended
+  to the output. Output records are dealt round-robin to out_filenames.
+
+  Args:
+    in_filenames: list of TFRecord files to read.
+    out_filenames: list of TFRecord files to write.
+    memory_budget: approximate bytes of records to hold in memory at once.
+  """
+  total_bytes = sum(tf.gfile.Stat(f).length for f in in_filenames)
+  writers = [IndexedRecordWriter(f) for f in out_filenames]
+  if total_bytes <= memory_budget:
+    records = []
+    for fname in in_filenames:
+      records.extend(read_records(fname))
+    random.shuffle(records)
+    _write_records_round_robin(records, writers, 0)
+  else:
+    num_buckets = int(math.ceil(2.0 * total_bytes / memory_budget))
+    tf.logging.info("Shuffling %d bytes through %d buckets.",
+                    total_bytes, num_buckets)
+    bucket_filenames = ["%s.shuffle-bucket-%05d" % (out_filenames[0], i)
+                        for i in xrange(num_buckets)]
+    bucket_writers = [tf.python_io.TFRecordWriter(f) for f in bucket_filenames]
+    for fname in in_filenames:
+      for record in tf.python_io.tf_record_iterator(fname):
+        bucket_writers[random.randrange(num_buckets)].write(record)
+    for writer in bucket_writers:
+      writer.close()
+
+    shard = 0
+    for bucket_filename in bucket_filenames:
+      records = read_records(bucket_filename)
+      random.shuffle(records)
+      shard = _write_records_round_robin(records, writers, shard)
+      tf.gfile.Remove(bucket_filename)
+  for writer in writers:
+    writer.close()
+
+
+def shuffle_dataset(filenames, memory_budget=None, across_shards=None):
+  """Shuffles unshuffled TFRecord files and removes them.
+
+  Each file name has UNSHUFFLED_SUFFIX removed to get its output name. Shards
+  larger than memory_budget are shuffled out of core via temporary bucket
+  files next to the output.
+
+  Args:
+    filenames: list of unshuffled TFRecord files.
+    memory_budget: approximate bytes of records to hold in memory at once.
+      Defaults to SHUFFLE_MEMORY_BUDGET or what set_shuffle_defaults() set.
+    across_shards: if True, shuffle globally across all shards of the same
+      split (files named alike up to the -NNNNN-of-NNNNN suffix), so that every
+      output shard samples from the whole split. Otherwise each shard is
+      shuffled on its own. Defaults to False or what set_shuffle_defaults()
+      set.
+  """
+  if memory_budget is None:
+    memory_budget = _shuffle_defaults["memory_budget"]
+  if across_shards is None:
+    across_shards = _shuffle_defaults["across_shards"]
   if outputs_exist(filenames):
     tf.logging.info("Skipping shuffle because output files exist")
     return
   tf.logging.info("Shuffling data...")
-  for fname in filenames:
-    records = read_records(fname)
-    random.shuffle(records)
-    out_fname = fname.replace(UNSHUFFLED_SUFFIX, "")
-    write_records(records, out_fname)
-    tf.gfile.Remove(fname)
+  if across_shards:
+    splits = collections.OrderedDict()
+    for fname in filenames:
+      splits.setdefault(_split_name(fname), []).append(fname)
+    groups = list(splits.values())
+  else:
+    groups = [[fname] for fname in filenames]
+  for in_filenames in groups:
+    out_filenames = [f.replace(UNSHUFFLED_SUFFIX, "") for f in in_filenames]
+    _shuffle_records(in_filenames, out_filenames, memory_budget)
+    for fname in in_filenames:
+      tf.gfile.Remove(fname)
+      if tf.gfile.Exists(record_index_filename(fname)):
+        tf.gfile.Remove(record_index_filename(fname))
 
 
 class SequencePacker(object):
@@ -472,14 +983,14 @@ class SequencePacker(object):
     self._spacing = spacing
     self._ids = first_sequence[:]
     self._segmentation = [1] * len(first_sequence)
-    self._position = range(len(first_sequence))
+    self._position = list(range(len(first_sequence)))
 
   def add(self, ids):
     padding = [0] * self._spacing
     self._ids.extend(padding + ids)
     next_segment_num = self._segmentation[-1] + 1 if self._segmentation else 1
     self._segmentation.extend(padding + [next_segment_num] * len(ids))
-    self._position.extend(padding + range(len(ids)))
+    self._position.extend(padding + list(range(len(ids))))
 
   def can_fit(self, ids, packed_length):
     return len(self._ids) + self._spacing + len(ids) <= packed_length
@@ -518,12 +1029,184 @@ class SequencePairPacker(object):
     return ret
 
 
+class BestFitPacker(object):
+  """Packs sequence examples into fixed-capacity bins by best fit.
+
+  Produces packed examples in the same format as pack_examples(), but places
+  each sequence in the open bin that it fills most tightly instead of the
+  first one it fits in. Open bins are kept in a list sorted by remaining
+  "targets" capacity, so the best bin is found by bisection, which allows a
+  window of thousands of open bins. When the window is full, the fullest bin
+  is emitted. Bin contents live in arrays preallocated for the whole window.
+
+  After packing, stats() reports packing efficiency: the fraction of the
+  positions of the emitted examples (at packed_length each) that hold tokens
+  rather than padding or spacing.
+  """
+
+  def __init__(self,
+               has_inputs,
+               packed_length=256,
+               spacing=2,
+               max_open_bins=1000,
+               chop_long_sequences=False):
+    self._has_inputs = has_inputs
+    self._packed_length = packed_length
+    self._spacing = spacing
+    self._chop_long_sequences = chop_long_sequences
+    self._streams = ["inputs", "targets"] if has_inputs else ["targets"]
+    shape = [max_open_bins, packed_length]
+    self._ids = {s: np.zeros(shape, np.int64) for s in self._streams}
+    self._segmentation = {s: np.zeros(shape, np.int64) for s in self._streams}
+    self._position = {s: np.zeros(shape, np.int64) for s in self._streams}
+    self._fill = {s: [0] * max_open_bins for s in self._streams}
+    self._num_segments = [0] * max_open_bins
+    self._free_bins = list(reversed(xrange(max_open_bins)))
+    # Sorted (remaining targets capacity, bin) pairs of the open bins.
+    self._open_bins = []
+    self._num_examples = 0
+    self._num_packed = 0
+    self._num_positions = 0
+    self._num_tokens = {s: 0 for s in self._streams}
+
+  def _sequences(self, example):
+    return [example[s] for s in self._streams]
+
+  def _fits(self, b, sequences):
+    for stream, seq in zip(self._streams, sequences):
+      if (self._fill[stream][b] + self._spacing + len(seq) >
+          self._packed_length):
+        return False
+    return True
+
+  def _best_fit_index(self, sequences):
+    """Index in _open_bins of the tightest bin sequences fit in, or None."""
+    need = len(sequences[-1]) + self._spacing
+    i = bisect.bisect_left(self._open_bins, (need, -1))
+    while i < len(self._open_bins):
+      if self._fits(self._open_bins[i][1], sequences):
+        return i
+      i += 1
+    return None
+
+  def _add(self, b, sequences):
+    self._num_segments[b] += 1
+    segment = self._num_segments[b]
+    for stream, seq in zip(self._streams, sequences):
+      start = self._fill[stream][b]
+      if segment > 1:
+        start += self._spacing
+      end = start + len(seq)
+      self._ids[stream][b, start:end] = seq
+      self._segmentation[stream][b, start:end] = segment
+      self._position[stream][b, start:end] = np.arange(len(seq))
+      self._fill[stream][b] = end
+
+  def _remaining(self, b):
+    return self._packed_length - self._fill["targets"][b]
+
+  def _emit(self, b):
+    """Returns the packed example of bin b and frees the bin."""
+    ret = {"inputs": [0]}
+    for stream in self._streams:
+      fill = self._fill[stream][b]
+      ret[stream] = self._ids[stream][b, :fill].tolist()
+      ret[stream + "_segmentation"] = (
+          self._segmentation[stream][b, :fill].tolist())
+      ret[stream + "_position"] = self._position[stream][b, :fill].tolist()
+      for arrays in (self._ids, self._segmentation, self._position):
+        arrays[stream][b, :fill] = 0
+      self._fill[stream][b] = 0
+      self._num_tokens[stream] += int(np.count_nonzero(
+          ret[stream + "_segmentation"]))
+    self._num_segments[b] = 0
+    self._free_bins.append(b)
+    self._num_packed += 1
+    self._num_positions += self._packed_length
+    return ret
+
+  def _emit_singleton(self, sequences):
+    """Returns an example of sequences that take a whole bin or more.
+
+    The example is emitted directly, leaving the open bins untouched.
+    """
+    ret = {"inputs": [0]}
+    length = 0
+    for stream, seq in zip(self._streams, sequences):
+      ret[stream] = list(seq)
+      ret[stream + "_segmentation"] = [1] * len(seq)
+      ret[stream + "_position"] = list(range(len(seq)))
+      self._num_tokens[stream] += len(seq)
+      length = max(length, len(seq))
+    self._num_packed += 1
+    self._num_positions += max(length, self._packed_length)
+    return ret
+
+  def _place(self, sequences):
+    """Adds sequences to the best bin; yields any examples emitted."""
+    if max(len(seq) for seq in sequences) > self._packed_length:
+      yield self._emit_singleton(sequences)
+      return
+    i = self._best_fit_index(sequences)
+    if i is None:
+      if not self._free_bins:
+        # Evict the fullest open bin.
+        _, evicted = self._open_bins.pop(0)
+        yield self._emit(evicted)
+      b = self._free_bins.pop()
+    else:
+      _, b = self._open_bins.pop(i)
+    self._add(b, sequences)
+    if self._remaining(b) <= self._spacing:
+      # Nothing non-empty can fit any more.
+      yield self._emit(b)
+    else:
+      bisect.insort(self._open_bins, (self._remaining(b), b))
+
+  def pack(self, examples):
+    """Packs examples.
+
+    Args:
+      examples: a generator returning feature dictionaries.
+
+    Yields:
+      feature dictionaries, as from pack_examples().
+    """
+    for example in examples:
+      self._num_examples += 1
+      sequences = self._sequences(example)
+      if self._chop_long_sequences and len(sequences[-1]) > self._packed_length:
+        assert not self._has_inputs
+        x = sequences[-1]
+        num_fragments = len(x) // self._packed_length
+        for i in xrange(num_fragments):
+          fragment = x[self._packed_length * i:self._packed_length * (i + 1)]
+          yield self._emit_singleton([fragment])
+        sequences = [x[self._packed_length * num_fragments:]]
+      for packed in self._place(sequences):
+        yield packed
+    while self._open_bins:
+      _, b = self._open_bins.pop(0)
+      yield self._emit(b)
+
+  def stats(self):
+    """Returns a dict of example counts and per-feature packing efficiency."""
+    ret = {"examples": self._num_examples,
+           "packed_examples": self._num_packed}
+    for stream in self._streams:
+      ret[stream + "_efficiency"] = (
+          float(self._num_tokens[stream]) / self._num_positions
+          if self._num_positions else 0.0)
+    return ret
+
+
 def pack_examples(examples,
                   has_inputs,
                   packed_length=256,
                   spacing=2,
                   queue_size=10,
-                  chop_long_sequences=False):
+                  chop_long_sequences=False,
+                  best_fit=False):
   """Pack examples into longer examples.
 
   If has_inputs=False, we are packing single-sequence examples with
@@ -559,12 +1242,24 @@ def pack_examples(examples,
     has_inputs: a boolean
     packed_length: an integer
     spacing: an integer
-    queue_size: an integer
+    queue_size: an integer; how many partially packed examples to keep open.
     chop_long_sequences: a boolean
+    best_fit: a boolean; if True, pack with a BestFitPacker, which puts each
+      sequence in the open example it fills most tightly and is efficient
+      with a much larger queue_size.
 
   Yields:
     feature dictionaries.
   """
+  if best_fit:
+    best_fit_packer = BestFitPacker(
+        has_inputs, packed_length=packed_length, spacing=spacing,
+        max_open_bins=queue_size, chop_long_sequences=chop_long_sequences)
+    for packed in best_fit_packer.pack(examples):
+      yield packed
+    tf.logging.info("Packing stats: %s", best_fit_packer.stats())
+    return
+
   packer = SequencePairPacker if has_inputs else SequencePacker
   combined = []
   for example in examples:
@@ -52,6 +52,182 @@ class GeneratorUtilsTest(tf.test.TestCase):
     os.remove(tmp_file_path + "-train-00000-of-00001")
     os.remove(tmp_file_path)
 
+  def testGenerateFilesPipelined(self):
+    tmp_dir = tempfile.mkdtemp(dir=self.get_temp_dir())
+
+    def test_generator():
+      for i in range(1000):
+        yield {"inputs": [i], "targets": [i, i]}
+
+    serial = generator_utils.train_data_filenames("serial", tmp_dir, 3)
+    generator_utils.generate_files(test_generator(), serial, max_cases=500)
+    pipelined = generator_utils.train_data_filenames("pipelined", tmp_dir, 3)
+    generator_utils.generate_files(test_generator(), pipelined, max_cases=500,
+                                   num_workers=2, chunk_size=7)
+
+    # Shard assignment and max_cases do not depend on the number of workers.
+    for serial_fname, pipelined_fname in zip(serial, pipelined):
+      self.assertEqual(generator_utils.read_records(serial_fname),
+                       generator_utils.read_records(pipelined_fname))
+
+  def testGenerateFilesPipelinedWriterError(self):
+    tmp_dir = tempfile.mkdtemp(dir=self.get_temp_dir())
+
+    def test_generator():
+      for i in range(1000):
+        yield {"inputs": [i], "targets": [i, i]}
+
+    # The second shard cannot be written; the error is raised rather than
+    # blocking the producer once that shard's queue is full.
+    filenames = [os.path.join(tmp_dir, "ok"),
+                 os.path.join(tmp_dir, "missing", "shard")]
+    with self.assertRaises(Exception):
+      generator_utils.generate_files(test_generator(), filenames,
+                                     num_workers=2, chunk_size=7)
+
+  def testShuffleDatasetAcrossShards(self):
+    tmp_dir = tempfile.mkdtemp(dir=self.get_temp_dir())
+    filenames = generator_utils.train_data_filenames(
+        "shuffle" + generator_utils.UNSHUFFLED_SUFFIX, tmp_dir, 2)
+    records = []
+    for shard, fname in enumerate(filenames):
+      shard_records = [bytes("%d-%d" % (shard, i), "utf-8")
+                       for i in range(100)]
+      generator_utils.write_records(shard_records, fname)
+      records.extend(shard_records)
+
+    # A tiny memory budget forces the shuffle through temporary buckets.
+    generator_utils.shuffle_dataset(filenames, memory_budget=100,
+                                    across_shards=True)
+
+    shuffled = []
+    for fname in filenames:
+      self.assertFalse(tf.gfile.Exists(fname))
+      out_fname = fname.replace(generator_utils.UNSHUFFLED_SUFFIX, "")
+      shard_records = generator_utils.read_records(out_fname)
+      self.assertEqual(100, len(shard_records))
+      shuffled.extend(shard_records)
+    self.assertEqual(sorted(records), sorted(shuffled))
+    # Only the shuffled shards and their indices are left.
+    self.assertEqual(4, len(os.listdir(tmp_dir)))
+
+  def testShuffleDatasetDefaults(self):
+    tmp_dir = tempfile.mkdtemp(dir=self.get_temp_dir())
+    filenames = generator_utils.train_data_filenames(
+        "shuffle" + generator_utils.UNSHUFFLED_SUFFIX, tmp_dir, 2)
+    for shard, fname in enumerate(filenames):
+      generator_utils.write_records(
+          [bytes("%d-%d" % (shard, i), "utf-8") for i in range(100)], fname)
+
+    # As set by t2t-datagen for the shuffles of Problem.generate_data.
+    generator_utils.set_shuffle_defaults(memory_budget=100,
+                                         across_shards=True)
+    try:
+      generator_utils.shuffle_dataset(filenames)
+    finally:
+      generator_utils.set_shuffle_defaults()
+
+    for shard, fname in enumerate(filenames):
+      out_fname = fname.replace(generator_utils.UNSHUFFLED_SUFFIX, "")
+      other = bytes("%d-" % (1 - shard), "utf-8")
+      # Each output shard holds records of the other input shard.
+      self.assertTrue(any(record.startswith(other) for record in
+                          generator_utils.read_records(out_fname)))
+
+  def testRecordIndex(self):
+    tmp_dir = tempfile.mkdtemp(dir=self.get_temp_dir())
+    fname = os.path.join(tmp_dir, "records")
+    records = [bytes("record %d" % i, "utf-8") * i for i in range(10)]
+    generator_utils.write_records(records, fname)
+
+    self.assertEqual(10, generator_utils.num_indexed_records(fname))
+    self.assertEqual(records[7:],
+                     list(generator_utils.read_records_from(fname, 7)))
+    self.assertEqual([], list(generator_utils.read_records_from(fname, 10)))
+
+    # An index that does not match its file is ignored.
+    generator_utils.write_records(records[:5], fname + "-other")
+    tf.gfile.Copy(generator_utils.record_index_filename(fname + "-other"),
+                  generator_utils.record_index_filename(fname), overwrite=True)
+    self.assertIsNone(generator_utils.num_indexed_records(fname))
+
+  def testFlatDataset(self):
+    tmp_dir = tempfile.mkdtemp(dir=self.get_temp_dir())
+    prefix = os.path.join(tmp_dir, "data.flat-train")
+    examples = [{"inputs": [5, 6, 1], "targets": [300, 1]},
+                {"inputs": [1], "targets": [7, 8, 9, 1]},
+                {"inputs": [2, 1], "targets": []}]
+    writer = generator_utils.FlatDatasetWriter(prefix, ["inputs", "targets"],
+                                               vocab_size=301)
+    for example in examples:
+      writer.write(example)
+    self.assertFalse(generator_utils.flat_dataset_exists(prefix))
+    writer.close()
+    self.assertTrue(generator_utils.flat_dataset_exists(prefix))
+    # Ids that fit are stored as uint16s.
+    self.assertEqual(2 * 6, os.path.getsize(prefix + ".inputs.tokens"))
+
+    dataset = generator_utils.FlatDataset(prefix)
+    self.assertEqual(3, len(dataset))
+    self.assertEqual([7, 8, 9, 1], list(dataset.example(1)["targets"]))
+    read = list(dataset.examples([2, 0]))
+    self.assertEqual([[2, 1], [5, 6, 1]], [list(e["inputs"]) for e in read])
+    self.assertEqual("int32", read[0]["targets"].dtype.name)
+
+    # TFRecord files convert to the same dataset.
+    records = [generator_utils.to_example(dict(e, score=[0.5])).
+               SerializeToString() for e in examples[:2]]
+    generator_utils.write_records(records[:1], prefix + "-00000")
+    generator_utils.write_records(records[1:], prefix + "-00001")
+    converted = prefix + "-converted"
+    self.assertEqual(2, generator_utils.convert_records_to_flat(
+        [prefix + "-00000", prefix + "-00001"], converted))
+    dataset = generator_utils.FlatDataset(converted)
+    self.assertEqual(["inputs", "targets"], dataset.features)
+    self.assertEqual([300, 1], list(dataset.example(0)["targets"]))
+
+    with self.assertRaises(ValueError):
+      generator_utils.FlatDatasetWriter(
+          prefix + "-small", ["inputs"], vocab_size=10).write(
+              {"inputs": [70000]})
+
+  def testPackExamplesBestFit(self):
+    examples = [{"targets": [i + 1] * n}
+                for i, n in enumerate([6, 3, 5, 2, 1, 4])]
+    packer = generator_utils.BestFitPacker(
+        has_inputs=False, packed_length=8, spacing=0, max_open_bins=4)
+    packed = list(packer.pack(iter(examples)))
+    # Full bins are emitted as soon as they fill up.
+    self.assertEqual([[2, 2, 2, 3, 3, 3, 3, 3],
+                      [1, 1, 1, 1, 1, 1, 4, 4],
+                      [5, 6, 6, 6, 6]],
+                     [ex["targets"] for ex in packed])
+    self.assertEqual([1, 1, 1, 2, 2, 2, 2, 2],
+                     packed[0]["targets_segmentation"])
+    self.assertEqual([0, 1, 2, 0, 1, 2, 3, 4], packed[0]["targets_position"])
+    self.assertEqual([0], packed[0]["inputs"])
+    stats = packer.stats()
+    self.assertEqual(6, stats["examples"])
+    self.assertEqual(3, stats["packed_examples"])
+    self.assertAllClose(21. / 24., stats["targets_efficiency"])
+
+  def testPackExamplesBestFitChopsWithoutEvicting(self):
+    examples = [{"targets": [1] * 3}, {"targets": [2] * 6},
+                {"targets": [3] * 19}, {"targets": [4] * 2}]
+    packer = generator_utils.BestFitPacker(
+        has_inputs=False, packed_length=8, spacing=0, max_open_bins=2,
+        chop_long_sequences=True)
+    packed = list(packer.pack(iter(examples)))
+    # Both bins are open when the long example comes; its full fragments are
+    # emitted without evicting them.
+    self.assertEqual([[3] * 8,
+                      [3] * 8,
+                      [1, 1, 1, 3, 3, 3, 4, 4],
+                      [2] * 6],
+                     [ex["targets"] for ex in packed])
+    self.assertEqual(4, packer.stats()["packed_examples"])
+    self.assertAllClose(30. / 32., packer.stats()["targets_efficiency"])
+
   def testMaybeDownload(self):
     tmp_dir = self.get_temp_dir()
     (_, tmp_file_path) = tempfile.mkstemp(dir=tmp_dir)
@@ -21,6 +21,7 @@ import collections
 import os
 import random
 # Dependency imports
+import numpy as np
 import six
 from tensor2tensor.data_generators import generator_utils
 from tensor2tensor.data_generators import text_encoder
@@ -129,12 +130,14 @@ def preprocess_example_common(example, hparams, mode):
 
 def _file_num_records_cached(filename):
   """Return the number of TFRecords in a file."""
-  # Cache the result, as this is expensive to compute
+  # Cache the result, as this is expensive to compute without an index
   if filename in _file_num_records_cache:
     return _file_num_records_cache[filename]
-  ret = 0
-  for _ in tf.python_io.tf_record_iterator(filename):
-    ret += 1
+  ret = generator_utils.num_indexed_records(filename)
+  if ret is None:
+    ret = 0
+    for _ in tf.python_io.tf_record_iterator(filename):
+      ret += 1
   _file_num_records_cache[filename] = ret
   return ret
 
@@ -142,6 +145,46 @@ def _file_num_records_cached(filename):
 _file_num_records_cache = {}
 
 
+def _worker_data_files(data_files, num_workers, worker_id):
+  """Assigns data files to a worker, logging how much data it reads.
+
+  Args:
+    data_files: list of all the data files.
+    num_workers: int, number of workers reading the data.
+    worker_id: int, the index of the worker, in [0, num_workers).
+
+  Returns:
+    (the files the worker reads, whether it should also only read every
+    num_workers-th record of each). Files are divided among the workers if
+    their number is a multiple of num_workers, else every worker reads all
+    the files and divides their records with the others.
+  """
+  data_files = sorted(data_files)
+  total_bytes = sum(tf.gfile.Stat(f).length for f in data_files)
+  if len(data_files) % num_workers == 0:
+    worker_files = data_files[worker_id::num_workers]
+    worker_bytes = sum(tf.gfile.Stat(f).length for f in worker_files)
+    tf.logging.info("Worker %d of %d reads %d of %d files, %.1f of %.1f MB.",
+                    worker_id, num_workers, len(worker_files),
+                    len(data_files), worker_bytes / 1e6, total_bytes / 1e6)
+    return worker_files, False
+  tf.logging.warning(
+      "%d files do not divide among %d workers; worker %d reads all %.1f MB "
+      "and keeps 1 in %d records.", len(data_files), num_workers,
+      worker_id, total_bytes / 1e6, num_workers)
+  return data_files, True
+
+
+def _split_suffix(mode):
+  """Suffix of the data files of mode: train, dev or test."""
+  if mode == tf.estimator.ModeKeys.TRAIN:
+    return "train"
+  elif mode in [tf.estimator.ModeKeys.EVAL, tf.estimator.ModeKeys.PREDICT]:
+    return "dev"
+  assert mode == "test"
+  return "test"
+
+
 class Problem(object):
   """Problem base class. Specifies a T2T problem.
 
@@ -347,15 +390,35 @@ class Problem(object):
     """
     path = os.path.join(data_dir, self.dataset_filename())
     shard_str = "-%05d" % shard if shard is not None else ""
-    if mode == tf.estimator.ModeKeys.TRAIN:
-      suffix = "train"
-    elif mode in [tf.estimator.ModeKeys.EVAL, tf.estimator.ModeKeys.PREDICT]:
-      suffix = "dev"
-    else:
-      assert mode == "test"
-      suffix = "test"
+    return "%s-%s%s*" % (path, _split_suffix(mode), shard_str)
 
-    return "%s-%s%s*" % (path, suffix, shard_str)
+  def flat_data_prefix(self, data_dir, mode):
+    """Path prefix of the flat dataset for mode; see filepattern."""
+    path = os.path.join(data_dir, self.dataset_filename())
+    return "%s.flat-%s" % (path, _split_suffix(mode))
+
+  def convert_to_flat(self, data_dir):
+    """Writes a flat copy of the TFRecord files of each split in data_dir.
+
+    Problem.dataset reads the flat copies if hparams.dataset_format is
+    "flat". Only integer features are copied.
+
+    Args:
+      data_dir: directory that contains data files.
+    """
+    vocab_sizes = [getattr(encoder, "vocab_size", None) for encoder in
+                   self.get_feature_encoders(data_dir).values()]
+    vocab_size = (max(vocab_sizes) if vocab_sizes and None not in vocab_sizes
+                  else None)
+    for mode in [tf.estimator.ModeKeys.TRAIN, tf.estimator.ModeKeys.EVAL,
+                 "test"]:
+      filenames = sorted(tf.gfile.Glob(self.filepattern(data_dir, mode)))
+      if not filenames:
+        continue
+      prefix = self.flat_data_prefix(data_dir, mode)
+      num_examples = generator_utils.convert_records_to_flat(
+          filenames, prefix, vocab_size)
+      tf.logging.info("Wrote %d examples to %s", num_examples, prefix)
 
   def __init__(self, was_reversed=False, was_copy=False):
     """Create a Problem.
@@ -425,7 +488,10 @@ class Problem(object):
               hparams=None,
               preprocess=True,
               dataset_split=None,
-              shard=None):
+              shard=None,
+              record_reader=None,
+              num_workers=1,
+              worker_id=0):
     """Build a Dataset for this problem.
 
     Args:
@@ -441,12 +507,21 @@ class Problem(object):
         mode == TRAIN.
       hparams: tf.contrib.training.HParams; hparams to be passed to
         Problem.preprocess_example and Problem.hparams. If None, will use a
-        default set that is a no-op.
+        default set that is a no-op. If hparams.dataset_format is "flat", the
+        flat dataset written by convert_to_flat is read instead of the
+        TFRecord files.
       preprocess: bool, whether to map the Dataset through
         Problem.preprocess_example.
       dataset_split: tf.estimator.ModeKeys + ["test"], which split to read data
         from (TRAIN:"-train", EVAL:"-dev", "test":"-test"). Defaults to mode.
       shard: int, if provided, will only read data from the specified shard.
+      record_reader: data_reader.ResumableRecordReader, if passed, reads the
+        TFRecord files through it, in an order that is resumed from the
+        latest checkpoint, rather than from a random point.
+      num_workers: int, number of workers reading the data. If more than 1,
+        each worker reads a disjoint subset of the files, or of the records
+        of each file if the files do not divide evenly among the workers.
+      worker_id: int, the index of this worker, in [0, num_workers).
 
     Returns:
       Dataset containing dict<feature name, Tensor>.
@@ -468,16 +543,6 @@ class Problem(object):
     # Construct the Problem's hparams so that items within it are accessible
     _ = self.get_hparams(hparams)
 
-    data_filepattern = self.filepattern(data_dir, dataset_split, shard=shard)
-    tf.logging.info("Reading data files from %s", data_filepattern)
-    dataset = tf.data.Dataset.list_files(data_filepattern)
-
-    if shuffle_files:
-      dataset = dataset.shuffle(buffer_size=1024)
-
-    def _load_records(filename):
-      return tf.data.TFRecordDataset(filename, buffer_size=16 * 1000 * 1000)
-
     if hasattr(tf.contrib.data, "parallel_interleave"):
       interleave = lambda ds, fn: ds.apply(  # pylint: disable=g-long-lambda
           tf.contrib.data.parallel_interleave(
@@ -485,19 +550,27 @@ class Problem(object):
     else:
       interleave = lambda ds, fn: ds.interleave(fn, cycle_length=16)
 
-    dataset = interleave(dataset, _load_records)
-
-    if repeat:
-      dataset = dataset.repeat()
-
-    if shuffle_files:
-      # Skip a random fraction at the beginning of the stream.  The skip is
-      # essential for synchronous highly-parallel training to avoid multiple
-      # replicas reading the same data in lock-step.
-      data_files = tf.contrib.slim.parallel_reader.get_data_files(
-          data_filepattern)
-      num_skip = random.randint(0, _file_num_records_cached(data_files[0]))
-      dataset = dataset.skip(num_skip)
+    if getattr(hparams, "dataset_format", "tfrecord") == "flat":
+      if shard is not None or record_reader is not None:
+        raise ValueError("Flat datasets are not sharded or resumable.")
+      dataset = self._flat_dataset(data_dir, dataset_split, shuffle_files,
+                                   num_workers, worker_id)
+      if repeat:
+        dataset = dataset.repeat()
+    else:
+      if record_reader is not None:
+        data_files = tf.contrib.slim.parallel_reader.get_data_files(
+            self.filepattern(data_dir, dataset_split, shard=shard))
+        data_files, shard_records = _worker_data_files(
+            data_files, num_workers, worker_id)
+        dataset = record_reader.dataset(data_files, shuffle_files, repeat)
+        if shard_records:
+          dataset = dataset.shard(num_workers, worker_id)
+      else:
+        dataset = self._record_dataset(data_dir, dataset_split, shard,
+                                       shuffle_files, repeat, interleave,
+                                       num_workers, worker_id)
+      dataset = dataset.map(self.decode_example, num_parallel_calls=num_threads)
 
     def _maybe_reverse_and_copy(example):
       self.maybe_reverse_features(example)
@@ -510,8 +583,6 @@ class Problem(object):
         examples = tf.data.Dataset.from_tensors(examples)
       return examples
 
-    dataset = dataset.map(self.decode_example, num_parallel_calls=num_threads)
-
     if preprocess:
       dataset = interleave(dataset, _preprocess)
 
@@ -523,6 +594,87 @@ class Problem(object):
 
     return dataset
 
+  def _record_dataset(self, data_dir, dataset_split, shard, shuffle_files,
+                      repeat, interleave, num_workers=1, worker_id=0):
+    """Dataset of the serialized tf.Examples of a split's TFRecord files."""
+    data_filepattern = self.filepattern(data_dir, dataset_split, shard=shard)
+    tf.logging.info("Reading data files from %s", data_filepattern)
+    shard_records = False
+    if num_workers > 1:
+      data_files, shard_records = _worker_data_files(
+          tf.contrib.slim.parallel_reader.get_data_files(data_filepattern),
+          num_workers, worker_id)
+      dataset = tf.data.Dataset.from_tensor_slices(tf.constant(data_files))
+    else:
+      dataset = tf.data.Dataset.list_files(data_filepattern)
+
+    if shuffle_files:
+      dataset = dataset.shuffle(buffer_size=1024)
+
+    def _load_records(filename):
+      records = tf.data.TFRecordDataset(filename, buffer_size=16 * 1000 * 1000)
+      if shard_records:
+        records = records.shard(num_workers, worker_id)
+      return records
+
+    dataset = interleave(dataset, _load_records)
+
+    if repeat:
+      dataset = dataset.repeat()
+
+    # Workers that read disjoint data do not need the random skip below to
+    # stay out of lock-step.
+    if shuffle_files and num_workers <= 1:
+      # Skip a random fraction at the beginning of the stream.  The skip is
+      # essential for synchronous highly-parallel training to avoid multiple
+      # replicas reading the same data in lock-step.
+      data_files = tf.contrib.slim.parallel_reader.get_data_files(
+          data_filepattern)
+      num_skip = random.randint(0, _file_num_records_cached(data_files[0]))
+      dataset = dataset.skip(num_skip)
+    return dataset
+
+  def _flat_dataset(self, data_dir, dataset_split, shuffle, num_workers=1,
+                    worker_id=0):
+    """Dataset of the examples of a split's flat dataset.
+
+    Examples are sliced from the memory-mapped token arrays of the dataset
+    written by convert_to_flat, so no records are parsed.
+
+    Args:
+      data_dir: directory that contains data files.
+      dataset_split: tf.estimator.ModeKeys or "test".
+      shuffle: whether to read the examples in a new random order each time
+        the Dataset is iterated.
+      num_workers: int, number of workers reading the data; each reads every
+        num_workers-th example.
+      worker_id: int, the index of this worker, in [0, num_workers).
+
+    Returns:
+      Dataset of dict<feature name, int32 Tensor>.
+    """
+    prefix = self.flat_data_prefix(data_dir, dataset_split)
+    tf.logging.info("Reading flat dataset %s", prefix)
+    flat_dataset = generator_utils.FlatDataset(prefix)
+    worker_indices = np.arange(worker_id, flat_dataset.num_examples,
+                               num_workers)
+    if num_workers > 1:
+      tf.logging.info("Worker %d of %d reads %d of %d examples", worker_id,
+                      num_workers, len(worker_indices),
+                      flat_dataset.num_examples)
+
+    def _examples():
+      indices = worker_indices
+      if shuffle:
+        indices = np.random.permutation(worker_indices)
+      return flat_dataset.examples(indices)
+
+    features = flat_dataset.features
+    return tf.data.Dataset.from_generator(
+        _examples,
+        dict((feature, tf.int32) for feature in features),
+        dict((feature, tf.TensorShape([None])) for feature in features))
+
   def decode_example(self, serialized_example):
     """Return a dict of Tensors from a serialized tensorflow.Example."""
     data_fields, data_items_to_decoders = self.example_reading_spec()
@@ -589,17 +741,21 @@ class Problem(object):
     return features
 
   def make_estimator_input_fn(self, mode, hparams, data_dir=None,
-                              dataset_kwargs=None):
+                              dataset_kwargs=None, example_filter=None,
+                              max_examples=None):
     """Return input_fn wrapped for Estimator."""
 
     def estimator_input_fn(params, config):
       return self.input_fn(mode, hparams, data_dir=data_dir, params=params,
-                           config=config, dataset_kwargs=dataset_kwargs)
+                           config=config, dataset_kwargs=dataset_kwargs,
+                           example_filter=example_filter,
+                           max_examples=max_examples)
 
     return estimator_input_fn
 
   def input_fn(self, mode, hparams, data_dir=None, params=None, config=None,
-               dataset_kwargs=None):
+               dataset_kwargs=None, example_filter=None, input_stats=None,
+               max_examples=None):
     """Builds input pipeline for problem.
 
     Args:
@@ -611,6 +767,13 @@ class Problem(object):
         TPU
       dataset_kwargs: dict, if passed, will pass as kwargs to self.dataset
         method when called
+      example_filter: function, if passed, examples for which it returns a
+        False boolean Tensor are dropped before batching
+      input_stats: data_reader.InputPipelineStats, if passed, records the
+        throughput of the pipeline's stages; one is created if
+        hparams.instrument_input_pipeline is set. Not used on TPU.
+      max_examples: int, if passed, only the first max_examples examples are
+        read; examples dropped by example_filter count toward it.
 
     Returns:
       (features_dict<str name, Tensor feature>, Tensor targets)
@@ -648,9 +811,29 @@ class Problem(object):
         "num_threads": num_threads,
         "hparams": hparams})
 
+    if (hparams.shard_data_by_worker and is_training and config and
+        not config.use_tpu):
+      device_info = getattr(config, "t2t_device_info", {})
+      num_workers = device_info.get("num_async_replicas", 1)
+      if num_workers > 1:
+        dataset_kwargs.update({
+            "num_workers": num_workers,
+            "worker_id": device_info.get("worker_id", 0)})
+
+    if config and config.use_tpu:
+      input_stats = None
+    elif input_stats is None and hparams.instrument_input_pipeline:
+      input_stats = data_reader.InputPipelineStats()
+
     dataset = self.dataset(**dataset_kwargs)
     dataset = dataset.map(
         data_reader.cast_int64_to_int32, num_parallel_calls=num_threads)
+    if input_stats:
+      dataset = input_stats.count(dataset, "read")
+    if max_examples is not None:
+      dataset = dataset.take(max_examples)
+    if example_filter is not None:
+      dataset = dataset.filter(example_filter)
     if is_training:
       dataset = dataset.repeat(None)
 
@@ -693,19 +876,38 @@ class Problem(object):
       else:
         # On GPU, bucket by length
         dataset = dataset.filter(gpu_valid_size)
-        batching_scheme = data_reader.hparams_to_batching_scheme(
-            hparams,
-            shard_multiplier=(config and config.data_parallelism.n) or 1,
-            length_multiplier=self.get_hparams().batch_size_multiplier)
-        if hparams.use_fixed_batch_size:
-          # Here  batch_size really means examples per datashard.
-          batching_scheme["batch_sizes"] = [hparams.batch_size]
-          batching_scheme["boundaries"] = []
-        dataset = data_reader.bucket_by_sequence_length(
-            dataset,
-            data_reader.example_length,
-            batching_scheme["boundaries"],
-            batching_scheme["batch_sizes"])
+        if input_stats:
+          dataset = input_stats.count(dataset, "valid")
+          input_stats.count_drops("read", "valid")
+        shard_multiplier = (config and config.data_parallelism.n) or 1
+        if (hparams.batching_mode == "sorted_buffer" and
+            not hparams.use_fixed_batch_size):
+          # batch_size_multiplier is not used: below it only stretches the
+          # bucket boundaries, and the token budget, like the batch sizes of
+          # the buckets, is in example_length units already. In eval, no
+          # examples are dropped to split batches evenly across datashards;
+          # _pad_batch pads them instead.
+          dataset = data_reader.sort_and_batch_by_token_budget(
+              dataset,
+              data_reader.example_length,
+              hparams.batch_size * shard_multiplier,
+              hparams.sorted_buffer_size,
+              batch_multiple=shard_multiplier if is_training else 1,
+              shuffle=is_training)
+        else:
+          batching_scheme = data_reader.hparams_to_batching_scheme(
+              hparams,
+              shard_multiplier=shard_multiplier,
+              length_multiplier=self.get_hparams().batch_size_multiplier)
+          if hparams.use_fixed_batch_size:
+            # Here  batch_size really means examples per datashard.
+            batching_scheme["batch_sizes"] = [hparams.batch_size]
+            batching_scheme["boundaries"] = []
+          dataset = data_reader.bucket_by_sequence_length(
+              dataset,
+              data_reader.example_length,
+              batching_scheme["boundaries"],
+              batching_scheme["batch_sizes"])
 
         if not is_training:
           def _pad_batch(features):
@@ -720,9 +922,19 @@ class Problem(object):
 
           dataset = dataset.map(_pad_batch, num_parallel_calls=num_threads)
 
+    if input_stats:
+      dataset = input_stats.count(dataset, "batched", batched=True)
     dataset = dataset.map(define_shapes, num_parallel_calls=num_threads)
     dataset = dataset.prefetch(2)
-    features = dataset.make_one_shot_iterator().get_next()
+    iterator = dataset.make_one_shot_iterator()
+    if input_stats:
+      features = input_stats.timed_get_next(iterator)
+      input_stats.add_summaries()
+    else:
+      features = iterator.get_next()
+    record_reader = dataset_kwargs.get("record_reader")
+    if record_reader is not None:
+      features = record_reader.count_consumed(features)
     if not config or not config.use_tpu:
       _summarize_features(features, (config and config.data_parallelism.n) or 1)
 
@@ -899,6 +1111,19 @@ class Text2TextProblem(Problem):
     """
     return None
 
+  @property
+  def packing_window(self):
+    """How many partially packed examples to keep open while packing.
+
+    If set, examples are packed by best fit over this many open examples
+    (see generator_utils.BestFitPacker) instead of by first fit over a small
+    queue.
+
+    Returns:
+      an optional integer
+    """
+    return None
+
   def max_length(self, model_hparams):
     """Maximum sequence length."""
     if self.packed_length:
@@ -944,7 +1169,12 @@ class Text2TextProblem(Problem):
 
   def _maybe_pack_examples(self, generator):
     """Helper to generate_data()."""
-    if self.packed_length:
+    if self.packed_length and self.packing_window:
+      return generator_utils.pack_examples(
+          generator, self.has_inputs, self.packed_length,
+          queue_size=self.packing_window,
+          chop_long_sequences=not self.has_inputs, best_fit=True)
+    elif self.packed_length:
       return generator_utils.pack_examples(
           generator, self.has_inputs, self.packed_length,
           chop_long_sequences=not self.has_inputs)
@@ -1314,6 +1544,11 @@ def _summarize_features(features, num_shards=1):
         tf.summary.scalar("%s_nonpadding_tokens" % k, nonpadding_tokens)
         tf.summary.scalar("%s_nonpadding_fraction" % k,
                           tf.reduce_mean(nonpadding))
+        # Padding included, to compare batching schemes.
+        tf.summary.scalar("%s_tokens_per_batch" % k,
+                          tf.size(v) // num_shards)
+        tf.summary.scalar("%s_padding_fraction" % k,
+                          1.0 - tf.reduce_mean(nonpadding))
 
 
 def standardize_shapes(features, batch_size=None):
@@ -26,8 +26,10 @@ from __future__ import print_function
 
 import collections
 from itertools import chain
+import multiprocessing
 import re
 import tempfile
+import threading
 
 # Dependency imports
 
@@ -75,6 +77,59 @@ else:  # No conversion required on Python >= 3.
     return s
 
 
+# Batches smaller than this many strings per worker are encoded in-process;
+# below it the cost of starting a pool outweighs the parallelism.
+_MIN_BATCH_SIZE_PER_WORKER = 256
+
+# The encoder used by the current worker process of encode_batch/decode_batch.
+_worker_encoder = None
+
+
+def _init_worker_encoder(encoder):
+  """Pool initializer; stores the encoder once per worker process."""
+  global _worker_encoder
+  _worker_encoder = encoder
+
+
+def _encode_chunk(chunk):
+  return [_worker_encoder.encode(s) for s in chunk]
+
+
+def _decode_chunk(chunk):
+  return [_worker_encoder.decode(ids) for ids in chunk]
+
+
+def _map_in_pool(encoder, chunk_fn, items, num_workers):
+  """Applies chunk_fn to contiguous chunks of items in a process pool.
+
+  The encoder is handed to each worker once through the pool initializer
+  (inherited without pickling when the platform forks), so only the inputs
+  and results of each chunk cross process boundaries.
+
+  Args:
+    encoder: the TextEncoder the workers should use.
+    chunk_fn: _encode_chunk or _decode_chunk.
+    items: a list of inputs.
+    num_workers: number of worker processes.
+
+  Returns:
+    A list with one output per element of items, in order.
+  """
+  # A few chunks per worker keeps the pool balanced when lengths vary.
+  num_chunks = num_workers * 4
+  chunk_size = max(1, (len(items) + num_chunks - 1) // num_chunks)
+  chunks = [items[i:i + chunk_size] for i in xrange(0, len(items), chunk_size)]
+  pool = multiprocessing.Pool(processes=num_workers,
+                              initializer=_init_worker_encoder,
+                              initargs=(encoder,))
+  try:
+    results = pool.map(chunk_fn, chunks)
+  finally:
+    pool.close()
+    pool.join()
+  return [output for chunk_result in results for output in chunk_result]
+
+
 class TextEncoder(object):
   """Base class for converting from ints to/from human readable strings."""
 
@@ -101,6 +156,39 @@ class TextEncoder(object):
     """
     return [int(w) + self._num_reserved_ids for w in s.split()]
 
+  def encode_batch(self, strings, num_workers=1):
+    """Encode a list of strings, optionally fanning out to worker processes.
+
+    Args:
+      strings: list of human-readable strings.
+      num_workers: number of processes to split the batch across. Batches
+        too small to benefit are encoded in the calling process.
+
+    Returns:
+      list of lists of integers, one per input string.
+    """
+    strings = list(strings)
+    if num_workers <= 1 or (
+        len(strings) < num_workers * _MIN_BATCH_SIZE_PER_WORKER):
+      return [self.encode(s) for s in strings]
+    return _map_in_pool(self, _encode_chunk, strings, num_workers)
+
+  def decode_batch(self, ids_list, num_workers=1):
+    """Decode a list of id sequences, optionally across worker processes.
+
+    Args:
+      ids_list: list of lists of integers.
+      num_workers: number of processes to split the batch across.
+
+    Returns:
+      list of human-readable strings, one per input sequence.
+    """
+    ids_list = list(ids_list)
+    if num_workers <= 1 or (
+        len(ids_list) < num_workers * _MIN_BATCH_SIZE_PER_WORKER):
+      return [self.decode(ids) for ids in ids_list]
+    return _map_in_pool(self, _decode_chunk, ids_list, num_workers)
+
   def decode(self, ids):
     """Transform a sequence of int ids into a human-readable string.
 
@@ -380,6 +468,199 @@ def _unescape_token(escaped_token):
   return _UNESCAPE_REGEX.sub(match, trimmed)
 
 
+class _SubtokenTrie(object):
+  """Prefix trie over a subtoken vocabulary for greedy longest-match lookup.
+
+  Each node is a dict from a character to the child node; a node that ends a
+  subtoken additionally maps the key None to that subtoken's id. Segmenting
+  an escaped token walks the trie once per emitted subtoken instead of
+  slicing and hashing every candidate substring.
+  """
+
+  def __init__(self, subtoken_string_to_id):
+    self._root = {}
+    for subtoken_string, subtoken_id in six.iteritems(subtoken_string_to_id):
+      node = self._root
+      for c in subtoken_string:
+        node = node.setdefault(c, {})
+      node[None] = subtoken_id
+
+  def segment(self, text):
+    """Greedily segments text into the longest matching subtokens.
+
+    Args:
+      text: a unicode string.
+    Returns:
+      A pair of lists (ends, ids): the end offset in text and the id of each
+      subtoken, in order.
+    """
+    root = self._root
+    ends = []
+    ids = []
+    start = 0
+    text_len = len(text)
+    while start < text_len:
+      node = root
+      match_end, match_id = start, None
+      for pos in xrange(start, text_len):
+        node = node.get(text[pos])
+        if node is None:
+          break
+        subtoken_id = node.get(None)
+        if subtoken_id is not None:
+          match_end, match_id = pos + 1, subtoken_id
+      # If there is no possible encoding of the escaped token then one of the
+      # characters in the token is not in the alphabet. This should be
+      # impossible and would be indicative of a bug.
+      assert match_id is not None, (
+          "Token substring not found in subtoken vocabulary.")
+      ends.append(match_end)
+      ids.append(match_id)
+      start = match_end
+    return ends, ids
+
+
+class _TokenCache(object):
+  """Least-recently-used cache from tokens to subtoken ids, with statistics.
+
+  Thread-safe, so one encoder can be shared by several input threads.
+  """
+
+  def __init__(self, capacity):
+    self._capacity = capacity
+    self._entries = collections.OrderedDict()
+    self._lock = threading.Lock()
+    self.hits = 0
+    self.misses = 0
+    self.evictions = 0
+
+  def __getstate__(self):
+    # Locks cannot be pickled, e.g. when an encoder is sent to a pool worker.
+    state = self.__dict__.copy()
+    del state["_lock"]
+    return state
+
+  def __setstate__(self, state):
+    self.__dict__.update(state)
+    self._lock = threading.Lock()
+
+  def get(self, token):
+    """Returns the cached value for token, or None on a miss."""
+    with self._lock:
+      value = self._entries.pop(token, None)
+      if value is None:
+        self.misses += 1
+        return None
+      # Reinsert to mark the entry as most recently used.
+      self._entries[token] = value
+      self.hits += 1
+      return value
+
+  def put(self, token, value):
+    """Caches value for token, evicting the least recently used entry."""
+    if self._capacity <= 0:
+      return
+    with self._lock:
+      if token in self._entries:
+        del self._entries[token]
+      elif len(self._entries) >= self._capacity:
+        self._entries.popitem(last=False)
+        self.evictions += 1
+      self._entries[token] = value
+
+  def stats(self):
+    with self._lock:
+      lookups = self.hits + self.misses
+      return {
+          "hits": self.hits,
+          "misses": self.misses,
+          "evictions": self.evictions,
+          "size": len(self._entries),
+          "capacity": self._capacity,
+          "hit_rate": float(self.hits) / lookups if lookups else 0.0,
+      }
+
+
+class _SubtokenCandidates(object):
+  """Counts of candidate subtokens over a fixed set of escaped tokens.
+
+  A candidate is a substring of an escaped token that starts at a boundary of
+  the token's current segmentation into subtokens. The escaped tokens and
+  their boundaries are kept between vocabulary refinement iterations, so
+  resegmenting with a new vocabulary only updates the counts of the tokens
+  whose boundaries moved. The counts for the initial vocabulary (alphabet and
+  reserved tokens) are kept as well and restored by reset(), so they are
+  computed once per build_to_target_size rather than once per bisection step.
+  """
+
+  def __init__(self, token_counts, alphabet, trie, max_subtoken_length):
+    """Escapes all tokens and counts candidates under the initial vocabulary.
+
+    Args:
+      token_counts: a dictionary of Unicode strings to int.
+      alphabet: the alphabet used to escape tokens.
+      trie: the _SubtokenTrie of the initial vocabulary.
+      max_subtoken_length: Maximum length of a subtoken, or None.
+    """
+    self._max_subtoken_length = max_subtoken_length
+    self._escaped_tokens = []
+    self._token_counts = []
+    self._starts = []
+    self.counts = collections.defaultdict(int)
+    for token, count in six.iteritems(token_counts):
+      escaped_token = _escape_token(token, alphabet)
+      starts = self._segment_starts(trie, escaped_token)
+      self._escaped_tokens.append(escaped_token)
+      self._token_counts.append(count)
+      self._starts.append(starts)
+      self._update(escaped_token, starts, count)
+    self._initial_starts = list(self._starts)
+    self._initial_counts = dict(self.counts)
+    self._is_initial = True
+
+  @staticmethod
+  def _segment_starts(trie, escaped_token):
+    ends, _ = trie.segment(escaped_token)
+    return tuple([0] + ends[:-1])
+
+  def _update(self, escaped_token, starts, delta):
+    """Adds delta to the counts of all candidates starting at starts."""
+    counts = self.counts
+    token_len = len(escaped_token)
+    for start in starts:
+      last_position = token_len + 1
+      if self._max_subtoken_length is not None:
+        last_position = min(last_position, start + self._max_subtoken_length)
+      for end in xrange(start + 1, last_position):
+        counts[escaped_token[start:end]] += delta
+
+  def reset(self):
+    """Restores the counts for the initial vocabulary."""
+    if not self._is_initial:
+      self._starts = list(self._initial_starts)
+      self.counts = collections.defaultdict(int, self._initial_counts)
+      self._is_initial = True
+
+  def resegment(self, trie):
+    """Updates the counts for the segmentation given by a new vocabulary.
+
+    Args:
+      trie: the _SubtokenTrie of the new vocabulary.
+    """
+    self._is_initial = False
+    for i, escaped_token in enumerate(self._escaped_tokens):
+      old_starts = self._starts[i]
+      new_starts = self._segment_starts(trie, escaped_token)
+      if new_starts == old_starts:
+        continue
+      old_set = set(old_starts)
+      new_set = set(new_starts)
+      count = self._token_counts[i]
+      self._update(escaped_token, old_set - new_set, -count)
+      self._update(escaped_token, new_set - old_set, count)
+      self._starts[i] = new_starts
+
+
 class SubwordTextEncoder(TextEncoder):
   """Class for invertibly encoding text using a limited vocabulary.
 
@@ -413,14 +694,18 @@ class SubwordTextEncoder(TextEncoder):
 
   """
 
-  def __init__(self, filename=None):
+  def __init__(self, filename=None, cache_size=2**20):
     """Initialize and read from a file, if provided.
 
     Args:
       filename: filename from which to read vocab. If None, do not load a
         vocab
+      cache_size: maximum number of tokens whose subtoken ids are cached;
+        the least recently used token is evicted first. 0 disables caching.
     """
     self._alphabet = set()
+    self._cache_size = cache_size
+    self._cache = _TokenCache(cache_size)
     if filename is not None:
       self._load_from_file(filename)
     super(SubwordTextEncoder, self).__init__(num_reserved_ids=None)
@@ -493,15 +778,38 @@ class SubwordTextEncoder(TextEncoder):
     Returns:
       a list of integers in the range [0, vocab_size)
     """
-    cache_location = hash(token) % self._cache_size
-    cache_key, cache_value = self._cache[cache_location]
-    if cache_key == token:
-      return cache_value
+    ret = self._cache.get(token)
+    if ret is not None:
+      return ret
     ret = self._escaped_token_to_subtoken_ids(
         _escape_token(token, self._alphabet))
-    self._cache[cache_location] = (token, ret)
+    self._cache.put(token, ret)
     return ret
 
+  def warm_up_cache(self, token_counts, num_tokens):
+    """Pre-populates the token cache with the most frequent tokens.
+
+    Warm-up lookups are not counted in cache_stats().
+
+    Args:
+      token_counts: a dictionary of token counts, mapping string to int, e.g.
+        from tokenizer.corpus_token_counts.
+      num_tokens: how many of the most frequent tokens to cache. Capped at the
+        cache size.
+    """
+    num_tokens = min(num_tokens, self._cache_size)
+    most_frequent = sorted(six.iteritems(token_counts),
+                           key=lambda kv: kv[1], reverse=True)[:num_tokens]
+    # Insert the least frequent first so the most frequent are evicted last.
+    for token, _ in reversed(most_frequent):
+      token = native_to_unicode(token)
+      self._cache.put(token, self._escaped_token_to_subtoken_ids(
+          _escape_token(token, self._alphabet)))
+
+  def cache_stats(self):
+    """Returns a dict of token cache hits, misses, evictions and size."""
+    return self._cache.stats()
+
   def _subtoken_ids_to_tokens(self, subtokens):
     """Converts a list of subtoken ids to a list of tokens.
 
@@ -539,22 +847,10 @@ class SubwordTextEncoder(TextEncoder):
     # list of subtokens.
     ret = []
     start = 0
-    token_len = len(escaped_token)
-    while start < token_len:
-      for end in xrange(
-          min(token_len, start + self._max_subtoken_len), start, -1):
-        subtoken = escaped_token[start:end]
-        if subtoken in self._subtoken_string_to_id:
-          ret.append(subtoken)
-          start = end
-          break
-
-      else:  # Did not break
-        # If there is no possible encoding of the escaped token then one of the
-        # characters in the token is not in the alphabet. This should be
-        # impossible and would be indicative of a bug.
-        assert False, "Token substring not found in subtoken vocabulary."
-
+    ends, _ = self._subtoken_trie.segment(escaped_token)
+    for end in ends:
+      ret.append(escaped_token[start:end])
+      start = end
     return ret
 
   def _escaped_token_to_subtoken_ids(self, escaped_token):
@@ -565,10 +861,8 @@ class SubwordTextEncoder(TextEncoder):
     Returns:
       A list of subtoken IDs as integers.
     """
-    return [
-        self._subtoken_string_to_id[subtoken]
-        for subtoken in self._escaped_token_to_subtoken_strings(escaped_token)
-    ]
+    _, ids = self._subtoken_trie.segment(escaped_token)
+    return ids
 
   @classmethod
   def build_to_target_size(cls,
@@ -613,15 +907,23 @@ class SubwordTextEncoder(TextEncoder):
     if reserved_tokens is None:
       reserved_tokens = RESERVED_TOKENS
 
+    # The escaped tokens and the initial candidate counts do not depend on the
+    # minimum count, so all bisection steps share them.
+    shared_candidates = []
+
     def bisect(min_val, max_val):
       """Bisection to find the right size."""
       present_count = (max_val + min_val) // 2
       tf.logging.info("Trying min_count %d" % present_count)
       subtokenizer = cls()
-      subtokenizer.build_from_token_counts(
-          token_counts, present_count, num_iterations,
-          max_subtoken_length=max_subtoken_length,
-          reserved_tokens=reserved_tokens)
+      subtokenizer._init_build(token_counts, reserved_tokens)  # pylint: disable=protected-access
+      if not shared_candidates:
+        shared_candidates.append(_SubtokenCandidates(
+            token_counts, subtokenizer._alphabet,  # pylint: disable=protected-access
+            subtokenizer._subtoken_trie, max_subtoken_length))  # pylint: disable=protected-access
+      subtokenizer._build_from_candidates(  # pylint: disable=protected-access
+          shared_candidates[0], present_count, num_iterations,
+          reserved_tokens)
 
       # Being within 1% of the target size is ok.
       is_ok = abs(subtokenizer.vocab_size - target_size) * 100 < target_size
@@ -669,6 +971,25 @@ class SubwordTextEncoder(TextEncoder):
         is not clear what the space is being reserved for, or when it will be
         filled in.
     """
+    reserved_tokens = self._init_build(token_counts, reserved_tokens)
+    candidates = _SubtokenCandidates(token_counts, self._alphabet,
+                                     self._subtoken_trie, max_subtoken_length)
+    self._build_from_candidates(candidates, min_count, num_iterations,
+                                reserved_tokens)
+
+  def _init_build(self, token_counts, reserved_tokens):
+    """Initializes the alphabet and the initial vocabulary for building.
+
+    Args:
+      token_counts: a dictionary of Unicode strings to int.
+      reserved_tokens: List of reserved tokens, or None for `RESERVED_TOKENS`.
+
+    Returns:
+      The reserved tokens to use.
+
+    Raises:
+      ValueError: if `RESERVED_TOKENS` is not a prefix of `reserved_tokens`.
+    """
     if reserved_tokens is None:
       reserved_tokens = RESERVED_TOKENS
     else:
@@ -689,6 +1010,19 @@ class SubwordTextEncoder(TextEncoder):
     # alphabet plus the escaping characters.
     self._init_subtokens_from_list(list(self._alphabet),
                                    reserved_tokens=reserved_tokens)
+    return reserved_tokens
+
+  def _build_from_candidates(self, candidates, min_count, num_iterations,
+                             reserved_tokens):
+    """Refines the vocabulary set up by _init_build.
+
+    Args:
+      candidates: a _SubtokenCandidates over the token counts.
+      min_count: an integer - discard subtokens with lower counts.
+      num_iterations: an integer.  how many iterations of refinement.
+      reserved_tokens: List of reserved tokens.
+    """
+    candidates.reset()
 
     # We build iteratively.  On each iteration, we segment all the words,
     # then count the resulting potential subtokens, keeping the ones
@@ -699,21 +1033,11 @@ class SubwordTextEncoder(TextEncoder):
       tf.logging.info("Iteration {0}".format(i))
 
       # Collect all substrings of the encoded token that break along current
-      # subtoken boundaries.
-      subtoken_counts = collections.defaultdict(int)
-      for token, count in six.iteritems(token_counts):
-        escaped_token = _escape_token(token, self._alphabet)
-        subtokens = self._escaped_token_to_subtoken_strings(escaped_token)
-        start = 0
-        for subtoken in subtokens:
-          last_position = len(escaped_token) + 1
-          if max_subtoken_length is not None:
-            last_position = min(last_position, start + max_subtoken_length)
-
-          for end in xrange(start + 1, last_position):
-            new_subtoken = escaped_token[start:end]
-            subtoken_counts[new_subtoken] += count
-          start += len(subtoken)
+      # subtoken boundaries. The candidates were counted for the initial
+      # vocabulary, so only later iterations need to resegment.
+      if i > 0:
+        candidates.resegment(self._subtoken_trie)
+      subtoken_counts = collections.defaultdict(int, candidates.counts)
 
       # Array of sets of candidate subtoken strings, by length.
       len_to_subtoken_strings = []
@@ -792,9 +1116,9 @@ class SubwordTextEncoder(TextEncoder):
         s: i + len(reserved_tokens)
         for i, s in enumerate(subtoken_strings) if s
     }
+    self._subtoken_trie = _SubtokenTrie(self._subtoken_string_to_id)
     # Initialize the cache to empty.
-    self._cache_size = 2 ** 20
-    self._cache = [(None, None)] * self._cache_size
+    self._cache = _TokenCache(self._cache_size)
 
   def _init_alphabet_from_tokens(self, tokens):
     """Initialize alphabet from an iterable of token or subtoken strings."""
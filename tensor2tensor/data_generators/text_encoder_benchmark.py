@@ -0,0 +1,142 @@
+# coding=utf-8
+# Copyright 2017 The Tensor2Tensor Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+r"""Benchmark for SubwordTextEncoder subtoken segmentation.
+
+Compares the trie-based longest-match segmentation used by SubwordTextEncoder
+against the original substring-slicing search, checks that both produce the
+same subtokens, and reports tokens per second for each.
+
+Example usage:
+
+python data_generators/text_encoder_benchmark.py \
+    --vocab_filename=tensor2tensor/test_data/vocab.ende.8192 \
+    --corpus_filepattern=$DATA_DIR/newstest2014.en \
+    --logtostderr
+
+If --corpus_filepattern is not given, a synthetic corpus is sampled from the
+vocabulary itself.
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import os
+import random
+import time
+
+# Dependency imports
+
+from six.moves import xrange  # pylint: disable=redefined-builtin
+from tensor2tensor.data_generators import text_encoder
+from tensor2tensor.data_generators import tokenizer
+
+import tensorflow as tf
+
+_DEFAULT_VOCAB = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+    "test_data", "vocab.ende.8192")
+
+tf.flags.DEFINE_string("vocab_filename", _DEFAULT_VOCAB,
+                       "SubwordTextEncoder vocabulary to benchmark.")
+tf.flags.DEFINE_string("corpus_filepattern", "",
+                       "Text to segment; synthesized from the vocab if empty.")
+tf.flags.DEFINE_integer("corpus_max_lines", 10000,
+                        "How many lines of corpus to read.")
+tf.flags.DEFINE_integer("num_synthetic_tokens", 200000,
+                        "Size of the synthetic corpus, in tokens.")
+tf.flags.DEFINE_integer("num_repeats", 3, "Timed passes per segmenter.")
+FLAGS = tf.flags.FLAGS
+
+
+def slice_segmentation(encoder, escaped_token):
+  """The original longest-match search, slicing every candidate substring."""
+  ret = []
+  start = 0
+  token_len = len(escaped_token)
+  while start < token_len:
+    for end in xrange(
+        min(token_len, start + encoder._max_subtoken_len), start, -1):  # pylint: disable=protected-access
+      subtoken = escaped_token[start:end]
+      if subtoken in encoder._subtoken_string_to_id:  # pylint: disable=protected-access
+        ret.append(encoder._subtoken_string_to_id[subtoken])  # pylint: disable=protected-access
+        start = end
+        break
+    else:  # Did not break
+      assert False, "Token substring not found in subtoken vocabulary."
+  return ret
+
+
+def trie_segmentation(encoder, escaped_token):
+  return encoder._escaped_token_to_subtoken_ids(escaped_token)  # pylint: disable=protected-access
+
+
+def synthetic_tokens(encoder, num_tokens, seed=0):
+  """Samples tokens by gluing together random subtokens of the vocabulary."""
+  rng = random.Random(seed)
+  pieces = [s for s in encoder.all_subtoken_strings
+            if s and s not in text_encoder.RESERVED_TOKENS]
+  words = [s for s in pieces if s.endswith("_")]
+  tokens = []
+  for _ in xrange(num_tokens):
+    prefix = "".join(rng.choice(pieces).rstrip("_")
+                     for _ in xrange(rng.randint(0, 2)))
+    tokens.append(text_encoder._unescape_token(prefix + rng.choice(words)))  # pylint: disable=protected-access
+  return tokens
+
+
+def corpus_tokens(filepattern, max_lines):
+  tokens = []
+  for line in tokenizer._read_filepattern(filepattern, max_lines=max_lines):  # pylint: disable=protected-access
+    tokens.extend(tokenizer.encode(text_encoder.native_to_unicode(line)))
+  return tokens
+
+
+def time_segmenter(segment_fn, encoder, escaped_tokens, num_repeats):
+  """Returns the best tokens/sec over num_repeats passes and the output."""
+  best = None
+  for _ in xrange(num_repeats):
+    start = time.time()
+    output = [segment_fn(encoder, t) for t in escaped_tokens]
+    elapsed = time.time() - start
+    best = elapsed if best is None else min(best, elapsed)
+  return len(escaped_tokens) / max(best, 1e-9), output
+
+
+def main(unused_argv):
+  encoder = text_encoder.SubwordTextEncoder(FLAGS.vocab_filename)
+  if FLAGS.corpus_filepattern:
+    tokens = corpus_tokens(FLAGS.corpus_filepattern, FLAGS.corpus_max_lines)
+  else:
+    tokens = synthetic_tokens(encoder, FLAGS.num_synthetic_tokens)
+  escaped_tokens = [
+      text_encoder._escape_token(t, encoder._alphabet) for t in tokens]  # pylint: disable=protected-access
+  tf.logging.info("Segmenting %d tokens with a %d subtoken vocab.",
+                  len(escaped_tokens), encoder.vocab_size)
+
+  slice_rate, slice_output = time_segmenter(
+      slice_segmentation, encoder, escaped_tokens, FLAGS.num_repeats)
+  trie_rate, trie_output = time_segmenter(
+      trie_segmentation, encoder, escaped_tokens, FLAGS.num_repeats)
+  if slice_output != trie_output:
+    raise ValueError("Trie segmentation differs from slice segmentation.")
+
+  tf.logging.info("slice: %.0f tokens/sec", slice_rate)
+  tf.logging.info("trie:  %.0f tokens/sec (%.2fx)",
+                  trie_rate, trie_rate / slice_rate)
+
+
+if __name__ == "__main__":
+  tf.app.run()
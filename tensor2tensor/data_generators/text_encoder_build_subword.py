@@ -50,6 +50,12 @@ tf.flags.DEFINE_integer('corpus_max_lines', 10000,
                         'How many lines of corpus to read')
 tf.flags.DEFINE_integer('num_iterations', 4, 'Number of iterations')
 tf.flags.DEFINE_bool('split_on_newlines', True, 'Break corpus into lines.')
+tf.flags.DEFINE_integer('num_workers', 1,
+                        'Number of processes used to count corpus tokens. '
+                        'Only used when --corpus_max_lines is 0.')
+tf.flags.DEFINE_string('token_counts_filename', '',
+                       'If set, token counts are read from this file when it '
+                       'exists and written to it otherwise.')
 FLAGS = tf.flags.FLAGS
 
 
@@ -58,11 +64,18 @@ def main(unused_argv):
     raise ValueError(
         'Must only provide one of --corpus_filepattern or --vocab_filepattern')
 
+  elif (FLAGS.token_counts_filename and
+        tf.gfile.Exists(FLAGS.token_counts_filename)):
+    token_counts = tokenizer.load_token_counts(FLAGS.token_counts_filename)
+
   elif FLAGS.corpus_filepattern:
     token_counts = tokenizer.corpus_token_counts(
         FLAGS.corpus_filepattern,
         FLAGS.corpus_max_lines,
-        split_on_newlines=FLAGS.split_on_newlines)
+        split_on_newlines=FLAGS.split_on_newlines,
+        num_workers=FLAGS.num_workers)
+    if FLAGS.token_counts_filename:
+      tokenizer.store_token_counts(token_counts, FLAGS.token_counts_filename)
 
   elif FLAGS.vocab_filepattern:
     token_counts = tokenizer.vocab_token_counts(FLAGS.vocab_filepattern,
@@ -107,6 +107,17 @@ class TokenTextEncoderTest(tf.test.TestCase):
     # be unique.
     self.assertEqual(len(all_tokens), len(set(all_tokens)))
 
+  def test_encode_decode_batch(self):
+    corpus = "A B C D E F G H I J K L M N O P Q R S T U V W X Y Z"
+    encoder = text_encoder.TokenTextEncoder(None, vocab_list=corpus.split())
+    random.seed(0)
+    sentences = [" ".join(random.sample(corpus.split(), 5))
+                 for _ in xrange(1000)]
+
+    encoded = encoder.encode_batch(sentences, num_workers=2)
+    self.assertEqual([encoder.encode(s) for s in sentences], encoded)
+    self.assertEqual(sentences, encoder.decode_batch(encoded, num_workers=2))
+
 
 class SubwordTextEncoderTest(tf.test.TestCase):
 
@@ -151,6 +162,63 @@ class SubwordTextEncoderTest(tf.test.TestCase):
     for a in alphabet:
       self.assertIn(a, encoder.all_subtoken_strings)
 
+  def test_encode_decode_batch(self):
+    corpus = "the quick brown fox jumps over the lazy dog"
+    token_counts = collections.Counter(corpus.split(" "))
+    encoder = text_encoder.SubwordTextEncoder.build_to_target_size(
+        100, token_counts, 2, 10)
+    random.seed(0)
+    sentences = [" ".join(random.sample(corpus.split(" "), 4)) + "!"
+                 for _ in xrange(1000)]
+
+    encoded = encoder.encode_batch(sentences, num_workers=2)
+    self.assertEqual([encoder.encode(s) for s in sentences], encoded)
+    self.assertEqual(sentences, encoder.decode_batch(encoded, num_workers=2))
+
+  def test_token_cache(self):
+    corpus = "the quick brown fox jumps over the lazy dog"
+    token_counts = collections.Counter(corpus.split(" "))
+    encoder = text_encoder.SubwordTextEncoder.build_to_target_size(
+        100, token_counts, 2, 10)
+    filename = os.path.join(self.test_temp_dir, "cache.voc")
+    encoder.store_to_file(filename)
+    encoder = text_encoder.SubwordTextEncoder(filename, cache_size=2)
+
+    encoder.warm_up_cache(token_counts, 1)
+    self.assertEqual(0, encoder.cache_stats()["misses"])
+    ids = encoder.encode("the")
+    self.assertEqual(1, encoder.cache_stats()["hits"])
+
+    # "fox" evicts nothing, "dog" evicts the least recently used "the".
+    encoder.encode("fox")
+    encoder.encode("dog")
+    self.assertEqual(ids, encoder.encode("the"))
+    stats = encoder.cache_stats()
+    self.assertEqual(1, stats["hits"])
+    self.assertEqual(3, stats["misses"])
+    self.assertEqual(2, stats["evictions"])
+    self.assertEqual(2, stats["size"])
+
+  def test_shared_candidates_match_fresh_build(self):
+    corpus = ("the quick brown fox jumps over the lazy dog and the quicker "
+              "browner foxes jumped over the lazier dogs")
+    token_counts = collections.Counter(corpus.split(" "))
+    reserved_tokens = text_encoder.RESERVED_TOKENS
+
+    shared = text_encoder.SubwordTextEncoder()
+    shared._init_build(token_counts, reserved_tokens)
+    candidates = text_encoder._SubtokenCandidates(
+        token_counts, shared._alphabet, shared._subtoken_trie, None)
+    shared._build_from_candidates(candidates, 1, 4, reserved_tokens)
+    # Reusing the candidates for another minimum count starts from scratch.
+    shared = text_encoder.SubwordTextEncoder()
+    shared._init_build(token_counts, reserved_tokens)
+    shared._build_from_candidates(candidates, 2, 4, reserved_tokens)
+
+    fresh = text_encoder.SubwordTextEncoder()
+    fresh.build_from_token_counts(token_counts, 2)
+    self.assertEqual(fresh.all_subtoken_strings, shared.all_subtoken_strings)
+
   def test_unicode(self):
     corpus = "Cat emoticons. \U0001F638 \U0001F639 \U0001F63A \U0001F63B"
     token_counts = collections.Counter(corpus.split(" "))
@@ -265,6 +333,17 @@ class SubwordTextEncoderTest(tf.test.TestCase):
     with self.assertRaises(AssertionError):
       encoder.encode(original)
 
+  def test_trie_segmentation_is_longest_match(self):
+    encoder = text_encoder.SubwordTextEncoder()
+    encoder._load_from_file_object(io.StringIO("a\nb\nab\nabc\nbcd_\n_\nc\nd\n"))
+
+    self.assertEqual(["abc", "d", "_"],
+                     encoder._escaped_token_to_subtoken_strings("abcd_"))
+    self.assertEqual(["ab", "abc", "d", "_"],
+                     encoder._escaped_token_to_subtoken_strings("ababcd_"))
+    self.assertEqual([2, 3, 7, 5],
+                     encoder._escaped_token_to_subtoken_ids("ababcd_"))
+
   def test_load_from_file(self):
     # Test a vocab file with words not wrapped with single quotes
     encoder = text_encoder.SubwordTextEncoder()
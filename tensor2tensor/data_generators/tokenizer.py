@@ -45,6 +45,9 @@ from __future__ import division
 from __future__ import print_function
 
 import collections
+import json
+import multiprocessing
+import re
 import sys
 import unicodedata
 
@@ -58,11 +61,72 @@ import tensorflow as tf
 _native_to_unicode = (lambda s: s.decode("utf-8")) if six.PY2 else (lambda s: s)
 
 
-# This set contains all letter and number characters.
-_ALPHANUMERIC_CHAR_SET = set(
-    six.unichr(i) for i in xrange(sys.maxunicode)
-    if (unicodedata.category(six.unichr(i)).startswith("L") or
-        unicodedata.category(six.unichr(i)).startswith("N")))
+# Letter and number characters, i.e. those whose Unicode category starts with
+# "L" or "N", as sorted inclusive (first, last) code point ranges. Built on
+# first use by _alphanumeric_ranges() so that importing this module does not
+# scan the whole code space.
+_ALPHANUMERIC_RANGES = None
+
+# Lookup table indexed by code point, nonzero for alphanumeric characters.
+_ALPHANUMERIC_TABLE = None
+
+# Matches a maximal run of alphanumeric or of non-alphanumeric characters.
+_TOKEN_REGEX = None
+
+
+def _alphanumeric_ranges():
+  """Returns the alphanumeric code points as inclusive (first, last) ranges."""
+  global _ALPHANUMERIC_RANGES
+  if _ALPHANUMERIC_RANGES is None:
+    ranges = []
+    first = None
+    for i in xrange(sys.maxunicode):
+      category = unicodedata.category(six.unichr(i))
+      if category.startswith("L") or category.startswith("N"):
+        if first is None:
+          first = i
+      elif first is not None:
+        ranges.append((first, i - 1))
+        first = None
+    if first is not None:
+      ranges.append((first, sys.maxunicode - 1))
+    _ALPHANUMERIC_RANGES = ranges
+  return _ALPHANUMERIC_RANGES
+
+
+def _alphanumeric_table():
+  """Returns a bytearray indexed by code point, nonzero for alphanumerics."""
+  global _ALPHANUMERIC_TABLE
+  if _ALPHANUMERIC_TABLE is None:
+    table = bytearray(sys.maxunicode + 1)
+    for first, last in _alphanumeric_ranges():
+      table[first:last + 1] = b"\x01" * (last - first + 1)
+    _ALPHANUMERIC_TABLE = table
+  return _ALPHANUMERIC_TABLE
+
+
+def _token_regex():
+  """Returns a regex matching runs of alphanumeric or other characters."""
+  global _TOKEN_REGEX
+  if _TOKEN_REGEX is None:
+    ranges = _alphanumeric_ranges()
+    # Where the regex engine's notion of a word character minus "_" agrees
+    # with the Unicode categories, a small pattern matches much faster than a
+    # character class with hundreds of ranges. Check this on every code point.
+    word_regex = re.compile(r"[^\W_]+|[\W_]+", re.UNICODE)
+    all_chars = u"".join(six.unichr(i) for i in xrange(sys.maxunicode))
+    word_ranges = [(m.start(), m.end() - 1) for m in
+                   re.finditer(r"[^\W_]+", all_chars, re.UNICODE)]
+    if word_ranges == ranges:
+      _TOKEN_REGEX = word_regex
+    else:
+      # Range endpoints are letters or numbers, so none need escaping.
+      char_class = u"".join(
+          six.unichr(first) if first == last else
+          u"%s-%s" % (six.unichr(first), six.unichr(last))
+          for first, last in ranges)
+      _TOKEN_REGEX = re.compile(u"[%s]+|[^%s]+" % (char_class, char_class))
+  return _TOKEN_REGEX
 
 
 def encode(text):
@@ -75,19 +139,12 @@ def encode(text):
   """
   if not text:
     return []
-  ret = []
-  token_start = 0
-  # Classify each character in the input string
-  is_alnum = [c in _ALPHANUMERIC_CHAR_SET for c in text]
-  for pos in xrange(1, len(text)):
-    if is_alnum[pos] != is_alnum[pos - 1]:
-      token = text[token_start:pos]
-      if token != u" " or token_start == 0:
-        ret.append(token)
-      token_start = pos
-  final_token = text[token_start:]
-  ret.append(final_token)
-  return ret
+  # Runs of alphanumeric and non-alphanumeric characters alternate. A single
+  # space between two tokens is implied, unless it starts or ends the text.
+  tokens = _token_regex().findall(text)
+  last = len(tokens) - 1
+  return [token for i, token in enumerate(tokens)
+          if token != u" " or i == 0 or i == last]
 
 
 def decode(tokens):
@@ -98,7 +155,8 @@ def decode(tokens):
   Returns:
     a unicode string
   """
-  token_is_alnum = [t[0] in _ALPHANUMERIC_CHAR_SET for t in tokens]
+  table = _alphanumeric_table()
+  token_is_alnum = [table[ord(t[0])] for t in tokens]
   ret = []
   for i, token in enumerate(tokens):
     if i > 0 and token_is_alnum[i - 1] and token_is_alnum[i]:
@@ -147,20 +205,114 @@ def _read_filepattern(filepattern, max_lines=None, split_on_newlines=True):
           yield f.read()
 
 
-def corpus_token_counts(
-    text_filepattern, corpus_max_lines, split_on_newlines=True):
+def _read_lines_in_byte_range(filename, start, end):
+  """Yields the stripped lines of a file that begin in bytes [start, end).
+
+  Every line of the file belongs to exactly one of a set of adjacent ranges, so
+  a file can be split into byte ranges that are read independently.
+
+  Args:
+    filename: path to a UTF-8 text file.
+    start: an integer; first byte offset of the range.
+    end: an integer; the range excludes lines starting at or after this offset.
+
+  Yields:
+    The lines as unicode strings, with leading and trailing whitespace removed.
+  """
+  with tf.gfile.Open(filename, "rb") as f:
+    if start > 0:
+      # The line straddling `start` (if any) belongs to the previous range.
+      f.seek(start - 1)
+      f.readline()
+    while f.tell() < end:
+      line = f.readline()
+      if not line:
+        return
+      yield line.decode("utf-8").strip()
+
+
+def _corpus_shards(filenames, split_on_newlines, shard_bytes):
+  """Splits files into (filename, start, end, split_on_newlines) shards."""
+  shards = []
+  for filename in filenames:
+    if not split_on_newlines:
+      # Each file is a single document and cannot be split.
+      shards.append((filename, 0, None, False))
+      continue
+    size = tf.gfile.Stat(filename).length
+    for start in xrange(0, max(size, 1), shard_bytes):
+      shards.append((filename, start, min(start + shard_bytes, size), True))
+  return shards
+
+
+def _count_tokens_in_shard(shard):
+  """Pool worker for corpus_token_counts; returns a Counter of one shard."""
+  filename, start, end, split_on_newlines = shard
+  counts = collections.Counter()
+  if split_on_newlines:
+    for line in _read_lines_in_byte_range(filename, start, end):
+      counts.update(encode(line))
+  else:
+    with tf.gfile.Open(filename) as f:
+      counts.update(encode(_native_to_unicode(f.read())))
+  return counts
+
+
+def _count_tokens_in_docs(docs):
+  """Pool worker for generator_token_counts; returns a Counter of docs."""
+  counts = collections.Counter()
+  for doc in docs:
+    counts.update(encode(_native_to_unicode(doc)))
+  return counts
+
+
+def _merge_counts_in_pool(count_fn, work_items, num_workers):
+  """Maps count_fn over work_items in a process pool and sums the Counters."""
+  counts = collections.Counter()
+  pool = multiprocessing.Pool(processes=num_workers)
+  try:
+    for partial_counts in pool.imap_unordered(count_fn, work_items):
+      counts.update(partial_counts)
+  finally:
+    pool.close()
+    pool.join()
+  return counts
+
+
+def corpus_token_counts(text_filepattern,
+                        corpus_max_lines,
+                        split_on_newlines=True,
+                        num_workers=1,
+                        shard_bytes=64 * 1024 * 1024):
   """Read the corpus and compute a dictionary of token counts.
 
+  With num_workers > 1 the files are split into byte ranges of about
+  shard_bytes (whole files if not split_on_newlines) that are tokenized in a
+  process pool, and the partial counts are merged.
+
   Args:
     text_filepattern: A pattern matching one or more files.
     corpus_max_lines: An integer; maximum total lines to read.
     split_on_newlines: A boolean. If true, then split files by lines and strip
         leading and trailing whitespace from each line. Otherwise, treat each
         file as a single string.
+    num_workers: An integer; number of processes to count with.
+    shard_bytes: An integer; approximate size of the shards counted in
+        parallel.
 
   Returns:
     a dictionary mapping token to count.
   """
+  if num_workers > 1 and corpus_max_lines:
+    # Which lines fall under the limit depends on every preceding shard.
+    tf.logging.warning("corpus_max_lines is set; counting tokens serially.")
+  elif num_workers > 1:
+    shards = _corpus_shards(sorted(tf.gfile.Glob(text_filepattern)),
+                            split_on_newlines, shard_bytes)
+    tf.logging.info("Counting tokens in %d shards with %d workers.",
+                    len(shards), num_workers)
+    return _merge_counts_in_pool(_count_tokens_in_shard, shards, num_workers)
+
   counts = collections.Counter()
   for doc in _read_filepattern(
       text_filepattern,
@@ -171,6 +323,63 @@ def corpus_token_counts(
   return counts
 
 
+def generator_token_counts(generator, num_workers=1, chunk_size=10000):
+  """Compute a dictionary of token counts over the strings of a generator.
+
+  With num_workers > 1 the generator is consumed in the calling process and
+  chunks of chunk_size strings are tokenized in a process pool.
+
+  Args:
+    generator: a generator of native strings.
+    num_workers: An integer; number of processes to count with.
+    chunk_size: An integer; number of strings sent to a worker at a time.
+
+  Returns:
+    a dictionary mapping token to count.
+  """
+  if num_workers <= 1:
+    return _count_tokens_in_docs(generator)
+
+  def chunks():
+    chunk = []
+    for doc in generator:
+      chunk.append(doc)
+      if len(chunk) == chunk_size:
+        yield chunk
+        chunk = []
+    if chunk:
+      yield chunk
+
+  return _merge_counts_in_pool(_count_tokens_in_docs, chunks(), num_workers)
+
+
+def store_token_counts(token_counts, filename):
+  """Write a dictionary of token counts to a file.
+
+  Unlike the CSV files read by vocab_token_counts, this format keeps tokens
+  containing commas, newlines or surrounding whitespace intact.
+
+  Args:
+    token_counts: a dictionary mapping token to count.
+    filename: path of the file to write.
+  """
+  with tf.gfile.Open(filename, "w") as f:
+    f.write(json.dumps(dict(token_counts)))
+
+
+def load_token_counts(filename):
+  """Read a dictionary of token counts written by store_token_counts.
+
+  Args:
+    filename: path of the file to read.
+
+  Returns:
+    a dictionary mapping token to count.
+  """
+  with tf.gfile.Open(filename) as f:
+    return collections.Counter(json.loads(f.read()))
+
+
 def vocab_token_counts(text_filepattern, max_lines):
   """Read a vocab file and return a dictionary of token counts.
 
@@ -22,6 +22,7 @@ from __future__ import print_function
 
 import os
 import random
+import unicodedata
 
 # Dependency imports
 
@@ -62,6 +63,22 @@ class TokenizerTest(tf.test.TestCase):
       self.assertEqual(s, tokenizer.decode(tokenizer.encode(s)))
 
 
+  def test_encode_splits_on_unicode_categories(self):
+    def is_alnum(c):
+      return unicodedata.category(c)[0] in ("L", "N")
+
+    for _ in xrange(1000):
+      s = u"".join(six.unichr(random.randint(0, 65535)) for _ in xrange(10))
+      tokens = tokenizer.encode(s)
+      for token in tokens:
+        self.assertEqual(1, len(set(is_alnum(c) for c in token)))
+      for prev, token in zip(tokens, tokens[1:]):
+        if is_alnum(prev[-1]) != is_alnum(token[0]):
+          continue
+        # Adjacent tokens of the same kind had a single space removed.
+        self.assertTrue(is_alnum(token[0]))
+
+
 class TestTokenCounts(tf.test.TestCase):
 
   def setUp(self):
@@ -116,6 +133,33 @@ class TestTokenCounts(tf.test.TestCase):
         u".\n": 1
     }, token_counts)
 
+  def test_corpus_token_counts_parallel(self):
+    for split_on_newlines in (True, False):
+      serial = tokenizer.corpus_token_counts(
+          self.corpus_path, corpus_max_lines=0,
+          split_on_newlines=split_on_newlines)
+      # Tiny shards put range boundaries in the middle of most lines.
+      parallel = tokenizer.corpus_token_counts(
+          self.corpus_path, corpus_max_lines=0,
+          split_on_newlines=split_on_newlines, num_workers=2, shard_bytes=7)
+      self.assertDictEqual(dict(serial), dict(parallel))
+
+  def test_generator_token_counts(self):
+    lines = [u"I shot an elephant", u"in my pajamas."] * 10
+    serial = tokenizer.generator_token_counts(iter(lines))
+    parallel = tokenizer.generator_token_counts(
+        iter(lines), num_workers=2, chunk_size=3)
+    self.assertDictEqual(dict(serial), dict(parallel))
+    self.assertEqual(10, parallel[u"elephant"])
+
+  def test_store_and_load_token_counts(self):
+    token_counts = tokenizer.corpus_token_counts(
+        self.corpus_path, corpus_max_lines=0, split_on_newlines=False)
+    filename = os.path.join(tf.test.get_temp_dir(), "corpus.token_counts")
+    tokenizer.store_token_counts(token_counts, filename)
+    self.assertDictEqual(dict(token_counts),
+                         dict(tokenizer.load_token_counts(filename)))
+
   def test_vocab_token_counts(self):
     token_counts = tokenizer.vocab_token_counts(self.vocab_path, 0)
 
@@ -36,6 +36,7 @@ from tensor2tensor.utils import expert_utils
 import tensorflow as tf
 
 from tensorflow.python.framework import function
+from tensorflow.python.ops import inplace_ops
 
 # Struct conatining the sequences ids and order on a batch (are send to the
 # expert to allow them to compute the bias mask)
@@ -2184,6 +2185,31 @@ def masked_local_attention_2d(q,
     return output
 
 
+def compute_attention_component(antecedent,
+                                total_depth,
+                                filter_width=1,
+                                padding="VALID",
+                                name="c"):
+  """Computes attention compoenent (query, key or value).
+
+  Args:
+    antecedent: a Tensor with shape [batch, length, channels]
+    total_depth: an integer
+    filter_width: An integer specifying how wide you want the attention
+      component to be.
+    padding: One of "VALID", "SAME" or "LEFT". Default is VALID: No padding.
+    name: a string specifying scope name.
+
+  Returns:
+    c : [batch, length, depth] tensor
+  """
+  if filter_width == 1:
+    return tf.layers.dense(antecedent, total_depth, use_bias=False, name=name)
+  else:
+    return common_layers.conv1d(
+        antecedent, total_depth, filter_width, padding, name=name)
+
+
 def compute_qkv(query_antecedent,
                 memory_antecedent,
                 total_key_depth,
@@ -2210,20 +2236,88 @@ def compute_qkv(query_antecedent,
   """
   if memory_antecedent is None:
     memory_antecedent = query_antecedent
-  def _compute(inp, depth, filter_width, padding, name):
-    if filter_width == 1:
-      return tf.layers.dense(inp, depth, use_bias=False, name=name)
-    else:
-      return common_layers.conv1d(inp, depth, filter_width, padding, name=name)
-  q = _compute(
+  q = compute_attention_component(
       query_antecedent, total_key_depth, q_filter_width, q_padding, "q")
-  k = _compute(
+  k = compute_attention_component(
       memory_antecedent, total_key_depth, kv_filter_width, kv_padding, "k")
-  v = _compute(
+  v = compute_attention_component(
       memory_antecedent, total_value_depth, kv_filter_width, kv_padding, "v")
   return q, k, v
 
 
+def write_to_decode_cache(cache, x, decode_loop_step):
+  """Writes decoding steps into a preallocated cache, in place.
+
+  The cache is already split into heads, in the layout attention reads, so
+  neither the write nor the attention copies it.
+
+  Args:
+    cache: a Tensor or a Variable with shape [batch, heads, length, depth]. A
+      Tensor must own its buffer, e.g. come from inplace_ops.empty() rather
+      than from tf.zeros(), which may be a constant shared by all runs.
+    x: a Tensor with shape [batch, heads, n, depth], usually with n = 1.
+    decode_loop_step: an integer Tensor, a scalar or of shape [batch], the
+      position to write x[:, :, 0] at in every row or in each row; x[:, :, j]
+      is written at decode_loop_step + j, which must be before length.
+
+  Returns:
+    the cache with x written. A Tensor is updated in its own buffer, which
+    the result aliases; a Variable is updated with a scatter update.
+  """
+  batch, heads, length, depth = common_layers.shape_list(cache)
+  n = common_layers.shape_list(x)[2]
+  # [batch, n] positions to write.
+  positions = (tf.expand_dims(tf.zeros([batch], tf.int32) + decode_loop_step, 1)
+               + tf.expand_dims(tf.range(n), 0))
+  if isinstance(cache, tf.Variable):
+    indices = tf.stack([
+        tf.tile(tf.reshape(tf.range(batch), [batch, 1, 1]), [1, heads, n]),
+        tf.tile(tf.reshape(tf.range(heads), [1, heads, 1]), [batch, 1, n]),
+        tf.tile(tf.expand_dims(positions, 1), [1, heads, 1])], axis=3)
+    return tf.scatter_nd_update(cache, indices, x)
+  # Row r of the [batch * heads * length, depth] view of the cache holds
+  # position r % length of row and head r // length.
+  offsets = tf.reshape(tf.range(batch * heads) * length, [batch, heads, 1])
+  rows = tf.reshape(offsets + tf.expand_dims(positions, 1), [-1])
+  flat_cache = inplace_ops.alias_inplace_update(
+      tf.reshape(cache, [-1, depth]), rows, tf.reshape(x, [-1, depth]))
+  return tf.reshape(flat_cache, [batch, heads, length, depth])
+
+
+def fold_rows_into_queries(q, num_memory_rows):
+  """Folds query rows that share a memory row into the query length.
+
+  Args:
+    q: a Tensor with shape [num_memory_rows * n, heads, length_q, depth]
+    num_memory_rows: an integer scalar.
+
+  Returns:
+    a Tensor with shape [num_memory_rows, heads, n * length_q, depth]
+  """
+  shape = common_layers.shape_list(q)
+  n = shape[0] // num_memory_rows
+  q = tf.reshape(q, [num_memory_rows, n] + shape[1:])
+  q = tf.transpose(q, [0, 2, 1, 3, 4])
+  return tf.reshape(q, [num_memory_rows, shape[1], n * shape[2], shape[3]])
+
+
+def unfold_rows_from_queries(x, length_q):
+  """Inverse of fold_rows_into_queries().
+
+  Args:
+    x: a Tensor with shape [num_memory_rows, heads, n * length_q, depth]
+    length_q: an integer scalar.
+
+  Returns:
+    a Tensor with shape [num_memory_rows * n, heads, length_q, depth]
+  """
+  shape = common_layers.shape_list(x)
+  n = shape[2] // length_q
+  x = tf.reshape(x, [shape[0], shape[1], n, length_q, shape[3]])
+  x = tf.transpose(x, [0, 2, 1, 3, 4])
+  return tf.reshape(x, [shape[0] * n, shape[1], length_q, shape[3]])
+
+
 def multihead_attention(query_antecedent,
                         memory_antecedent,
                         bias,
@@ -2246,6 +2340,7 @@ def multihead_attention(query_antecedent,
                         num_memory_blocks=2,
                         name=None,
                         save_weights_to=None,
+                        decode_loop_step=None,
                         **kwargs):
   """Multihead scaled-dot-product attention with input/output transformations.
 
@@ -2281,6 +2376,15 @@ def multihead_attention(query_antecedent,
            should be empty Tensors of the appropriate shape.
                'k' [batch_size, 0, key_channels]
                'v' [batch_size, 0, value_channels]
+           For encoder-decoder attention (memory_antecedent is not None), the
+           dict may instead hold the memory keys and values, computed once and
+           already split into heads; without them, they are computed from
+           memory_antecedent on every call:
+               'k_encdec' [memory_batch, heads, length_m, key_channels/heads]
+               'v_encdec' [memory_batch, heads, length_m, value_channels/heads]
+           where batch_size is a multiple n of memory_batch, e.g. with n beams
+           per memory row in beam search. Query rows [i * n, (i + 1) * n)
+           attend to memory row i; bias must then have memory_batch rows.
     gap_size: Integer option for dilated attention to indicate spacing between
               memory blocks.
     num_memory_blocks: Integer option to indicate how many memory blocks to look
@@ -2289,6 +2393,16 @@ def multihead_attention(query_antecedent,
     save_weights_to: an optional dictionary to capture attention weights
       for vizualization; the weights tensor will be appended there under
       a string key created from the variable scope (including name).
+    decode_loop_step: an optional integer Tensor, the step of the decoding
+      loop, a scalar or one per batch row. If given, the cache holds
+      preallocated Tensors or Variables, already split into heads,
+               'k' [batch_size, heads, decode_length, key_channels/heads]
+               'v' [batch_size, heads, decode_length, value_channels/heads]
+      and this step's keys and values are written in place at
+      decode_loop_step instead of being concatenated (see
+      write_to_decode_cache()). A query of length n writes the n positions
+      from decode_loop_step on and attends to the whole cache, so the bias
+      must cover decode_length memory positions and mask those not written.
     **kwargs (dict): Parameters for the attention function
 
   Caching:
@@ -2322,9 +2436,12 @@ def multihead_attention(query_antecedent,
       name,
       default_name="multihead_attention",
       values=[query_antecedent, memory_antecedent]):
-    q, k, v = compute_qkv(query_antecedent, memory_antecedent, total_key_depth,
-                          total_value_depth, q_filter_width, kv_filter_width,
-                          q_padding, kv_padding)
+    cached_memory = (cache is not None and memory_antecedent is not None and
+                     "k_encdec" in cache)
+    if not cached_memory:
+      q, k, v = compute_qkv(query_antecedent, memory_antecedent,
+                            total_key_depth, total_value_depth, q_filter_width,
+                            kv_filter_width, q_padding, kv_padding)
 
     if cache is not None:
       if attention_type != "dot_product":
@@ -2334,12 +2451,36 @@ def multihead_attention(query_antecedent,
       if bias is None:
         raise ValueError("Bias required for caching. See function docstring "
                          "for details.")
-      k = cache["k"] = tf.concat([cache["k"], k], axis=1)
-      v = cache["v"] = tf.concat([cache["v"], v], axis=1)
+      if cached_memory:
+        # Encoder-decoder attention: the memory keys and values do not change
+        # from step to step, so only the query is computed.
+        q = compute_attention_component(query_antecedent, total_key_depth,
+                                        q_filter_width, q_padding, "q")
+        k = cache["k_encdec"]
+        v = cache["v_encdec"]
+      elif memory_antecedent is None:
+        if decode_loop_step is None:
+          k = cache["k"] = tf.concat([cache["k"], k], axis=1)
+          v = cache["v"] = tf.concat([cache["v"], v], axis=1)
+        else:
+          # The cache is attended to as is; the bias masks the positions not
+          # written yet.
+          k = cache["k"] = write_to_decode_cache(
+              cache["k"], split_heads(k, num_heads), decode_loop_step)
+          v = cache["v"] = write_to_decode_cache(
+              cache["v"], split_heads(v, num_heads), decode_loop_step)
+    heads_cached = cache is not None and (
+        cached_memory or
+        memory_antecedent is None and decode_loop_step is not None)
 
     q = split_heads(q, num_heads)
-    k = split_heads(k, num_heads)
-    v = split_heads(v, num_heads)
+    if not heads_cached:
+      k = split_heads(k, num_heads)
+      v = split_heads(v, num_heads)
+    shared_memory = cache is not None and memory_antecedent is not None
+    if shared_memory:
+      length_q = common_layers.shape_list(q)[2]
+      q = fold_rows_into_queries(q, common_layers.shape_list(k)[0])
     key_depth_per_head = total_key_depth // num_heads
     q *= key_depth_per_head**-0.5
 
@@ -2366,6 +2507,8 @@ def multihead_attention(query_antecedent,
       assert attention_type == "unmasked_dilated_1d"
       x = dilated_self_attention_1d(q, k, v, block_length, block_width,
                                     gap_size, num_memory_blocks)
+    if shared_memory:
+      x = unfold_rows_from_queries(x, length_q)
     x = combine_heads(x)
     x = tf.layers.dense(
         x, output_depth, use_bias=False, name="output_transform")
@@ -27,6 +27,8 @@ from tensor2tensor.layers import common_layers
 
 import tensorflow as tf
 
+from tensorflow.python.ops import inplace_ops
+
 
 class CommonAttentionTest(tf.test.TestCase):
 
@@ -460,6 +462,54 @@ class CommonAttentionTest(tf.test.TestCase):
           ground_truth,
       )
 
+  def testWriteToDecodeCache(self):
+    x = tf.reshape(tf.range(1, 13, dtype=tf.float32), [2, 2, 1, 3])
+    step = tf.placeholder(tf.int32, [])
+    cache = common_attention.write_to_decode_cache(
+        inplace_ops.empty([2, 2, 4, 3], tf.float32, init=True), x, step)
+    # One position per row.
+    var = tf.get_variable("cache", initializer=tf.zeros([2, 2, 4, 3]))
+    var_cache = common_attention.write_to_decode_cache(var, x,
+                                                       tf.constant([3, 0]))
+    with self.test_session() as session:
+      session.run(tf.global_variables_initializer())
+      session.run(cache, {step: 2})
+      # Each run writes into a new buffer, so the first write is gone.
+      res, x_res = session.run([cache, x], {step: 1})
+      var_res = session.run(var_cache)
+    expected = np.zeros([2, 2, 4, 3], np.float32)
+    expected[:, :, 1] = x_res[:, :, 0]
+    self.assertAllClose(expected, res)
+    expected = np.zeros([2, 2, 4, 3], np.float32)
+    expected[0, :, 3] = x_res[0, :, 0]
+    expected[1, :, 0] = x_res[1, :, 0]
+    self.assertAllClose(expected, var_res)
+
+  def testEncDecAttentionCache(self):
+    x = tf.random_normal([2, 1, 8])
+    memory = tf.random_normal([2, 3, 8])
+    bias = tf.zeros([2, 1, 1, 3])
+
+    def attend(cache):
+      return common_attention.multihead_attention(
+          x, memory, bias, 8, 8, 8, 2, 0.0, cache=cache,
+          name="encdec_attention")
+
+    with tf.variable_scope("attention", reuse=tf.AUTO_REUSE):
+      uncached = attend(None)
+      # Without precomputed keys and values, they come from the memory.
+      no_encdec = attend({"k": tf.zeros([2, 0, 8]), "v": tf.zeros([2, 0, 8])})
+      with tf.variable_scope("encdec_attention"):
+        k = common_attention.compute_attention_component(memory, 8, name="k")
+        v = common_attention.compute_attention_component(memory, 8, name="v")
+      cached = attend({"k_encdec": common_attention.split_heads(k, 2),
+                       "v_encdec": common_attention.split_heads(v, 2)})
+    with self.test_session() as session:
+      session.run(tf.global_variables_initializer())
+      res = session.run([uncached, no_encdec, cached])
+    self.assertAllClose(res[0], res[1])
+    self.assertAllClose(res[0], res[2])
+
 
 if __name__ == "__main__":
   tf.test.main()
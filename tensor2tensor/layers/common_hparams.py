@@ -118,6 +118,29 @@ def basic_params1():
       # min_bucket_length to (max_length or batch_size), increasing
       # (approximately) by factors of length_bucket_step.
       length_bucket_step=1.1,
+      # How to batch variable length features when batch_size means tokens:
+      # "buckets" groups examples into length buckets, "sorted_buffer" sorts
+      # a buffer of sorted_buffer_size examples by length and cuts it into
+      # batches that fill batch_size tokens, padding included. It has no
+      # buckets, so the problem's batch_size_multiplier is not used.
+      batching_mode="buckets",
+      sorted_buffer_size=10000,
+      # Add summaries of the throughput of the input pipeline's stages and of
+      # the time spent waiting for batches. This slows the pipeline a little.
+      instrument_input_pipeline=False,
+      # Read the training files in an order that is saved with each
+      # checkpoint, so a restarted job resumes after the records read before
+      # the checkpoint instead of replaying data. Records still buffered in
+      # the input pipeline at the checkpoint are skipped; their number is
+      # logged on resume. Not used on TPU or with flat datasets.
+      resumable_input_pipeline=False,
+      # In training with several workers, have each worker read its own
+      # subset of the data files, or of the records of every file if the
+      # files do not divide evenly among the workers.
+      shard_data_by_worker=False,
+      # Format of the data files to read: "tfrecord", or "flat" for the
+      # memory-mapped token arrays written by t2t-flatten-data.
+      dataset_format="tfrecord",
       # If set to True, drop sequences longer than max_length during eval.
       # This affects the validity of the evaluation metrics.
       eval_drop_long_sequences=False,
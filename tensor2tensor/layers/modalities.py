@@ -41,6 +41,73 @@ def tpu_gather(params, indices):
   return out
 
 
+def vocab_shortlist(frequent_ids, vocab_size, source_ids=None,
+                    batch_size=None):
+  """Per-example shortlists of the vocabulary, for decoding.
+
+  Each shortlist holds the ids in frequent_ids and, if given, the ids in the
+  example's row of source_ids. Positions 0 and 1 of every shortlist hold
+  the padding id 0 and the end-of-sequence id 1, so these two ids mean the
+  same in the shortlist id space. The other ids follow in increasing order,
+  and shortlists are padded to a common length.
+
+  Args:
+    frequent_ids: a 1-d int Tensor (or list) of ids in every shortlist.
+    vocab_size: an integer, the size of the vocabulary.
+    source_ids: an optional int Tensor [batch, length] of ids to add per
+      example; 0 is padding.
+    batch_size: the number of shortlists, if source_ids is None.
+
+  Returns:
+    shortlist: an int32 Tensor [batch, shortlist_size] of vocabulary ids.
+    bias: a float Tensor [batch, shortlist_size], 0 for shortlisted ids and
+      -1e9 for padding positions, to add to the logits.
+  """
+  frequent_ids = tf.convert_to_tensor(frequent_ids, dtype=tf.int32)
+  # Repeated ids add up in scatter_nd, so the scores are clipped to 1.
+  scores = tf.minimum(tf.scatter_nd(
+      tf.expand_dims(frequent_ids, 1),
+      tf.ones_like(frequent_ids, dtype=tf.float32), [vocab_size]), 1.0)
+  size = common_layers.shape_list(frequent_ids)[0] + 2
+  if source_ids is None:
+    scores = tf.tile(tf.expand_dims(scores, 0), [batch_size, 1])
+  else:
+    source_ids = tf.to_int32(source_ids)
+    batch_size, length = common_layers.shape_list(source_ids)
+    indices = tf.stack([
+        tf.reshape(tf.tile(tf.expand_dims(tf.range(batch_size), 1),
+                           [1, length]), [-1]),
+        tf.reshape(source_ids, [-1])], axis=1)
+    in_source = tf.scatter_nd(
+        indices, tf.ones([batch_size * length]), [batch_size, vocab_size])
+    scores = tf.minimum(scores + in_source, 1.0)
+    size += length
+  # PAD and EOS first, then the shortlisted ids in order.
+  scores += 3.0 * tf.one_hot(0, vocab_size) + 2.0 * tf.one_hot(1, vocab_size)
+  scores, shortlist = tf.nn.top_k(scores, k=tf.minimum(size, vocab_size))
+  bias = tf.where(tf.greater(scores, 0.0), tf.zeros_like(scores),
+                  tf.fill(tf.shape(scores), -1e9))
+  return shortlist, bias
+
+
+def shortlist_to_vocab_ids(ids, shortlist):
+  """Maps ids in the shortlist id space back to vocabulary ids.
+
+  Args:
+    ids: an int Tensor whose leading dimension is batch * n, with the rows of
+      each example consecutive, or batch with any trailing dimensions.
+    shortlist: an int32 Tensor [batch, shortlist_size], from vocab_shortlist.
+
+  Returns:
+    a Tensor of vocabulary ids with the shape of ids.
+  """
+  batch_size, size = common_layers.shape_list(shortlist)
+  flat_ids = tf.reshape(ids, [batch_size, -1])
+  offsets = tf.expand_dims(tf.range(batch_size) * size, 1)
+  vocab_ids = tf.gather(tf.reshape(shortlist, [-1]), flat_ids + offsets)
+  return tf.reshape(vocab_ids, tf.shape(ids))
+
+
 @registry.register_symbol_modality("default")
 class SymbolModality(modality.Modality):
   """Modality for sets of discrete symbols.
@@ -169,6 +236,49 @@ class SymbolModality(modality.Modality):
           return tf.reshape(
               logits, body_output_shape[:-1] + [1, self._vocab_size])
 
+  def shortlist_top_weights(self, shortlist):
+    """Gathers the softmax weights of per-example vocabulary shortlists.
+
+    This gathers rows of the (possibly sharded) softmax variable once, so
+    that top_with_shortlist can be called every decoding step.
+
+    Args:
+      shortlist: an int32 Tensor [batch, shortlist_size] of vocabulary ids.
+    Returns:
+      a Tensor [batch, shortlist_size, body_input_depth].
+    """
+    if self._model_hparams.shared_embedding_and_softmax_weights:
+      scope_name = "shared"
+      reuse = True
+    else:
+      scope_name = "softmax"
+      reuse = False
+
+    with tf.variable_scope(scope_name, reuse=reuse):
+      var = self._get_weights()
+      return tf.gather(var, shortlist)
+
+  def top_with_shortlist(self, body_output, weights, bias=None):
+    """Generate logits over per-example vocabulary shortlists.
+
+    Args:
+      body_output: A Tensor with shape [batch * n, p0, p1, body_input_depth],
+        where the n rows of each example (e.g. its beams) are consecutive.
+      weights: A Tensor [batch, shortlist_size, body_input_depth] from
+        shortlist_top_weights.
+      bias: an optional Tensor [batch, shortlist_size] added to the logits.
+    Returns:
+      logits: A Tensor with shape [batch * n, p0, p1, 1, shortlist_size].
+    """
+    body_output_shape = common_layers.shape_list(body_output)
+    batch_size, size = common_layers.shape_list(weights)[:2]
+    body_output = tf.reshape(body_output,
+                             [batch_size, -1, body_output_shape[-1]])
+    logits = tf.matmul(body_output, weights, transpose_b=True)
+    if bias is not None:
+      logits += tf.expand_dims(bias, 1)
+    return tf.reshape(logits, body_output_shape[:-1] + [1, size])
+
 
 @registry.register_symbol_modality("ctc")
 class CTCSymbolModality(SymbolModality):
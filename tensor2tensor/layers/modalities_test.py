@@ -114,6 +114,41 @@ class ModalityTest(tf.test.TestCase):
     self.assertEqual(res1.shape, (batch_size, length, height, 1, vocab_size))
     self.assertEqual(res2.shape, ())
 
+  def testVocabShortlist(self):
+    source_ids = tf.constant([[7, 5, 0], [4, 4, 1]])
+    shortlist, bias = modalities.vocab_shortlist([2, 5], 10,
+                                                 source_ids=source_ids)
+    with self.test_session() as session:
+      shortlist, bias = session.run((shortlist, bias))
+    self.assertAllEqual([[0, 1, 2, 5, 7], [0, 1, 2, 4, 5]], shortlist[:, :5])
+    self.assertAllEqual(np.zeros((2, 5)), bias[:, :5])
+    self.assertTrue(np.all(bias[:, 5:] < -1e8))
+
+  def testSymbolModalityTopWithShortlist(self):
+    batch_size = 2
+    beam_size = 3
+    hidden_size = 9
+    vocab_size = 11
+    model_hparams = common_hparams.basic_params1()
+    model_hparams.hidden_size = hidden_size
+    model_hparams.mode = tf.estimator.ModeKeys.PREDICT
+    model_hparams.symbol_modality_num_shards = 4
+    body_output = tf.random_normal([batch_size * beam_size, 1, 1, hidden_size])
+    shortlist = tf.constant([[0, 1, 3, 8], [0, 1, 10, 4]])
+    m = modalities.SymbolModality(model_hparams, vocab_size)
+    logits = m.top(body_output, None)
+    with tf.variable_scope(tf.get_variable_scope(), reuse=True):
+      shortlist_logits = m.top_with_shortlist(
+          body_output, m.shortlist_top_weights(shortlist))
+    with self.test_session() as session:
+      session.run(tf.global_variables_initializer())
+      res1, res2 = session.run((logits, shortlist_logits))
+    self.assertEqual(res2.shape, (batch_size * beam_size, 1, 1, 1, 4))
+    res1 = np.reshape(res1, [batch_size, beam_size, vocab_size])
+    res2 = np.reshape(res2, [batch_size, beam_size, 4])
+    self.assertAllClose(res1[0][:, [0, 1, 3, 8]], res2[0])
+    self.assertAllClose(res1[1][:, [0, 1, 10, 4]], res2[1])
+
 
 if __name__ == "__main__":
   tf.test.main()
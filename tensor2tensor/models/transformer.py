@@ -23,13 +23,18 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
+import copy
+import functools
+
 # Dependency imports
 
+import six
 from six.moves import xrange  # pylint: disable=redefined-builtin
 
 from tensor2tensor.layers import common_attention
 from tensor2tensor.layers import common_hparams
 from tensor2tensor.layers import common_layers
+from tensor2tensor.layers import modalities
 from tensor2tensor.utils import beam_search
 from tensor2tensor.utils import expert_utils
 from tensor2tensor.utils import registry
@@ -38,6 +43,7 @@ from tensor2tensor.utils import t2t_model
 import tensorflow as tf
 
 from tensorflow.python.eager import context
+from tensorflow.python.ops import inplace_ops
 from tensorflow.python.util import nest
 
 
@@ -90,7 +96,8 @@ class Transformer(t2t_model.T2TModel):
              decoder_self_attention_bias,
              hparams,
              cache=None,
-             nonpadding=None):
+             nonpadding=None,
+             decode_loop_step=None):
     """Decode Transformer outputs from encoder representation.
 
     Args:
@@ -106,6 +113,8 @@ class Transformer(t2t_model.T2TModel):
       cache: dict, containing tensors which are the results of previous
           attentions, used for fast decoding.
       nonpadding: optional Tensor with shape [batch_size, decoder_length]
+      decode_loop_step: optional integer Tensor, the step of a fast decoding
+          loop whose cache is preallocated.
 
     Returns:
       Final decoder representation. [batch_size, decoder_length, hidden_dim]
@@ -121,7 +130,8 @@ class Transformer(t2t_model.T2TModel):
         hparams,
         cache=cache,
         nonpadding=nonpadding,
-        save_weights_to=self.attention_weights)
+        save_weights_to=self.attention_weights,
+        decode_loop_step=decode_loop_step)
 
     if hparams.use_tpu and hparams.mode == tf.estimator.ModeKeys.TRAIN:
       # TPU does not react kindly to extra dimensions.
@@ -180,7 +190,10 @@ class Transformer(t2t_model.T2TModel):
       NotImplementedError: If there are multiple data shards.
     """
     with tf.variable_scope(self.name):
-      decoded_ids, _ = self._fast_decode(features, decode_length)
+      if self._decode_hparams.draft_hparams_set:
+        decoded_ids = self._speculative_decode(features, decode_length)
+      else:
+        decoded_ids, _ = self._fast_decode(features, decode_length)
       return decoded_ids, None, None
 
   def _beam_decode(self, features, decode_length, beam_size, top_beams, alpha):
@@ -202,6 +215,192 @@ class Transformer(t2t_model.T2TModel):
                                               beam_size, top_beams, alpha)
       return {"outputs": decoded_ids, "scores": scores}
 
+  def _encode_for_decoding(self, features):
+    """Runs the input modality and the encoder on features["inputs"].
+
+    Args:
+      features: a map of string to model features.
+
+    Returns:
+      encoder_output: [batch_size, input_length, hidden_dim]
+      encoder_decoder_attention_bias: [batch_size, 1, 1, input_length]
+    """
+    dp = self._data_parallelism
+    inputs = features["inputs"]
+    # TODO(llion): Clean up this reshaping logic.
+    inputs = tf.expand_dims(inputs, axis=1)
+    if len(inputs.shape) < 5:
+      inputs = tf.expand_dims(inputs, axis=4)
+    s = common_layers.shape_list(inputs)
+    inputs = tf.reshape(inputs, [s[0] * s[1], s[2], s[3], s[4]])
+    # _shard_features called to ensure that the variable names match
+    inputs = self._shard_features({"inputs": inputs})["inputs"]
+    input_modality = self._problem_hparams.input_modality["inputs"]
+    with tf.variable_scope(input_modality.name):
+      inputs = input_modality.bottom_sharded(inputs, dp)
+    with tf.variable_scope("body"):
+      encoder_output, encoder_decoder_attention_bias = dp(
+          self.encode, inputs, features["target_space_id"], self._hparams,
+          features=features)
+    return encoder_output[0], encoder_decoder_attention_bias[0]
+
+  def _encdec_attention_cache(self, encoder_output):
+    """Keys and values of the decoder's encoder-decoder attention.
+
+    They do not change while decoding, so fast decoding computes them once,
+    before the decoding loop, with the variables of the encdec_attention
+    layers of transformer_decoder, and passes them in the cache.
+
+    Args:
+      encoder_output: Output from encoder.
+
+    Returns:
+      a dict from decoder layer name to a dict of "k_encdec" and "v_encdec"
+      Tensors, split into heads.
+    """
+    hparams = self._hparams
+    key_channels = hparams.attention_key_channels or hparams.hidden_size
+    value_channels = hparams.attention_value_channels or hparams.hidden_size
+    cache = {}
+    for layer in xrange(hparams.num_decoder_layers or
+                        hparams.num_hidden_layers):
+      layer_name = "layer_%d" % layer
+      # The multihead_attention scope is entered separately so that leaving
+      # the outer scope frees its name for the default name used there.
+      with tf.variable_scope("body/decoder/%s/encdec_attention" % layer_name):
+        with tf.variable_scope("multihead_attention"):
+          k = common_attention.compute_attention_component(
+              encoder_output, key_channels, name="k")
+          v = common_attention.compute_attention_component(
+              encoder_output, value_channels, name="v")
+      cache[layer_name] = {
+          "k_encdec": common_attention.split_heads(k, hparams.num_heads),
+          "v_encdec": common_attention.split_heads(v, hparams.num_heads),
+      }
+    return cache
+
+  def _incremental_decoder(self, features, cache_length):
+    """Encodes features for decoding several positions per step.
+
+    Args:
+      features: a map of string to model features.
+      cache_length: the number of decoder positions to preallocate the cache
+        for.
+
+    Returns:
+      symbols_to_logits_fn: a function mapping (ids, i, cache), where ids
+        [batch_size, n] are the decoder inputs at positions i to i + n - 1,
+        to logits [batch_size, n, vocab_size] and the updated cache. The
+        input at position 0 must be 0.
+      cache: the initial cache.
+    """
+    dp = self._data_parallelism
+    hparams = self._hparams
+    target_modality = self._problem_hparams.target_modality
+
+    encoder_output, encoder_decoder_attention_bias = (
+        self._encode_for_decoding(features))
+    cache = _merge_states(
+        init_decode_cache(encoder_output, encoder_decoder_attention_bias,
+                          hparams, cache_length),
+        self._encdec_attention_cache(encoder_output))
+
+    if hparams.pos == "timing":
+      timing_signal = common_attention.get_timing_signal_1d(
+          cache_length, hparams.hidden_size)
+    decoder_self_attention_bias = (
+        common_attention.attention_bias_lower_triangle(cache_length))
+    if hparams.proximity_bias:
+      decoder_self_attention_bias += common_attention.attention_bias_proximal(
+          cache_length)
+
+    def symbols_to_logits_fn(ids, i, cache):
+      """Go from ids to logits for the symbols after each of them."""
+      length = common_layers.shape_list(ids)[1]
+      # The embedding of id 0 is zeros, as fast decoding's first input.
+      targets = tf.expand_dims(tf.expand_dims(ids, axis=2), axis=3)
+      targets = self._shard_features({"targets": targets})["targets"]
+      with tf.variable_scope(target_modality.name):
+        targets = target_modality.targets_bottom_sharded(targets, dp)[0]
+      targets = common_layers.flatten4d3d(targets)
+      if hparams.pos == "timing":
+        targets += timing_signal[:, i:i + length]
+
+      with tf.variable_scope("body"):
+        body_outputs = dp(
+            self.decode, targets, cache["encoder_output"],
+            cache["encoder_decoder_attention_bias"],
+            decoder_self_attention_bias[:, :, i:i + length, :], hparams, cache,
+            nonpadding=features_to_nonpadding(features, "targets"),
+            decode_loop_step=i)
+
+      with tf.variable_scope(target_modality.name):
+        logits = target_modality.top_sharded(body_outputs, None, dp)[0]
+
+      return tf.squeeze(logits, axis=[2, 3]), cache
+
+    return symbols_to_logits_fn, cache
+
+  def _speculative_decode(self, features, decode_length):
+    """Greedy decoding with the proposals of a draft model.
+
+    The draft model is a Transformer with hparams set
+    decode_hparams.draft_hparams_set, for the same problem. Its variables are
+    local variables under the "draft" scope, loaded from the latest
+    checkpoint in decode_hparams.draft_model_dir. The decoded ids are those of
+    greedy decoding; see speculative_greedy_decode().
+
+    Args:
+      features: a map of string to model features.
+      decode_length: an integer.  How many additional timesteps to decode.
+
+    Returns:
+       samples: an integer `Tensor` [batch_size, length].
+
+    Raises:
+      NotImplementedError: If there are multiple data shards.
+    """
+    if self._num_datashards != 1:
+      raise NotImplementedError("Fast decoding only supports a single shard.")
+    decode_hp = self._decode_hparams
+    target_modality = self._problem_hparams.target_modality
+    if target_modality.is_class_modality:
+      decode_length = 1
+    else:
+      decode_length = (common_layers.shape_list(features["inputs"])[1] +
+                       decode_length)
+    cache_length = decode_length + decode_hp.num_draft_tokens
+
+    scope = tf.get_variable_scope()
+    symbols_to_logits_fn, cache = self._incremental_decoder(features,
+                                                            cache_length)
+    draft = _draft_model(self, decode_hp.draft_hparams_set)
+    with tf.variable_scope("draft", custom_getter=_local_variable_getter,
+                           reuse=tf.AUTO_REUSE):
+      with tf.variable_scope(draft.name) as draft_scope:
+        draft_symbols_to_logits_fn, draft_cache = draft._incremental_decoder(  # pylint: disable=protected-access
+            features, cache_length)
+
+    def target_fn(ids, i, cache):
+      with tf.variable_scope(scope, reuse=tf.AUTO_REUSE):
+        return symbols_to_logits_fn(ids, i, cache)
+
+    def draft_fn(ids, i, cache):
+      with tf.variable_scope(draft_scope, reuse=tf.AUTO_REUSE):
+        return draft_symbols_to_logits_fn(ids, i, cache)
+
+    decoded_ids, tokens_per_step = speculative_greedy_decode(
+        target_fn, draft_fn, cache, draft_cache, decode_length,
+        decode_hp.num_draft_tokens,
+        stop_at_eos=bool(self._problem_hparams.stop_at_eos))
+    if decode_hp.draft_model_dir:
+      tf.train.init_from_checkpoint(
+          decode_hp.draft_model_dir,
+          {draft.name + "/": draft_scope.name + "/"})
+    self.decode_stats["tokens_per_step"] = tf.fill(
+        [common_layers.shape_list(decoded_ids)[0]], tokens_per_step)
+    return decoded_ids
+
   def _fast_decode(self,
                    features,
                    decode_length,
@@ -239,23 +438,10 @@ class Transformer(t2t_model.T2TModel):
     else:
       decode_length = common_layers.shape_list(inputs)[1] + decode_length
 
-    # TODO(llion): Clean up this reshaping logic.
-    inputs = tf.expand_dims(inputs, axis=1)
-    if len(inputs.shape) < 5:
-      inputs = tf.expand_dims(inputs, axis=4)
-    s = common_layers.shape_list(inputs)
-    inputs = tf.reshape(inputs, [s[0] * s[1], s[2], s[3], s[4]])
-    # _shard_features called to ensure that the variable names match
-    inputs = self._shard_features({"inputs": inputs})["inputs"]
+    encoder_output, encoder_decoder_attention_bias = (
+        self._encode_for_decoding(features))
+    batch_size = common_layers.shape_list(encoder_output)[0]
     input_modality = self._problem_hparams.input_modality["inputs"]
-    with tf.variable_scope(input_modality.name):
-      inputs = input_modality.bottom_sharded(inputs, dp)
-    with tf.variable_scope("body"):
-      encoder_output, encoder_decoder_attention_bias = dp(
-          self.encode, inputs, features["target_space_id"], hparams,
-          features=features)
-    encoder_output = encoder_output[0]
-    encoder_decoder_attention_bias = encoder_decoder_attention_bias[0]
 
     if hparams.pos == "timing":
       timing_signal = common_attention.get_timing_signal_1d(
@@ -295,36 +481,151 @@ class Transformer(t2t_model.T2TModel):
     if hparams.proximity_bias:
       decoder_self_attention_bias += common_attention.attention_bias_proximal(
           decode_length)
+    skip_finished = (bool(self._problem_hparams.stop_at_eos) and
+                     getattr(hparams, "skip_finished_decodes", False))
+    preallocate_cache = (getattr(hparams, "preallocate_decode_cache", False)
+                         and beam_size == 1 and not skip_finished)
+
+    vocab_size = target_modality.top_dimensionality
+    shortlist = None
+    if getattr(hparams, "vocab_shortlist_size", 0):
+      if skip_finished:
+        raise ValueError("vocab_shortlist_size is not supported with "
+                         "skip_finished_decodes.")
+      # Source tokens are only candidates if source and target share ids.
+      source_ids = None
+      if input_modality.name == target_modality.name:
+        source_ids = tf.reshape(features["inputs"], [batch_size, -1])
+      shortlist, shortlist_bias = modalities.vocab_shortlist(
+          _shortlist_frequent_ids(hparams, vocab_size), vocab_size,
+          source_ids=source_ids, batch_size=batch_size)
+      with tf.variable_scope(target_modality.name):
+        shortlist_weights = target_modality.shortlist_top_weights(shortlist)
+      vocab_size = common_layers.shape_list(shortlist)[1]
 
     def symbols_to_logits_fn(ids, i, cache):
       """Go from ids to logits for next symbol."""
       ids = ids[:, -1:]
+      if shortlist is not None:
+        ids = modalities.shortlist_to_vocab_ids(ids, shortlist)
       targets = tf.expand_dims(tf.expand_dims(ids, axis=2), axis=3)
       targets = preprocess_targets(targets, i)
 
-      bias = decoder_self_attention_bias[:, :, i:i + 1, :i + 1]
+      if preallocate_cache:
+        # Attend over the whole cache; the bias masks the unwritten positions.
+        bias = decoder_self_attention_bias[:, :, i:i + 1, :]
+        decode_loop_step = i
+      else:
+        bias = decoder_self_attention_bias[:, :, i:i + 1, :i + 1]
+        decode_loop_step = None
 
       with tf.variable_scope("body"):
         body_outputs = dp(
             self.decode, targets, cache["encoder_output"],
             cache["encoder_decoder_attention_bias"], bias, hparams, cache,
-            nonpadding=features_to_nonpadding(features, "targets"))
+            nonpadding=features_to_nonpadding(features, "targets"),
+            decode_loop_step=decode_loop_step)
 
       with tf.variable_scope(target_modality.name):
-        logits = target_modality.top_sharded(body_outputs, None, dp)[0]
+        if shortlist is not None:
+          logits = dp(target_modality.top_with_shortlist, body_outputs,
+                      shortlist_weights, shortlist_bias)[0]
+        else:
+          logits = target_modality.top_sharded(body_outputs, None, dp)[0]
 
       return tf.squeeze(logits, axis=[1, 2, 3]), cache
 
-    return fast_decode(
+    decoded_ids, scores = fast_decode(
         encoder_output=encoder_output,
         encoder_decoder_attention_bias=encoder_decoder_attention_bias,
         symbols_to_logits_fn=symbols_to_logits_fn,
         hparams=hparams,
         decode_length=decode_length,
-        vocab_size=target_modality.top_dimensionality,
+        vocab_size=vocab_size,
         beam_size=beam_size,
         top_beams=top_beams,
-        alpha=alpha)
+        alpha=alpha,
+        preallocate_cache=preallocate_cache,
+        cache=self._encdec_attention_cache(encoder_output),
+        stop_at_eos=bool(self._problem_hparams.stop_at_eos),
+        skip_finished=skip_finished,
+        share_encoder_across_beams=getattr(
+            hparams, "share_encoder_across_beams", False),
+        beam_search_back_pointers=getattr(
+            hparams, "beam_search_back_pointers", False))
+    if shortlist is not None:
+      decoded_ids = modalities.shortlist_to_vocab_ids(decoded_ids, shortlist)
+    return decoded_ids, scores
+
+
+def _shortlist_frequent_ids(hparams, vocab_size):
+  """The ids in every vocabulary shortlist of fast decoding.
+
+  These are the first hparams.vocab_shortlist_size ids listed, one per line,
+  in hparams.vocab_shortlist_file, or else the ids below
+  hparams.vocab_shortlist_size; subword vocabularies are generated roughly in
+  order of decreasing frequency.
+
+  Args:
+    hparams: run hyperparameters.
+    vocab_size: an integer, the size of the target vocabulary.
+
+  Returns:
+    a list of ids.
+  """
+  size = min(hparams.vocab_shortlist_size, vocab_size)
+  if not hparams.vocab_shortlist_file:
+    return list(range(size))
+  with tf.gfile.Open(hparams.vocab_shortlist_file) as f:
+    ids = [int(line) for line in f if line.strip()]
+  return [i for i in ids if i < vocab_size][:size]
+
+
+def init_decode_cache(encoder_output,
+                      encoder_decoder_attention_bias,
+                      hparams,
+                      cache_length):
+  """Returns the initial cache of incremental decoding with transformer_decoder.
+
+  Args:
+    encoder_output: Output from encoder.
+    encoder_decoder_attention_bias: a bias tensor for use in encoder-decoder
+      attention
+    hparams: run hyperparameters
+    cache_length: the number of self-attention positions to allocate, in
+      Tensors split into heads (see common_attention.multihead_attention);
+      0 for a cache that grows by concatenation.
+
+  Returns:
+    a nested dict of Tensors.
+  """
+  batch_size = common_layers.shape_list(encoder_output)[0]
+  key_channels = hparams.attention_key_channels or hparams.hidden_size
+  value_channels = hparams.attention_value_channels or hparams.hidden_size
+  num_layers = hparams.num_decoder_layers or hparams.num_hidden_layers
+
+  if cache_length:
+    heads = hparams.num_heads
+    # The cache is written in place, so each run needs a buffer of its own
+    # rather than a constant.
+    new_cache = lambda shape: inplace_ops.empty(shape, tf.float32, init=True)
+    k_shape = [batch_size, heads, cache_length, key_channels // heads]
+    v_shape = [batch_size, heads, cache_length, value_channels // heads]
+  else:
+    new_cache = tf.zeros
+    k_shape = [batch_size, 0, key_channels]
+    v_shape = [batch_size, 0, value_channels]
+  cache = {
+      "layer_%d" % layer: {
+          "k": new_cache(k_shape),
+          "v": new_cache(v_shape),
+      }
+      for layer in range(num_layers)
+  }
+
+  cache["encoder_output"] = encoder_output
+  cache["encoder_decoder_attention_bias"] = encoder_decoder_attention_bias
+  return cache
 
 
 def fast_decode(encoder_output,
@@ -336,12 +637,32 @@ def fast_decode(encoder_output,
                 beam_size=1,
                 top_beams=1,
                 alpha=1.0,
-                eos_id=beam_search.EOS_ID):
+                eos_id=beam_search.EOS_ID,
+                preallocate_cache=False,
+                cache=None,
+                stop_at_eos=False,
+                skip_finished=False,
+                share_encoder_across_beams=False,
+                beam_search_back_pointers=False):
   """Given encoder output and a symbols to logits function, does fast decoding.
 
   Implements both greedy and beam search decoding, uses beam search iff
   beam_size > 1, otherwise beam search related arguments are ignored.
 
+  By default the self-attention cache of each layer starts empty and grows by
+  one position per step, copying the whole cache into a new, larger one.
+  With preallocate_cache, it is allocated at its full size of decode_length
+  positions up front, and symbols_to_logits_fn must write step i at
+  position i (see the decode_loop_step argument of
+  common_attention.multihead_attention), which updates the cache in place.
+  This keeps the loop state at a fixed shape, and attention reads the cache
+  without copying it. It is only supported in greedy decoding without
+  skip_finished.
+
+  Tensors that do not change while decoding, such as the keys and values of
+  encoder-decoder attention, can be computed once, before the decoding loop,
+  and passed in cache.
+
   Args:
     encoder_output: Output from encoder.
     encoder_decoder_attention_bias: a bias tensor for use in encoder-decoder
@@ -356,42 +677,94 @@ def fast_decode(encoder_output,
     alpha: Float that controls the length penalty. larger the alpha, stronger
       the preference for slonger translations.
     eos_id: End-of-sequence symbol in beam search.
+    preallocate_cache: a boolean. Whether to preallocate the decoder
+      self-attention cache.
+    cache: an optional nested dict of Tensors, added to the initial cache
+      passed to symbols_to_logits_fn, e.g. {"layer_0": {"k_encdec": ...,
+      "v_encdec": ...}} (see common_attention.multihead_attention).
+    stop_at_eos: a boolean. In greedy decoding, stop once every sequence has
+      produced eos_id, and output eos_id after the first one. The decoded ids
+      are then only as long as the longest sequence.
+    skip_finished: a boolean. In greedy decoding with stop_at_eos, drop
+      finished sequences from the batch that is run through
+      symbols_to_logits_fn. This saves compute when sequence lengths vary a
+      lot, at the cost of copying the cache when a sequence finishes.
+    share_encoder_across_beams: a boolean. In beam search, keep one copy of
+      encoder_output, encoder_decoder_attention_bias and any encoder-decoder
+      attention keys and values in cache per batch item, rather than one per
+      beam.
+      symbols_to_logits_fn then gets these with batch_size rows while the
+      other states have batch_size * beam_size rows.
+    beam_search_back_pointers: a boolean. Run beam search with
+      beam_search.beam_search_with_back_pointers, which keeps the decoded ids
+      in per-step buffers rather than gathering whole sequences every step.
+      symbols_to_logits_fn then only gets the last decoded ids.
 
   Returns:
     Pair of tensors `(decoded_ids, scores)`, where `decoded_ids` is a 2-d or 3-d
     (when doing beam search with top_beams > 1) tensor containing result of
     decoding, and `scores` is the beam search scores.
+
+  Raises:
+    ValueError: if skip_finished is set without stop_at_eos, or
+      preallocate_cache with beam search or skip_finished.
   """
+  if skip_finished and not stop_at_eos:
+    raise ValueError("skip_finished requires stop_at_eos.")
+  if preallocate_cache and (beam_size > 1 or skip_finished):
+    raise ValueError("preallocate_cache is only supported in greedy decoding "
+                     "without skip_finished.")
   batch_size = common_layers.shape_list(encoder_output)[0]
 
   key_channels = hparams.attention_key_channels or hparams.hidden_size
   value_channels = hparams.attention_value_channels or hparams.hidden_size
   num_layers = hparams.num_decoder_layers or hparams.num_hidden_layers
 
-  cache = {
-      "layer_%d" % layer: {
-          "k": tf.zeros([batch_size, 0, key_channels]),
-          "v": tf.zeros([batch_size, 0, value_channels]),
-      }
-      for layer in range(num_layers)
-  }
+  cache = _merge_states(
+      init_decode_cache(encoder_output, encoder_decoder_attention_bias,
+                        hparams, decode_length if preallocate_cache else 0),
+      cache or {})
 
   # Set 2nd dim to None since it's not invariant in the tf.while_loop
   # Note: Tensor.set_shape() does not work here since it merges shape info.
   # TODO(llion); Find a more robust solution.
   # pylint: disable=protected-access
-  if not context.in_eager_mode():
-    for layer in cache:
-      cache[layer]["k"]._shape = tf.TensorShape([None, None, key_channels])
-      cache[layer]["v"]._shape = tf.TensorShape([None, None, value_channels])
+  if not preallocate_cache and not context.in_eager_mode():
+    for layer in range(num_layers):
+      layer_cache = cache["layer_%d" % layer]
+      layer_cache["k"]._shape = tf.TensorShape([None, None, key_channels])
+      layer_cache["v"]._shape = tf.TensorShape([None, None, value_channels])
   # pylint: enable=protected-access
-  cache["encoder_output"] = encoder_output
-  cache["encoder_decoder_attention_bias"] = encoder_decoder_attention_bias
 
   if beam_size > 1:  # Beam Search
+    if share_encoder_across_beams:
+      # Keep the encoder-side states out of the beam search states, which are
+      # tiled to beam_size and gathered every step, and add them back for
+      # symbols_to_logits_fn. Attention broadcasts them over the beams.
+      shared_states = {
+          "encoder_output": cache.pop("encoder_output"),
+          "encoder_decoder_attention_bias": cache.pop(
+              "encoder_decoder_attention_bias"),
+      }
+      for layer in range(num_layers):
+        layer_name = "layer_%d" % layer
+        if "k_encdec" in cache[layer_name]:
+          shared_states[layer_name] = {
+              "k_encdec": cache[layer_name].pop("k_encdec"),
+              "v_encdec": cache[layer_name].pop("v_encdec"),
+          }
+      beam_symbols_to_logits_fn = functools.partial(
+          _symbols_to_logits_with_shared_states, symbols_to_logits_fn,
+          shared_states)
+    else:
+      beam_symbols_to_logits_fn = symbols_to_logits_fn
     initial_ids = tf.zeros([batch_size], dtype=tf.int32)
-    decoded_ids, scores = beam_search.beam_search(
-        symbols_to_logits_fn,
+    if beam_search_back_pointers:
+      beam_search_fn = beam_search.beam_search_with_back_pointers
+    else:
+      beam_search_fn = beam_search.beam_search
+    decoded_ids, scores = beam_search_fn(
+        beam_symbols_to_logits_fn,
         initial_ids,
         beam_size,
         decode_length,
@@ -407,33 +780,253 @@ def fast_decode(encoder_output,
       decoded_ids = decoded_ids[:, :top_beams, 1:]
   else:  # Greedy
 
-    def inner_loop(i, next_id, decoded_ids, cache):
+    # With skip_finished, next_id and cache only hold the rows that have not
+    # finished yet, and row_ids holds their indices in the batch.
+    def inner_loop(i, next_id, decoded_ids, finished, row_ids, cache):
+      """One step of greedy decoding."""
       logits, cache = symbols_to_logits_fn(next_id, i, cache)
       temperature = (0.0 if hparams.sampling_method == "argmax" else
                      hparams.sampling_temp)
-      next_id = tf.expand_dims(
-          common_layers.sample_with_temperature(logits, temperature), axis=1)
-      decoded_ids = tf.concat([decoded_ids, next_id], axis=1)
-      return i + 1, next_id, decoded_ids, cache
+      next_id = common_layers.sample_with_temperature(logits, temperature)
+      if skip_finished:
+        # Scatter to the whole batch; finished rows get eos_id.
+        eos = tf.constant(eos_id, dtype=next_id.dtype)
+        batch_next_id = tf.scatter_nd(
+            tf.expand_dims(row_ids, 1), next_id - eos, [batch_size]) + eos
+      elif stop_at_eos:
+        # Finished rows output eos_id from then on.
+        batch_next_id = tf.where(
+            finished, tf.fill([batch_size], tf.cast(eos_id, next_id.dtype)),
+            next_id)
+      else:
+        batch_next_id = next_id
+      if stop_at_eos:
+        finished = tf.logical_or(finished, tf.equal(batch_next_id, eos_id))
+      decoded_ids = tf.concat(
+          [decoded_ids, tf.expand_dims(batch_next_id, 1)], axis=1)
+      next_id = tf.expand_dims(next_id, 1)
+      if skip_finished:
+        active = tf.not_equal(tf.squeeze(next_id, 1), eos_id)
+        row_ids, next_id, cache = tf.cond(
+            tf.reduce_all(active),
+            lambda: (row_ids, next_id, cache),
+            lambda: nest.map_structure(  # pylint: disable=g-long-lambda
+                lambda t: tf.boolean_mask(t, active),
+                (row_ids, next_id, cache)))
+      return i + 1, next_id, decoded_ids, finished, row_ids, cache
+
+    def is_not_finished(i, unused_next_id, unused_decoded_ids, finished,
+                        *unused_args):
+      not_finished = tf.less(i, decode_length)
+      if stop_at_eos:
+        not_finished = tf.logical_and(
+            not_finished, tf.logical_not(tf.reduce_all(finished)))
+      return not_finished
 
     decoded_ids = tf.zeros([batch_size, 0], dtype=tf.int64)
     scores = None
     next_id = tf.zeros([batch_size, 1], dtype=tf.int64)
-    _, _, decoded_ids, _ = tf.while_loop(
-        # TODO(llion): Early stopping.
-        lambda i, *_: tf.less(i, decode_length),
+    finished = tf.zeros([batch_size], dtype=tf.bool)
+    row_ids = tf.range(batch_size)
+    if skip_finished:
+      cache_shape_invariant = (
+          lambda t: tf.TensorShape([None]).concatenate(t.shape[1:]))
+    else:
+      cache_shape_invariant = lambda t: tf.TensorShape(t.shape)
+    _, _, decoded_ids, _, _, _ = tf.while_loop(
+        is_not_finished,
         inner_loop,
-        [tf.constant(0), next_id, decoded_ids, cache],
+        [tf.constant(0), next_id, decoded_ids, finished, row_ids, cache],
         shape_invariants=[
             tf.TensorShape([]),
             tf.TensorShape([None, None]),
             tf.TensorShape([None, None]),
-            nest.map_structure(lambda t: tf.TensorShape(t.shape), cache),
+            tf.TensorShape([None]),
+            tf.TensorShape([None]),
+            nest.map_structure(cache_shape_invariant, cache),
         ])
 
   return decoded_ids, scores
 
 
+def speculative_greedy_decode(symbols_to_logits_fn,
+                              draft_symbols_to_logits_fn,
+                              cache,
+                              draft_cache,
+                              decode_length,
+                              num_draft_tokens,
+                              eos_id=beam_search.EOS_ID,
+                              stop_at_eos=False):
+  """Greedy decoding with the proposals of a draft model.
+
+  Each step, the draft model proposes num_draft_tokens ids, one at a time,
+  and the model scores all of them in one call. The proposals that match the
+  model's own greedy choices are kept, followed by the model's choice after
+  the last of them, so a step decodes from 1 to num_draft_tokens + 1 ids with
+  one call of the model. The decoded ids are those of greedy decoding with
+  the model alone. All rows of the batch advance together, by the fewest ids
+  any of them keeps.
+
+  Both functions map (ids, i, cache), where ids [batch_size, n] are the
+  decoder inputs at positions i to i + n - 1, to logits
+  [batch_size, n, vocab_size] and the updated cache, as returned by
+  Transformer._incremental_decoder. Their caches must be preallocated for
+  decode_length + num_draft_tokens positions; positions written past the ids
+  kept are written again in later steps.
+
+  Args:
+    symbols_to_logits_fn: the model.
+    draft_symbols_to_logits_fn: the draft model.
+    cache: the initial cache of the model.
+    draft_cache: the initial cache of the draft model.
+    decode_length: an integer.  How many timesteps to decode.
+    num_draft_tokens: an integer, the ids proposed per step.
+    eos_id: End-of-sequence symbol.
+    stop_at_eos: a boolean. Stop once every sequence has produced eos_id, and
+      output eos_id after the first one, as in fast_decode().
+
+  Returns:
+    decoded_ids: an int64 Tensor [batch_size, length].
+    tokens_per_step: a float scalar Tensor, the mean number of ids decoded
+      per call of the model.
+  """
+  batch_size = common_layers.shape_list(cache["encoder_output"])[0]
+  # ids[:, p + 1] holds the id decoded at position p and is the decoder input
+  # at position p + 1; ids[:, 0] is the first input. A step writes at most
+  # num_draft_tokens + 1 ids, starting before decode_length.
+  ids_length = decode_length + num_draft_tokens + 1
+
+  # The first id, which also starts both caches.
+  first_input = tf.zeros([batch_size, 1], dtype=tf.int64)
+  logits, cache = symbols_to_logits_fn(first_input, 0, cache)
+  _, draft_cache = draft_symbols_to_logits_fn(first_input, 0, draft_cache)
+  ids = tf.concat([first_input, tf.argmax(logits, axis=-1),
+                   tf.zeros([batch_size, ids_length - 2], dtype=tf.int64)],
+                  axis=1)
+
+  def step(i, num_steps, ids, cache, draft_cache):
+    """One step of speculative decoding, from i decoded ids."""
+    # The draft model also reads position i - 1 again, which it has not read
+    # yet if the last step kept all of its proposals.
+    draft_logits, draft_cache = draft_symbols_to_logits_fn(
+        ids[:, i - 1:i + 1], i - 1, draft_cache)
+    proposals = [tf.argmax(draft_logits[:, -1], axis=-1)]
+    for j in xrange(1, num_draft_tokens):
+      draft_logits, draft_cache = draft_symbols_to_logits_fn(
+          tf.expand_dims(proposals[-1], 1), i + j, draft_cache)
+      proposals.append(tf.argmax(draft_logits[:, -1], axis=-1))
+    proposals = tf.stack(proposals, axis=1)
+
+    logits, cache = symbols_to_logits_fn(
+        tf.concat([ids[:, i:i + 1], proposals], axis=1), i, cache)
+    greedy_ids = tf.argmax(logits, axis=-1)
+    matches = tf.to_int32(tf.equal(proposals, greedy_ids[:, :-1]))
+    num_kept = tf.reduce_min(tf.reduce_sum(tf.cumprod(matches, axis=1), 1))
+    ids = _write_ids(ids, greedy_ids, i + 1, num_kept + 1)
+    return i + num_kept + 1, num_steps + 1, ids, cache, draft_cache
+
+  def is_not_finished(i, unused_num_steps, ids, *unused_args):
+    not_finished = tf.less(i, decode_length)
+    if stop_at_eos:
+      decoded = tf.less(tf.range(ids_length), i + 1)
+      finished = tf.reduce_any(
+          tf.logical_and(tf.equal(ids, eos_id), decoded), axis=1)
+      not_finished = tf.logical_and(
+          not_finished, tf.logical_not(tf.reduce_all(finished)))
+    return not_finished
+
+  num_decoded, num_steps, ids, _, _ = tf.while_loop(
+      is_not_finished, step,
+      [tf.constant(1), tf.constant(1), ids, cache, draft_cache])
+
+  decoded_ids = ids[:, 1:decode_length + 1]
+  if stop_at_eos:
+    after_eos = tf.greater(
+        tf.cumsum(tf.to_int32(tf.equal(decoded_ids, eos_id)), axis=1,
+                  exclusive=True), 0)
+    decoded_ids = tf.where(
+        after_eos, tf.fill(tf.shape(decoded_ids),
+                           tf.constant(eos_id, dtype=tf.int64)), decoded_ids)
+    # As long as the longest sequence, up to its eos_id.
+    length = decode_length - tf.reduce_min(
+        tf.reduce_sum(tf.to_int32(after_eos), axis=1))
+    decoded_ids = decoded_ids[:, :length]
+  tokens_per_step = tf.to_float(num_decoded) / tf.to_float(num_steps)
+  return decoded_ids, tokens_per_step
+
+
+def _write_ids(ids, new_ids, start, count):
+  """Returns ids with new_ids[:, :count] written from position start on."""
+  batch_size, length = common_layers.shape_list(ids)
+  new_length = common_layers.shape_list(new_ids)[1]
+  new_ids = tf.pad(new_ids, [[0, 0], [start, length - start - new_length]])
+  positions = tf.range(length)
+  written = tf.logical_and(tf.greater_equal(positions, start),
+                           tf.less(positions, start + count))
+  return tf.where(tf.tile(tf.expand_dims(written, 0), [batch_size, 1]),
+                  new_ids, ids)
+
+
+def _draft_model(model, hparams_set):
+  """A Transformer with hparams_set for the problem of model, to predict."""
+  draft = Transformer(registry.hparams(hparams_set)(),
+                      tf.estimator.ModeKeys.PREDICT,
+                      data_parallelism=model._data_parallelism)  # pylint: disable=protected-access
+  hparams = draft.hparams
+  problem_hparams = copy.copy(model._problem_hparams)  # pylint: disable=protected-access
+  # The modalities of model are built for its hparams.
+  # pylint: disable=protected-access
+  problem_hparams.input_modality = dict(
+      (name, type(m)(hparams, m._vocab_size))
+      for name, m in six.iteritems(problem_hparams.input_modality))
+  target_modality = type(problem_hparams.target_modality)(
+      hparams, problem_hparams.target_modality._vocab_size)
+  problem_hparams.target_modality = target_modality
+  input_modality = problem_hparams.input_modality.get("inputs")
+  if input_modality and input_modality.name != target_modality.name:
+    hparams.shared_embedding_and_softmax_weights = 0
+  draft._problem_hparams = problem_hparams
+  # pylint: enable=protected-access
+  return draft
+
+
+def _local_variable_getter(getter, *args, **kwargs):
+  """Creates variables that are not saved in or restored from checkpoints."""
+  kwargs["collections"] = [tf.GraphKeys.LOCAL_VARIABLES]
+  kwargs["trainable"] = False
+  return getter(*args, **kwargs)
+
+
+def _merge_states(states, shared_states):
+  """Returns a copy of the nested dict states with shared_states added."""
+  merged = dict(states)
+  for key, value in six.iteritems(shared_states):
+    if isinstance(value, dict):
+      merged[key] = _merge_states(states.get(key, {}), value)
+    else:
+      merged[key] = value
+  return merged
+
+
+def _remove_states(states, shared_states):
+  """Inverse of _merge_states()."""
+  kept = {}
+  for key, value in six.iteritems(states):
+    if key not in shared_states:
+      kept[key] = value
+    elif isinstance(shared_states[key], dict):
+      kept[key] = _remove_states(value, shared_states[key])
+  return kept
+
+
+def _symbols_to_logits_with_shared_states(symbols_to_logits_fn, shared_states,
+                                          ids, i, states):
+  """Calls symbols_to_logits_fn with shared_states added to the states."""
+  logits, states = symbols_to_logits_fn(
+      ids, i, _merge_states(states, shared_states))
+  return logits, _remove_states(states, shared_states)
+
+
 @registry.register_model
 class TransformerEncoder(t2t_model.T2TModel):
   """Transformer, encoder only."""
@@ -636,7 +1229,8 @@ def transformer_decoder(decoder_input,
                         cache=None,
                         name="decoder",
                         nonpadding=None,
-                        save_weights_to=None):
+                        save_weights_to=None,
+                        decode_loop_step=None):
   """A stack of transformer layers.
 
   Args:
@@ -658,6 +1252,9 @@ def transformer_decoder(decoder_input,
     save_weights_to: an optional dictionary to capture attention weights
       for vizualization; the weights tensor will be appended there under
       a string key created from the variable scope (including name).
+    decode_loop_step: an optional integer Tensor, the step of a fast decoding
+      loop whose cache is preallocated.
+      See common_attention.multihead_attention().
 
   Returns:
     y: a Tensors
@@ -682,11 +1279,11 @@ def transformer_decoder(decoder_input,
               attention_type=hparams.self_attention_type,
               save_weights_to=save_weights_to,
               max_relative_position=hparams.max_relative_position,
-              cache=layer_cache)
+              cache=layer_cache,
+              decode_loop_step=decode_loop_step)
           x = common_layers.layer_postprocess(x, y, hparams)
         if encoder_output is not None:
           with tf.variable_scope("encdec_attention"):
-            # TODO(llion): Add caching.
             y = common_attention.multihead_attention(
                 common_layers.layer_preprocess(
                     x, hparams), encoder_output, encoder_decoder_attention_bias,
@@ -694,7 +1291,8 @@ def transformer_decoder(decoder_input,
                 hparams.attention_value_channels or hparams.hidden_size,
                 hparams.hidden_size, hparams.num_heads,
                 hparams.attention_dropout,
-                save_weights_to=save_weights_to)
+                save_weights_to=save_weights_to,
+                cache=layer_cache)
             x = common_layers.layer_postprocess(x, y, hparams)
         with tf.variable_scope("ffn"):
           y = transformer_ffn_layer(
@@ -825,6 +1423,23 @@ def transformer_base_v1():
   hparams.add_hparam("use_pad_remover", True)
   hparams.add_hparam("self_attention_type", "dot_product")
   hparams.add_hparam("max_relative_position", 0)
+  # Preallocate the self-attention cache in fast greedy decoding, without
+  # skip_finished_decodes, and write it in place.
+  hparams.add_hparam("preallocate_decode_cache", False)
+  # In fast greedy decoding, stop computing sequences that have ended.
+  hparams.add_hparam("skip_finished_decodes", False)
+  # In fast beam search, keep one copy of the encoder output per input rather
+  # than one per beam.
+  hparams.add_hparam("share_encoder_across_beams", False)
+  # In fast beam search, keep back-pointers instead of whole sequences.
+  hparams.add_hparam("beam_search_back_pointers", False)
+  # In fast decoding, compute logits only over a shortlist of this many
+  # frequent target ids, plus the source ids if the vocabulary is shared.
+  # 0 means the whole vocabulary.
+  hparams.add_hparam("vocab_shortlist_size", 0)
+  # File of the frequent target ids, one per line, most frequent first.
+  # Defaults to the lowest ids.
+  hparams.add_hparam("vocab_shortlist_file", "")
   return hparams
 
 
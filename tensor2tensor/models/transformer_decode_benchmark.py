@@ -0,0 +1,156 @@
+# coding=utf-8
+# Copyright 2017 The Tensor2Tensor Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+r"""Benchmark for Transformer fast decoding.
+
+Times greedy transformer.fast_decode with a randomly initialized decoder, with
+a growing self-attention cache (concatenating every step) and with a
+preallocated one written in place, and reports decoded tokens per second for
+each decode length.
+
+Example usage:
+
+python models/transformer_decode_benchmark.py \
+    --hparams_set=transformer_small \
+    --decode_lengths=64,128,256,512,1024 \
+    --logtostderr
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import time
+
+# Dependency imports
+
+from six.moves import xrange  # pylint: disable=redefined-builtin
+from tensor2tensor.layers import common_attention
+from tensor2tensor.models import transformer
+from tensor2tensor.utils import registry
+
+import tensorflow as tf
+
+tf.flags.DEFINE_string("hparams_set", "transformer_small",
+                       "Hyperparameters of the decoder.")
+tf.flags.DEFINE_string("hparams", "", "Overrides for --hparams_set.")
+tf.flags.DEFINE_string("decode_lengths", "64,128,256,512,1024",
+                       "Comma-separated decode lengths to time.")
+tf.flags.DEFINE_integer("batch_size", 8, "Sequences decoded at once.")
+tf.flags.DEFINE_integer("input_length", 32, "Length of the encoder output.")
+tf.flags.DEFINE_integer("vocab_size", 8192, "Output vocabulary size.")
+tf.flags.DEFINE_integer("num_repeats", 3, "Timed runs per configuration.")
+tf.flags.DEFINE_bool("use_gpu", False, "Whether to let TensorFlow use a GPU.")
+FLAGS = tf.flags.FLAGS
+
+
+def benchmark_hparams():
+  hparams = registry.hparams(FLAGS.hparams_set)()
+  hparams.parse(FLAGS.hparams)
+  hparams.layer_prepostprocess_dropout = 0.0
+  hparams.attention_dropout = 0.0
+  hparams.relu_dropout = 0.0
+  return hparams
+
+
+def build_fast_decode(hparams, batch_size, input_length, decode_length,
+                      vocab_size, preallocate_cache, **kwargs):
+  """Builds greedy fast decoding with a random encoder output.
+
+  Variables are created under the current variable scope, which should allow
+  reuse so that all configurations share one decoder.
+
+  Args:
+    hparams: decoder hyperparameters.
+    batch_size: an integer.
+    input_length: an integer, length of the encoder output.
+    decode_length: an integer.
+    vocab_size: an integer.
+    preallocate_cache: a boolean, passed to transformer.fast_decode.
+    **kwargs: further arguments to transformer.fast_decode.
+
+  Returns:
+    the decoded ids, a Tensor of shape [batch_size, decode_length].
+  """
+  hidden_size = hparams.hidden_size
+  encoder_output = tf.random_normal([batch_size, input_length, hidden_size])
+  encoder_decoder_attention_bias = tf.zeros([batch_size, 1, 1, input_length])
+  embedding = tf.get_variable("embedding", [vocab_size, hidden_size])
+  timing_signal = common_attention.get_timing_signal_1d(
+      decode_length + 1, hidden_size)
+  self_attention_bias = common_attention.attention_bias_lower_triangle(
+      decode_length)
+
+  def symbols_to_logits_fn(ids, i, cache):
+    targets = tf.gather(embedding, ids[:, -1:]) + timing_signal[:, i:i + 1]
+    if preallocate_cache:
+      bias = self_attention_bias[:, :, i:i + 1, :]
+      decode_loop_step = i
+    else:
+      bias = self_attention_bias[:, :, i:i + 1, :i + 1]
+      decode_loop_step = None
+    x = transformer.transformer_decoder(
+        targets, cache["encoder_output"], bias,
+        cache["encoder_decoder_attention_bias"], hparams, cache=cache,
+        decode_loop_step=decode_loop_step)
+    return tf.matmul(x[:, 0, :], embedding, transpose_b=True), cache
+
+  decoded_ids, _ = transformer.fast_decode(
+      encoder_output, encoder_decoder_attention_bias, symbols_to_logits_fn,
+      hparams, decode_length, vocab_size,
+      preallocate_cache=preallocate_cache, **kwargs)
+  return decoded_ids
+
+
+def time_run(sess, fetch, num_repeats):
+  """Returns the best wall time of num_repeats runs of fetch, after warm up."""
+  sess.run(fetch)
+  best = None
+  for _ in xrange(num_repeats):
+    start = time.time()
+    sess.run(fetch)
+    elapsed = time.time() - start
+    best = elapsed if best is None else min(best, elapsed)
+  return best
+
+
+def main(unused_argv):
+  hparams = benchmark_hparams()
+  decode_lengths = [int(l) for l in FLAGS.decode_lengths.split(",")]
+  fetches = {}
+  with tf.variable_scope("benchmark", reuse=tf.AUTO_REUSE):
+    for decode_length in decode_lengths:
+      for preallocate_cache in [False, True]:
+        fetches[decode_length, preallocate_cache] = build_fast_decode(
+            hparams, FLAGS.batch_size, FLAGS.input_length, decode_length,
+            FLAGS.vocab_size, preallocate_cache)
+
+  config = tf.ConfigProto(device_count={"GPU": 1 if FLAGS.use_gpu else 0})
+  with tf.Session(config=config) as sess:
+    sess.run(tf.global_variables_initializer())
+    for decode_length in decode_lengths:
+      num_tokens = FLAGS.batch_size * decode_length
+      concat_time = time_run(sess, fetches[decode_length, False],
+                             FLAGS.num_repeats)
+      prealloc_time = time_run(sess, fetches[decode_length, True],
+                               FLAGS.num_repeats)
+      tf.logging.info(
+          "decode_length %4d: concat %8.1f tokens/sec, "
+          "preallocated %8.1f tokens/sec (%.2fx)",
+          decode_length, num_tokens / concat_time, num_tokens / prealloc_time,
+          concat_time / prealloc_time)
+
+
+if __name__ == "__main__":
+  tf.app.run()
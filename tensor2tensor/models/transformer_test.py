@@ -149,6 +149,174 @@ class TransformerTest(tf.test.TestCase):
     self.assertEqual(fast_res.shape, (BATCH_SIZE, INPUT_LENGTH + decode_length))
     self.assertAllClose(beam_res, fast_res)
 
+  def testFastPreallocatedCache(self):
+    model, features = self.getModel(transformer.transformer_small(),
+                                    mode=tf.estimator.ModeKeys.PREDICT)
+    decode_length = 3
+
+    with tf.variable_scope(tf.get_variable_scope()):
+      fast_result, _, _ = model._greedy_infer(features, decode_length)
+    model._hparams.preallocate_decode_cache = True
+    with tf.variable_scope(tf.get_variable_scope(), reuse=True):
+      prealloc_result, _, _ = model._greedy_infer(features, decode_length)
+      # Beam search ignores the hparam.
+      prealloc_beam_result = model._beam_decode(
+          features, decode_length, beam_size=4, top_beams=1,
+          alpha=1.0)["outputs"]
+
+    with self.test_session():
+      tf.global_variables_initializer().run()
+      fast_res = fast_result.eval()
+      prealloc_res = prealloc_result.eval()
+      # The cache is written in place; a second run gives the same decodes.
+      prealloc_res2 = prealloc_result.eval()
+      prealloc_beam_res = prealloc_beam_result.eval()
+
+    self.assertEqual(prealloc_res.shape,
+                     (BATCH_SIZE, INPUT_LENGTH + decode_length))
+    self.assertAllEqual(fast_res, prealloc_res)
+    self.assertAllEqual(prealloc_res, prealloc_res2)
+    self.assertEqual(prealloc_beam_res.shape,
+                     (BATCH_SIZE, INPUT_LENGTH + decode_length))
+
+  def testBeamShareEncoderAcrossBeams(self):
+    model, features = self.getModel(transformer.transformer_small(),
+                                    mode=tf.estimator.ModeKeys.PREDICT)
+    decode_length = 3
+
+    with tf.variable_scope(tf.get_variable_scope()):
+      tiled = model._beam_decode(features, decode_length, beam_size=4,
+                                 top_beams=2, alpha=1.0)
+    model._hparams.share_encoder_across_beams = True
+    with tf.variable_scope(tf.get_variable_scope(), reuse=True):
+      shared = model._beam_decode(features, decode_length, beam_size=4,
+                                  top_beams=2, alpha=1.0)
+
+    with self.test_session() as session:
+      session.run(tf.global_variables_initializer())
+      tiled_res, shared_res = session.run([tiled, shared])
+
+    self.assertAllEqual(tiled_res["outputs"], shared_res["outputs"])
+    self.assertAllClose(tiled_res["scores"], shared_res["scores"])
+
+  def testBeamSearchBackPointers(self):
+    model, features = self.getModel(transformer.transformer_small(),
+                                    mode=tf.estimator.ModeKeys.PREDICT)
+    decode_length = 3
+
+    with tf.variable_scope(tf.get_variable_scope()):
+      gathered = model._beam_decode(features, decode_length, beam_size=4,
+                                    top_beams=2, alpha=1.0)
+    model._hparams.beam_search_back_pointers = True
+    with tf.variable_scope(tf.get_variable_scope(), reuse=True):
+      back_pointers = model._beam_decode(features, decode_length, beam_size=4,
+                                         top_beams=2, alpha=1.0)
+
+    with self.test_session() as session:
+      session.run(tf.global_variables_initializer())
+      gathered_res, back_pointers_res = session.run([gathered, back_pointers])
+
+    self.assertAllEqual(gathered_res["outputs"], back_pointers_res["outputs"])
+    self.assertAllClose(gathered_res["scores"], back_pointers_res["scores"])
+
+  def testVocabShortlist(self):
+    model, features = self.getModel(transformer.transformer_small(),
+                                    mode=tf.estimator.ModeKeys.PREDICT)
+    decode_length = 3
+
+    with tf.variable_scope(tf.get_variable_scope()):
+      full_greedy, _, _ = model._greedy_infer(features, decode_length)
+      full_beam = model._beam_decode(features, decode_length, beam_size=4,
+                                     top_beams=2, alpha=1.0)
+    # A shortlist of the whole vocabulary decodes the same.
+    model._hparams.vocab_shortlist_size = VOCAB_SIZE
+    with tf.variable_scope(tf.get_variable_scope(), reuse=True):
+      shortlist_greedy, _, _ = model._greedy_infer(features, decode_length)
+      shortlist_beam = model._beam_decode(features, decode_length, beam_size=4,
+                                          top_beams=2, alpha=1.0)
+    # A short one only decodes shortlisted ids.
+    model._hparams.vocab_shortlist_size = 3
+    with tf.variable_scope(tf.get_variable_scope(), reuse=True):
+      short_greedy, _, _ = model._greedy_infer(features, decode_length)
+
+    with self.test_session() as session:
+      session.run(tf.global_variables_initializer())
+      res = session.run([full_greedy, full_beam, shortlist_greedy,
+                         shortlist_beam, short_greedy, features["inputs"]])
+    (full_greedy, full_beam, shortlist_greedy, shortlist_beam, short_greedy,
+     inputs) = res
+
+    self.assertAllEqual(full_greedy, shortlist_greedy)
+    self.assertAllEqual(full_beam["outputs"], shortlist_beam["outputs"])
+    self.assertAllClose(full_beam["scores"], shortlist_beam["scores"])
+    for row, source in zip(short_greedy, inputs):
+      self.assertTrue(set(row) <= set(range(3)) | set(source.flatten()))
+
+  def testSpeculativeDecode(self):
+    model, features = self.getModel(transformer.transformer_small(),
+                                    mode=tf.estimator.ModeKeys.PREDICT)
+    decode_length = 5
+
+    with tf.variable_scope(tf.get_variable_scope()):
+      greedy_result, _, _ = model._greedy_infer(features, decode_length)
+    model._decode_hparams.draft_hparams_set = "transformer_tiny"
+    speculative_results = []
+    for num_draft_tokens in [1, 3]:
+      model._decode_hparams.num_draft_tokens = num_draft_tokens
+      with tf.variable_scope(tf.get_variable_scope(), reuse=True):
+        speculative_results.append(
+            model._greedy_infer(features, decode_length)[0])
+    tokens_per_step = model.decode_stats["tokens_per_step"]
+
+    with self.test_session() as session:
+      session.run([tf.global_variables_initializer(),
+                   tf.local_variables_initializer()])
+      greedy_res, speculative_res, tokens_per_step = session.run(
+          [greedy_result, speculative_results, tokens_per_step])
+
+    # An untrained draft model proposes badly, but the decodes are the same.
+    for res in speculative_res:
+      self.assertAllEqual(greedy_res, res)
+    self.assertEqual(tokens_per_step.shape, (BATCH_SIZE,))
+    self.assertTrue(np.all(tokens_per_step >= 1.0))
+
+  def testGreedyFastStopAtEos(self):
+    hparams = transformer.transformer_small()
+    hparams.hidden_size = 8
+    hparams.num_heads = 1
+    eos_id = 1
+    # Row b produces eos_id from step stop_steps[b] on, and 2 before that.
+    stop_steps = [1, 3, 2]
+    encoder_output = tf.tile(
+        tf.reshape(tf.constant(stop_steps, dtype=tf.float32), [3, 1, 1]),
+        [1, 2, hparams.hidden_size])
+
+    def symbols_to_logits_fn(unused_ids, i, cache):
+      stop = tf.to_int32(cache["encoder_output"][:, 0, 0])
+      next_id = tf.where(tf.greater_equal(i, stop),
+                         tf.fill(tf.shape(stop), eos_id),
+                         tf.fill(tf.shape(stop), 2))
+      return tf.one_hot(next_id, VOCAB_SIZE), cache
+
+    results = []
+    for skip_finished in [False, True]:
+      with tf.variable_scope("decode", reuse=tf.AUTO_REUSE):
+        decoded_ids, _ = transformer.fast_decode(
+            encoder_output, tf.zeros([3, 1, 1, 2]), symbols_to_logits_fn,
+            hparams, decode_length=10, vocab_size=VOCAB_SIZE, eos_id=eos_id,
+            stop_at_eos=True, skip_finished=skip_finished)
+      results.append(decoded_ids)
+
+    with self.test_session() as session:
+      session.run(tf.global_variables_initializer())
+      results = session.run(results)
+
+    expected = [[2, 1, 1, 1],
+                [2, 2, 2, 1],
+                [2, 2, 1, 1]]
+    for res in results:
+      self.assertAllEqual(expected, res)
+
   def testTransformerWithoutProblem(self):
     hparams = transformer.transformer_test()
 
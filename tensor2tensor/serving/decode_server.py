@@ -0,0 +1,778 @@
+# coding=utf-8
+# Copyright 2017 The Tensor2Tensor Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""In-process batching decode servers.
+
+A FastDecodeSession keeps a tf.Session with a model's inference graph (fast
+decoding for the Transformer) open across requests. A BatchingDecoder sits in
+front of it: requests are queued by input length bucket and a bucket is
+decoded, padded to its boundary, as soon as it holds max_batch_size requests
+or its oldest request has waited max_wait_secs. Batches of different buckets
+run concurrently on num_threads workers, so a short request only overtakes a
+long one while a worker is free; once all workers are busy with long batches,
+it waits for one of them to finish.
+
+This is batching per dispatch: a batch is one run of the model's decode loop,
+which stops when its last sequence finishes (or hits the decode length). All
+the requests of a batch are answered together when it ends, so a request that
+finishes early still waits for the longest output of its batch, and requests
+arriving meanwhile cannot join it.
+
+A ContinuousBatchingDecoder batches per decoding step instead. Its
+StepwiseDecodeSession keeps the decoding state of num_slots sequences (their
+self-attention caches, encoder-decoder attention keys and values and
+positions) in variables of the session, and runs one decoding position for
+all of them per step. A request is answered as soon as it emits EOS, and its
+slot is given to a waiting request before the next step, so requests only
+wait for each other while all slots are busy, and never for longer than it
+takes a slot to free up.
+
+make_http_server puts a small JSON HTTP front end on top:
+
+  POST /decode   {"inputs": "some text"} or {"input_ids": [4, 7, 1]}
+  GET  /metrics  latency percentiles and throughput since start (or reset)
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import bisect
+import collections
+import json
+import threading
+import time
+
+# Dependency imports
+
+import numpy as np
+
+import six
+from six.moves import BaseHTTPServer
+from six.moves import socketserver
+from six.moves import xrange  # pylint: disable=redefined-builtin
+
+from tensor2tensor.data_generators import text_encoder
+from tensor2tensor.layers import common_attention
+from tensor2tensor.layers import common_layers
+from tensor2tensor.models import transformer
+from tensor2tensor.utils import decoding
+from tensor2tensor.utils import registry
+
+import tensorflow as tf
+
+
+def default_bucket_boundaries(max_length=256, min_length=8):
+  """Input length bucket boundaries, doubling from min_length to max_length."""
+  boundaries = []
+  x = min_length
+  while x <= max_length:
+    boundaries.append(x)
+    x *= 2
+  return boundaries
+
+
+class DecodeMetrics(object):
+  """Thread-safe latency and throughput counters for a decode server.
+
+  Request and token counts cover everything since construction or the last
+  reset, while latency percentiles cover the last window requests only, so
+  memory stays bounded in a long-running server. A batch is one decode run of
+  a BatchingDecoder, or one step of a ContinuousBatchingDecoder, whose mean
+  batch size is then the mean number of busy slots.
+  """
+
+  def __init__(self, window=10000):
+    self._lock = threading.Lock()
+    self._window = window
+    self.reset()
+
+  def reset(self):
+    with self._lock:
+      self._start_time = time.time()
+      self._latencies = collections.deque(maxlen=self._window)
+      self._num_requests = 0
+      self._num_tokens = 0
+      self._num_batches = 0
+      self._num_batched_requests = 0
+
+  def record_batch(self, batch_size):
+    with self._lock:
+      self._num_batches += 1
+      self._num_batched_requests += batch_size
+
+  def record_request(self, latency, num_tokens):
+    with self._lock:
+      self._latencies.append(latency)
+      self._num_requests += 1
+      self._num_tokens += num_tokens
+
+  def summary(self):
+    """Returns a dict of metrics since construction or the last reset."""
+    with self._lock:
+      elapsed = max(time.time() - self._start_time, 1e-9)
+      latencies = np.array(self._latencies or [0.0])
+      return {
+          "requests": self._num_requests,
+          "tokens": self._num_tokens,
+          "batches": self._num_batches,
+          "mean_batch_size": (float(self._num_batched_requests) /
+                              max(self._num_batches, 1)),
+          "latency_p50": float(np.percentile(latencies, 50)),
+          "latency_p99": float(np.percentile(latencies, 99)),
+          "requests_per_sec": self._num_requests / elapsed,
+          "tokens_per_sec": self._num_tokens / elapsed,
+      }
+
+
+class DecodeRequest(object):
+  """A pending decode, resolved by the BatchingDecoder."""
+
+  def __init__(self, input_ids):
+    self.input_ids = list(input_ids)
+    self.arrival_time = time.time()
+    self._done = threading.Event()
+    self._output_ids = None
+    self._error = None
+
+  def set_result(self, output_ids=None, error=None):
+    self._output_ids = output_ids
+    self._error = error
+    self._done.set()
+
+  def result(self, timeout=None):
+    """Waits for and returns the output ids.
+
+    Args:
+      timeout: seconds to wait, or None to wait until the request is decoded.
+
+    Returns:
+      a list of output ids, or a list of them per beam.
+
+    Raises:
+      ValueError: if the request was not decoded within timeout.
+      Exception: whatever the decode function raised for this request's batch.
+    """
+    if not self._done.wait(timeout):
+      raise ValueError("Decode request timed out after %s secs." % timeout)
+    if self._error is not None:
+      raise self._error  # pylint: disable=raising-bad-type
+    return self._output_ids
+
+
+class BatchingDecoder(object):
+  """Batches concurrent decode requests by input length.
+
+  decode_fn is called from worker threads with an int32 numpy array of shape
+  [batch_size, padded_length] and must return one sequence of output ids, or
+  a list of them per beam, per row. Rows are padded with pad_id up to the bucket boundary of the longest
+  input, so that decode_fn sees a small set of shapes.
+  """
+
+  def __init__(self,
+               decode_fn,
+               max_batch_size=32,
+               max_wait_secs=0.01,
+               bucket_boundaries=None,
+               num_threads=2,
+               pad_id=text_encoder.PAD_ID,
+               metrics=None):
+    self._decode_fn = decode_fn
+    self._max_batch_size = max_batch_size
+    self._max_wait_secs = max_wait_secs
+    self._boundaries = sorted(bucket_boundaries or default_bucket_boundaries())
+    self._pad_id = pad_id
+    self.metrics = metrics or DecodeMetrics()
+    # One extra bucket for inputs longer than the last boundary.
+    self._buckets = [collections.deque()
+                     for _ in xrange(len(self._boundaries) + 1)]
+    self._cond = threading.Condition()
+    self._closed = False
+    self._threads = []
+    for i in xrange(num_threads):
+      thread = threading.Thread(
+          target=self._worker, name="batching_decoder_%d" % i)
+      thread.daemon = True
+      thread.start()
+      self._threads.append(thread)
+
+  def submit(self, input_ids):
+    """Queues input_ids for decoding and returns a DecodeRequest."""
+    request = DecodeRequest(input_ids)
+    bucket = bisect.bisect_left(self._boundaries, len(request.input_ids))
+    with self._cond:
+      if self._closed:
+        raise ValueError("BatchingDecoder is closed.")
+      self._buckets[bucket].append(request)
+      self._cond.notify_all()
+    return request
+
+  def decode(self, input_ids, timeout=None):
+    """Decodes input_ids, blocking until its batch is done."""
+    return self.submit(input_ids).result(timeout)
+
+  def close(self):
+    """Decodes the requests still queued and stops the worker threads."""
+    with self._cond:
+      self._closed = True
+      self._cond.notify_all()
+    for thread in self._threads:
+      thread.join()
+
+  def _next_batch_locked(self):
+    """Returns (batch, None) if a bucket is ready, else (None, secs to wait)."""
+    now = time.time()
+    ready = None
+    wait = None
+    for bucket in self._buckets:
+      if not bucket:
+        continue
+      waited = now - bucket[0].arrival_time
+      if (self._closed or len(bucket) >= self._max_batch_size or
+          waited >= self._max_wait_secs):
+        # Serve the bucket whose oldest request has waited longest.
+        if ready is None or bucket[0].arrival_time < ready[0].arrival_time:
+          ready = bucket
+      else:
+        remaining = self._max_wait_secs - waited
+        wait = remaining if wait is None else min(wait, remaining)
+    if ready is None:
+      return None, wait
+    batch = [ready.popleft()
+             for _ in xrange(min(len(ready), self._max_batch_size))]
+    return batch, None
+
+  def _worker(self):
+    while True:
+      with self._cond:
+        while True:
+          batch, wait = self._next_batch_locked()
+          if batch or (self._closed and wait is None):
+            break
+          self._cond.wait(wait)
+      if not batch:
+        return
+      self._run_batch(batch)
+
+  def _padded_length(self, max_length):
+    bucket = bisect.bisect_left(self._boundaries, max_length)
+    if bucket < len(self._boundaries):
+      return self._boundaries[bucket]
+    return max_length
+
+  def _run_batch(self, batch):
+    """Decodes one batch and resolves all its requests when it is done."""
+    max_length = max(len(r.input_ids) for r in batch)
+    inputs = np.full([len(batch), self._padded_length(max_length)],
+                     self._pad_id, dtype=np.int32)
+    for i, request in enumerate(batch):
+      inputs[i, :len(request.input_ids)] = request.input_ids
+    self.metrics.record_batch(len(batch))
+    try:
+      outputs = self._decode_fn(inputs)
+    except Exception as e:  # pylint: disable=broad-except
+      tf.logging.error("Decoding a batch of %d failed: %s", len(batch), e)
+      for request in batch:
+        request.set_result(error=e)
+      return
+    now = time.time()
+    for request, output_ids in zip(batch, outputs):
+      if len(output_ids) and np.ndim(output_ids[0]):
+        output_ids = [[int(t) for t in beam] for beam in output_ids]
+        num_tokens = sum(len(beam) for beam in output_ids)
+      else:
+        output_ids = [int(t) for t in output_ids]
+        num_tokens = len(output_ids)
+      request.set_result(output_ids)
+      self.metrics.record_request(now - request.arrival_time, num_tokens)
+
+
+class FastDecodeSession(object):
+  """A persistent session running a model's inference graph.
+
+  The graph takes a batch of padded input ids and returns the greedy or beam
+  search decodes given by decode_hp, so a Transformer decodes with
+  fast_decode. Calling the session decodes one batch, and it can be called
+  from several threads at once.
+  """
+
+  def __init__(self, model_name, hparams, decode_hp, checkpoint_path=None,
+               problem_idx=0, config=None):
+    """Builds the inference graph and restores the model.
+
+    Args:
+      model_name: a registered model name, e.g. "transformer".
+      hparams: model hyperparameters, with problem hparams added.
+      decode_hp: decoding hyperparameters, see decoding.decode_hparams.
+      checkpoint_path: checkpoint to restore. If None, the model is randomly
+        initialized, which is only useful for benchmarking.
+      problem_idx: index of the problem in hparams.problems to decode.
+      config: an optional tf.ConfigProto for the session.
+    """
+    self._graph = tf.Graph()
+    with self._graph.as_default():
+      self._inputs = tf.placeholder(tf.int32, [None, None], name="inputs")
+      features = decoding._decode_input_tensor_to_features_dict(  # pylint: disable=protected-access
+          {"inputs": self._inputs,
+           "problem_choice": tf.constant(problem_idx)}, hparams)
+      model = registry.model(model_name)(
+          hparams, tf.estimator.ModeKeys.PREDICT,
+          problem_hparams=hparams.problems[problem_idx],
+          decode_hparams=decode_hp)
+      self._outputs = model.estimator_spec_predict(
+          features).predictions["outputs"]
+      self._session = tf.Session(graph=self._graph, config=config)
+      if checkpoint_path:
+        tf.train.Saver().restore(self._session, checkpoint_path)
+      else:
+        tf.logging.warning("No checkpoint given, decoding with random weights.")
+        self._session.run(tf.global_variables_initializer())
+    self._graph.finalize()
+
+  def __call__(self, input_ids):
+    """Decodes a batch of padded input ids.
+
+    Args:
+      input_ids: an int32 numpy array of shape [batch_size, length].
+
+    Returns:
+      a list with one output id array per row, cut at the first EOS, or with
+      decode_hp.return_beams one list of such arrays per row, one per beam.
+    """
+    outputs = self._session.run(self._outputs, {self._inputs: input_ids})
+    save_until_eos = decoding._save_until_eos  # pylint: disable=protected-access
+    if outputs.ndim == 3:
+      # [batch_size, beams, length]
+      return [[save_until_eos(beam, False) for beam in row] for row in outputs]
+    return [save_until_eos(row, False) for row in outputs]
+
+  def close(self):
+    self._session.close()
+
+
+class StepwiseDecodeSession(object):
+  """A persistent session decoding a Transformer one position at a time.
+
+  The decoding state of num_slots sequences lives in local variables of the
+  session: the self-attention caches of all decoder layers, preallocated for
+  max_decode_length positions and split into heads, the encoder-decoder
+  attention keys and values and bias, and the position and last output of
+  each slot. The graph has two ops on them:
+
+    admit: encodes inputs into some slots and rewinds them to position 0.
+    step: greedily decodes the next position of every slot, writing its keys
+      and values into the slot's cache at the slot's own position.
+
+  So a slot can take a new request as soon as its previous one is done,
+  while the other slots carry on (see ContinuousBatchingDecoder). Idle slots
+  are stepped too and their outputs ignored. Calls must not overlap.
+  """
+
+  def __init__(self, model_name, hparams, decode_hp, num_slots=32,
+               max_input_length=256, checkpoint_path=None, problem_idx=0,
+               config=None):
+    """Builds the admit and step graphs and restores the model.
+
+    Args:
+      model_name: a registered Transformer model name, e.g. "transformer".
+      hparams: model hyperparameters, with problem hparams added.
+      decode_hp: decoding hyperparameters, see decoding.decode_hparams. Only
+        greedy decoding (beam_size=1) is supported; every sequence can decode
+        max_input_length + decode_hp.extra_length positions at most.
+      num_slots: the number of sequences decoded together.
+      max_input_length: the longest input that can be admitted.
+      checkpoint_path: checkpoint to restore. If None, the model is randomly
+        initialized, which is only useful for benchmarking.
+      problem_idx: index of the problem in hparams.problems to decode.
+      config: an optional tf.ConfigProto for the session.
+
+    Raises:
+      ValueError: if the model is not a Transformer or decode_hp or hparams
+        ask for something step-wise decoding does not support.
+    """
+    if decode_hp.beam_size > 1:
+      raise ValueError("Step-wise decoding is greedy, set beam_size=1.")
+    self.num_slots = num_slots
+    self.max_input_length = max_input_length
+    self.max_decode_length = max_input_length + decode_hp.extra_length
+    self._graph = tf.Graph()
+    with self._graph.as_default():
+      model = registry.model(model_name)(
+          hparams, tf.estimator.ModeKeys.PREDICT,
+          problem_hparams=hparams.problems[problem_idx],
+          decode_hparams=decode_hp)
+      if not isinstance(model, transformer.Transformer):
+        raise ValueError("Step-wise decoding needs a Transformer, not %s." %
+                         model_name)
+      if model.hparams.proximity_bias:
+        raise ValueError("Step-wise decoding does not support proximity_bias.")
+      self._slot_ids = tf.placeholder(tf.int32, [None], name="slot_ids")
+      self._inputs = tf.placeholder(tf.int32, [None, None], name="inputs")
+      with tf.variable_scope("decode_slots"):
+        self._create_slots(model.hparams)
+      # The same variable scopes as Transformer._fast_decode(), so that the
+      # model variables have the names of the checkpoint.
+      with tf.variable_scope(model.name):
+        features = decoding._decode_input_tensor_to_features_dict(  # pylint: disable=protected-access
+            {"inputs": self._inputs,
+             "problem_choice": tf.constant(problem_idx)}, hparams)
+        self._admit_op = self._build_admit(model, features)
+        self._next_ids, self._step_op = self._build_step(model)
+      self._session = tf.Session(graph=self._graph, config=config)
+      self._session.run(tf.local_variables_initializer())
+      if checkpoint_path:
+        tf.train.Saver().restore(self._session, checkpoint_path)
+      else:
+        tf.logging.warning("No checkpoint given, decoding with random weights.")
+        self._session.run(tf.global_variables_initializer())
+    self._graph.finalize()
+
+  def _create_slots(self, hparams):
+    """Creates the local variables holding the state of the slots."""
+
+    def slot_variable(name, shape, dtype=tf.float32):
+      # Local variables are neither trained nor saved.
+      return tf.get_variable(
+          name, shape, dtype, initializer=tf.zeros_initializer(),
+          trainable=False, collections=[tf.GraphKeys.LOCAL_VARIABLES])
+
+    heads = hparams.num_heads
+    key_depth = (hparams.attention_key_channels or hparams.hidden_size) // heads
+    value_depth = (
+        hparams.attention_value_channels or hparams.hidden_size) // heads
+    self._cache = {}
+    for layer in xrange(hparams.num_decoder_layers or
+                        hparams.num_hidden_layers):
+      layer_name = "layer_%d" % layer
+      with tf.variable_scope(layer_name):
+        self._cache[layer_name] = {
+            "k": slot_variable(
+                "k", [self.num_slots, heads, self.max_decode_length,
+                      key_depth]),
+            "v": slot_variable(
+                "v", [self.num_slots, heads, self.max_decode_length,
+                      value_depth]),
+            "k_encdec": slot_variable(
+                "k_encdec", [self.num_slots, heads, self.max_input_length,
+                             key_depth]),
+            "v_encdec": slot_variable(
+                "v_encdec", [self.num_slots, heads, self.max_input_length,
+                             value_depth]),
+        }
+    self._encoder_decoder_attention_bias = slot_variable(
+        "encoder_decoder_attention_bias",
+        [self.num_slots, 1, 1, self.max_input_length])
+    self._positions = slot_variable("positions", [self.num_slots], tf.int32)
+    self._last_ids = slot_variable("last_ids", [self.num_slots], tf.int32)
+
+  def _build_admit(self, model, features):
+    """Returns the op encoding self._inputs into the slots self._slot_ids."""
+    # pylint: disable=protected-access
+    encoder_output, encoder_decoder_attention_bias = (
+        model._encode_for_decoding(features))
+    encdec_cache = model._encdec_attention_cache(encoder_output)
+    # pylint: enable=protected-access
+    # Inputs are padded to max_input_length; the bias masks the padding.
+    padding = (self.max_input_length -
+               common_layers.shape_list(encoder_output)[1])
+    updates = [tf.scatter_update(
+        self._encoder_decoder_attention_bias, self._slot_ids,
+        tf.pad(encoder_decoder_attention_bias,
+               [[0, 0], [0, 0], [0, 0], [0, padding]],
+               constant_values=-1e9))]
+    for layer_name, layer_cache in six.iteritems(encdec_cache):
+      for key, value in six.iteritems(layer_cache):
+        updates.append(tf.scatter_update(
+            self._cache[layer_name][key], self._slot_ids,
+            tf.pad(value, [[0, 0], [0, 0], [0, padding], [0, 0]])))
+    # The self-attention cache needs no reset: the bias masks the positions
+    # the new sequence has not written yet.
+    zeros = tf.zeros_like(self._slot_ids)
+    updates.append(tf.scatter_update(self._positions, self._slot_ids, zeros))
+    updates.append(tf.scatter_update(self._last_ids, self._slot_ids, zeros))
+    return tf.group(*updates)
+
+  def _build_step(self, model):
+    """Returns the next ids of all slots and the op advancing the slots."""
+    # pylint: disable=protected-access
+    dp = model._data_parallelism
+    hparams = model.hparams
+    target_modality = model._problem_hparams.target_modality
+    length = self.max_decode_length
+
+    positions = tf.identity(self._positions)
+    # The embedding of id 0, the input of position 0, is zeros.
+    targets = tf.reshape(self._last_ids, [self.num_slots, 1, 1, 1])
+    targets = model._shard_features({"targets": targets})["targets"]
+    # pylint: enable=protected-access
+    with tf.variable_scope(target_modality.name):
+      targets = target_modality.targets_bottom_sharded(targets, dp)[0]
+    targets = common_layers.flatten4d3d(targets)
+    if hparams.pos == "timing":
+      timing_signal = common_attention.get_timing_signal_1d(
+          length, hparams.hidden_size)
+      targets += tf.expand_dims(tf.gather(timing_signal[0], positions), 1)
+
+    # Each slot attends to the positions up to its own.
+    future = tf.greater(tf.expand_dims(tf.range(length), 0),
+                        tf.expand_dims(positions, 1))
+    decoder_self_attention_bias = tf.reshape(
+        tf.to_float(future) * -1e9, [self.num_slots, 1, 1, length])
+    # The encoder-decoder attention only reads the cache, but the decoder
+    # needs an encoder output to build it.
+    encoder_output = tf.zeros([self.num_slots, 1, hparams.hidden_size])
+    cache = {layer_name: dict(layer_cache)
+             for layer_name, layer_cache in six.iteritems(self._cache)}
+    with tf.variable_scope("body"):
+      body_outputs = dp(
+          model.decode, targets, encoder_output,
+          self._encoder_decoder_attention_bias, decoder_self_attention_bias,
+          hparams, cache, decode_loop_step=positions)
+    with tf.variable_scope(target_modality.name):
+      logits = target_modality.top_sharded(body_outputs, None, dp)[0]
+    next_ids = tf.to_int32(
+        tf.argmax(tf.reshape(logits, [self.num_slots, -1]), axis=-1))
+
+    # Everything reading the slots is upstream of next_ids.
+    with tf.control_dependencies([next_ids]):
+      step_op = tf.group(
+          tf.assign(self._last_ids, next_ids),
+          tf.assign(self._positions, tf.minimum(positions + 1, length - 1)))
+    return next_ids, step_op
+
+  def admit(self, slot_ids, input_ids):
+    """Starts decoding input_ids in the slots slot_ids.
+
+    Args:
+      slot_ids: an int32 numpy array of shape [n], distinct slots.
+      input_ids: an int32 numpy array of shape [n, length], padded inputs
+        with length <= max_input_length.
+    """
+    self._session.run(self._admit_op, {self._slot_ids: slot_ids,
+                                       self._inputs: input_ids})
+
+  def step(self):
+    """Decodes one position of all slots; returns their ids, [num_slots]."""
+    next_ids, _ = self._session.run([self._next_ids, self._step_op])
+    return next_ids
+
+  def close(self):
+    self._session.close()
+
+
+class ContinuousBatchingDecoder(object):
+  """Decodes requests step by step in the slots of a StepwiseDecodeSession.
+
+  session may also be any object with the num_slots, max_input_length and
+  max_decode_length attributes and the admit and step methods of a
+  StepwiseDecodeSession. A scheduler thread alternates between admitting
+  waiting requests into free slots and running one step for all slots. A
+  request is answered as soon as it emits eos_id, which is not part of its
+  output, or has len(input_ids) + extra_length (at most max_decode_length)
+  output ids, and its slot is free for the next step.
+  """
+
+  def __init__(self,
+               session,
+               extra_length=50,
+               eos_id=text_encoder.EOS_ID,
+               pad_id=text_encoder.PAD_ID,
+               metrics=None):
+    self._session = session
+    self._extra_length = extra_length
+    self._eos_id = eos_id
+    self._pad_id = pad_id
+    self.metrics = metrics or DecodeMetrics()
+    self._queue = collections.deque()
+    self._cond = threading.Condition()
+    self._closed = False
+    self._thread = threading.Thread(
+        target=self._schedule, name="continuous_batching_decoder")
+    self._thread.daemon = True
+    self._thread.start()
+
+  def submit(self, input_ids):
+    """Queues input_ids for decoding and returns a DecodeRequest.
+
+    Raises:
+      ValueError: if the decoder is closed or input_ids is longer than the
+        session's max_input_length.
+    """
+    request = DecodeRequest(input_ids)
+    if len(request.input_ids) > self._session.max_input_length:
+      raise ValueError("Input of length %d is longer than %d." %
+                       (len(request.input_ids),
+                        self._session.max_input_length))
+    with self._cond:
+      if self._closed:
+        raise ValueError("ContinuousBatchingDecoder is closed.")
+      self._queue.append(request)
+      self._cond.notify_all()
+    return request
+
+  def decode(self, input_ids, timeout=None):
+    """Decodes input_ids, blocking until it is done."""
+    return self.submit(input_ids).result(timeout)
+
+  def close(self):
+    """Decodes the requests still queued and stops the scheduler thread."""
+    with self._cond:
+      self._closed = True
+      self._cond.notify_all()
+    self._thread.join()
+
+  def _schedule(self):
+    # Per slot, None or the (request, output_ids, max_length) decoded there.
+    slots = [None] * self._session.num_slots
+    while True:
+      with self._cond:
+        while not (self._queue or self._closed or _num_busy(slots)):
+          self._cond.wait()
+        if not (self._queue or _num_busy(slots)):
+          return
+        admitted = []
+        for i, slot in enumerate(slots):
+          if slot is None and self._queue:
+            admitted.append((i, self._queue.popleft()))
+      if admitted:
+        self._admit(slots, admitted)
+      if _num_busy(slots):
+        self._step(slots)
+
+  def _admit(self, slots, admitted):
+    """Starts decoding the (slot, request) pairs admitted."""
+    max_length = max(len(request.input_ids) for _, request in admitted)
+    inputs = np.full([len(admitted), max_length], self._pad_id,
+                     dtype=np.int32)
+    for row, (_, request) in enumerate(admitted):
+      inputs[row, :len(request.input_ids)] = request.input_ids
+    try:
+      self._session.admit(np.array([i for i, _ in admitted], dtype=np.int32),
+                          inputs)
+    except Exception as e:  # pylint: disable=broad-except
+      tf.logging.error("Admitting %d requests failed: %s", len(admitted), e)
+      for _, request in admitted:
+        request.set_result(error=e)
+      return
+    for i, request in admitted:
+      max_output_length = min(len(request.input_ids) + self._extra_length,
+                              self._session.max_decode_length)
+      slots[i] = (request, [], max_output_length)
+
+  def _step(self, slots):
+    """Decodes one position and resolves the requests that are done."""
+    busy = [i for i, slot in enumerate(slots) if slot is not None]
+    self.metrics.record_batch(len(busy))
+    try:
+      next_ids = self._session.step()
+    except Exception as e:  # pylint: disable=broad-except
+      tf.logging.error("Decoding a step of %d requests failed: %s",
+                       len(busy), e)
+      for i in busy:
+        slots[i][0].set_result(error=e)
+        slots[i] = None
+      return
+    now = time.time()
+    for i in busy:
+      request, output_ids, max_output_length = slots[i]
+      next_id = int(next_ids[i])
+      if next_id != self._eos_id:
+        output_ids.append(next_id)
+      if next_id == self._eos_id or len(output_ids) >= max_output_length:
+        request.set_result(output_ids)
+        self.metrics.record_request(now - request.arrival_time,
+                                    len(output_ids))
+        slots[i] = None
+
+
+def _num_busy(slots):
+  return sum(1 for slot in slots if slot is not None)
+
+
+class _ThreadingHTTPServer(socketserver.ThreadingMixIn,
+                           BaseHTTPServer.HTTPServer):
+  daemon_threads = True
+
+
+def make_http_server(decoder, input_encoder=None, output_encoder=None,
+                     host="", port=8888):
+  """Returns an HTTP server decoding JSON requests with decoder.
+
+  Args:
+    decoder: a BatchingDecoder or a ContinuousBatchingDecoder.
+    input_encoder: a TextEncoder for the "inputs" text of requests. Requests
+      must give "input_ids" instead if None.
+    output_encoder: a TextEncoder for the "outputs" text of responses. Only
+      "output_ids" are returned if None.
+    host: the address to bind.
+    port: the port to bind.
+
+  Returns:
+    an HTTPServer; call serve_forever() on it.
+  """
+
+  class DecodeHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Serves POST /decode and GET /metrics."""
+
+    def _respond(self, code, body):
+      data = json.dumps(body).encode("utf-8")
+      self.send_response(code)
+      self.send_header("Content-Type", "application/json")
+      self.send_header("Content-Length", str(len(data)))
+      self.end_headers()
+      self.wfile.write(data)
+
+    def do_GET(self):  # pylint: disable=invalid-name
+      if self.path == "/metrics":
+        self._respond(200, decoder.metrics.summary())
+      else:
+        self._respond(404, {"error": "Unknown path %s" % self.path})
+
+    def do_POST(self):  # pylint: disable=invalid-name
+      if self.path != "/decode":
+        self._respond(404, {"error": "Unknown path %s" % self.path})
+        return
+      try:
+        length = int(self.headers.get("Content-Length", 0))
+        request = json.loads(self.rfile.read(length).decode("utf-8"))
+        if "input_ids" in request:
+          input_ids = [int(t) for t in request["input_ids"]]
+        elif input_encoder is not None:
+          input_ids = input_encoder.encode(request["inputs"])
+          input_ids.append(text_encoder.EOS_ID)
+        else:
+          raise ValueError("Request needs input_ids.")
+      except (ValueError, KeyError, TypeError) as e:
+        self._respond(400, {"error": str(e)})
+        return
+      start = time.time()
+      try:
+        output_ids = decoder.decode(input_ids)
+      except Exception as e:  # pylint: disable=broad-except
+        self._respond(500, {"error": str(e)})
+        return
+      response = {"output_ids": output_ids, "latency": time.time() - start}
+      if output_encoder is not None:
+        if output_ids and isinstance(output_ids[0], list):
+          response["outputs"] = [output_encoder.decode(beam)
+                                 for beam in output_ids]
+        else:
+          response["outputs"] = output_encoder.decode(output_ids)
+      self._respond(200, response)
+
+    def log_message(self, format, *args):  # pylint: disable=redefined-builtin
+      tf.logging.debug(format, *args)
+
+  return _ThreadingHTTPServer((host, port), DecodeHandler)
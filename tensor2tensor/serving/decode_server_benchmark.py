@@ -0,0 +1,145 @@
+# coding=utf-8
+# Copyright 2017 The Tensor2Tensor Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+r"""Load generator for the batching decode server.
+
+Sends requests with random input ids and lengths to an in-process
+BatchingDecoder around a local model (a ContinuousBatchingDecoder with
+--continuous_batching), arriving as a Poisson process at --target_qps, and
+reports latency percentiles and throughput. Without a checkpoint in
+--output_dir the model is randomly initialized.
+
+Example usage:
+
+python serving/decode_server_benchmark.py \
+    --data_dir ~/data \
+    --problems=translate_ende_wmt32k \
+    --model=transformer \
+    --hparams_set=transformer_base_single_gpu \
+    --output_dir ~/train \
+    --target_qps=50 --num_requests=2000 \
+    --logtostderr
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import random
+import threading
+import time
+
+# Dependency imports
+
+from six.moves import xrange  # pylint: disable=redefined-builtin
+
+from tensor2tensor.bin import t2t_decode_server
+from tensor2tensor.data_generators import text_encoder
+from tensor2tensor.utils import usr_dir
+
+import tensorflow as tf
+
+flags = tf.flags
+FLAGS = flags.FLAGS
+
+# Additional flags in bin/t2t_decode_server.py
+flags.DEFINE_float("target_qps", 20.0, "Mean request arrival rate.")
+flags.DEFINE_integer("num_requests", 500, "Requests to send.")
+flags.DEFINE_integer("min_input_length", 4, "Shortest random input.")
+flags.DEFINE_integer("max_input_length", 64, "Longest random input.")
+flags.DEFINE_integer("num_warmup_requests", 16,
+                     "Requests sent before the metrics are reset.")
+
+
+def random_inputs(num_requests, vocab_size, min_length, max_length):
+  """Random input id sequences, each ending in EOS."""
+  inputs = []
+  for _ in xrange(num_requests):
+    length = random.randint(min_length, max_length)
+    ids = [random.randint(text_encoder.NUM_RESERVED_TOKENS, vocab_size - 1)
+           for _ in xrange(length - 1)]
+    inputs.append(ids + [text_encoder.EOS_ID])
+  return inputs
+
+
+def run_load(decoder, inputs, target_qps):
+  """Submits inputs at target_qps and waits for all of them.
+
+  Args:
+    decoder: a BatchingDecoder or a ContinuousBatchingDecoder.
+    inputs: a list of input id lists.
+    target_qps: mean arrival rate; inter-arrival times are exponential.
+
+  Returns:
+    the number of failed requests.
+  """
+  failures = [0]
+  lock = threading.Lock()
+
+  def wait_for(request):
+    try:
+      request.result()
+    except Exception:  # pylint: disable=broad-except
+      with lock:
+        failures[0] += 1
+
+  waiters = []
+  next_time = time.time()
+  for input_ids in inputs:
+    next_time += random.expovariate(target_qps)
+    delay = next_time - time.time()
+    if delay > 0:
+      time.sleep(delay)
+    waiter = threading.Thread(target=wait_for, args=(decoder.submit(input_ids),))
+    waiter.start()
+    waiters.append(waiter)
+  for waiter in waiters:
+    waiter.join()
+  return failures[0]
+
+
+def main(_):
+  tf.logging.set_verbosity(tf.logging.INFO)
+  usr_dir.import_usr_dir(FLAGS.t2t_usr_dir)
+
+  hparams = t2t_decode_server.create_hparams()
+  problem = hparams.problem_instances[0]
+  fname = "inputs" if problem.has_inputs else "targets"
+  vocab_size = problem.feature_info[fname].encoder.vocab_size
+  decoder = t2t_decode_server.create_decoder(hparams)
+
+  run_load(decoder,
+           random_inputs(FLAGS.num_warmup_requests, vocab_size,
+                         FLAGS.min_input_length, FLAGS.max_input_length),
+           FLAGS.target_qps)
+  decoder.metrics.reset()
+  failures = run_load(
+      decoder,
+      random_inputs(FLAGS.num_requests, vocab_size, FLAGS.min_input_length,
+                    FLAGS.max_input_length),
+      FLAGS.target_qps)
+  decoder.close()
+
+  summary = decoder.metrics.summary()
+  tf.logging.info(
+      "%d requests at %.1f qps target (%d failed): p50 %.1f ms, p99 %.1f ms, "
+      "%.1f requests/sec, %.1f tokens/sec, mean batch size %.1f",
+      summary["requests"], FLAGS.target_qps, failures,
+      summary["latency_p50"] * 1000, summary["latency_p99"] * 1000,
+      summary["requests_per_sec"], summary["tokens_per_sec"],
+      summary["mean_batch_size"])
+
+
+if __name__ == "__main__":
+  tf.app.run()
@@ -0,0 +1,201 @@
+# coding=utf-8
+# Copyright 2017 The Tensor2Tensor Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests for the batching decode server."""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import os
+import threading
+import time
+
+# Dependency imports
+
+import numpy as np
+
+from tensor2tensor.data_generators import problem_hparams
+from tensor2tensor.models import transformer
+from tensor2tensor.serving import decode_server
+from tensor2tensor.utils import decoding
+
+import tensorflow as tf
+
+
+class BatchingDecoderTest(tf.test.TestCase):
+
+  def testBatchesByLength(self):
+    shapes = []
+    lock = threading.Lock()
+
+    def decode_fn(inputs):
+      with lock:
+        shapes.append(inputs.shape)
+      # Echo each row without its padding.
+      return [[t for t in row if t] for row in inputs]
+
+    decoder = decode_server.BatchingDecoder(
+        decode_fn, max_batch_size=2, max_wait_secs=0.05,
+        bucket_boundaries=[4, 8], num_threads=1)
+    requests = [decoder.submit(ids)
+                for ids in [[5, 1], [6, 6, 6, 6, 6, 1], [7, 7, 1], [9] * 10]]
+    outputs = [r.result(timeout=10) for r in requests]
+    decoder.close()
+
+    self.assertEqual([[5, 1], [6, 6, 6, 6, 6, 1], [7, 7, 1], [9] * 10],
+                     outputs)
+    # The two short inputs share a batch; longer ones are padded to their
+    # bucket boundary, or to their own length past the last boundary.
+    self.assertEqual(sorted([(2, 4), (1, 8), (1, 10)]), sorted(shapes))
+    summary = decoder.metrics.summary()
+    self.assertEqual(4, summary["requests"])
+    self.assertEqual(3, summary["batches"])
+    self.assertEqual(21, summary["tokens"])
+
+  def testBeams(self):
+
+    def decode_fn(inputs):
+      return [[[t for t in row if t], [t for t in row[::-1] if t]]
+              for row in inputs]
+
+    decoder = decode_server.BatchingDecoder(decode_fn, max_wait_secs=0.0)
+    self.assertEqual([[5, 1], [1, 5]], decoder.decode([5, 1], timeout=10))
+    decoder.close()
+    self.assertEqual(4, decoder.metrics.summary()["tokens"])
+
+  def testDecodeError(self):
+
+    def decode_fn(unused_inputs):
+      raise ValueError("bad batch")
+
+    decoder = decode_server.BatchingDecoder(decode_fn, max_wait_secs=0.0)
+    with self.assertRaisesRegexp(ValueError, "bad batch"):
+      decoder.decode([3, 1], timeout=10)
+    decoder.close()
+
+  def testMetricsWindow(self):
+    metrics = decode_server.DecodeMetrics(window=2)
+    for latency in [10.0, 1.0, 1.0]:
+      metrics.record_request(latency, 3)
+    metrics.record_batch(2)
+    metrics.record_batch(1)
+    summary = metrics.summary()
+    # Counts cover all requests, latencies only the last two.
+    self.assertEqual(3, summary["requests"])
+    self.assertEqual(9, summary["tokens"])
+    self.assertEqual(1.5, summary["mean_batch_size"])
+    self.assertEqual(1.0, summary["latency_p99"])
+
+
+class EchoStepwiseSession(object):
+  """Decodes each slot's input back, one id per step, then EOS."""
+
+  num_slots = 2
+  max_input_length = 32
+  max_decode_length = 40
+
+  def __init__(self):
+    self.admitted = []
+    self._slots = [None] * self.num_slots
+
+  def admit(self, slot_ids, input_ids):
+    for slot, row in zip(slot_ids, input_ids):
+      self.admitted.append(slot)
+      self._slots[slot] = [[int(t) for t in row if t], 0]
+
+  def step(self):
+    time.sleep(0.001)
+    next_ids = []
+    for slot in self._slots:
+      if slot is None or slot[1] >= len(slot[0]):
+        next_ids.append(1)
+      else:
+        next_ids.append(slot[0][slot[1]])
+        slot[1] += 1
+    return next_ids
+
+
+class ContinuousBatchingDecoderTest(tf.test.TestCase):
+
+  def testRefillsFreeSlots(self):
+    session = EchoStepwiseSession()
+    decoder = decode_server.ContinuousBatchingDecoder(session, extra_length=0)
+    # Without EOS, the long input stops at its length limit, after 20 steps.
+    long_request = decoder.submit([9] * 20)
+    requests = [decoder.submit([i, i, 1]) for i in [5, 6, 7]]
+    outputs = [r.result(timeout=10) for r in requests]
+    self.assertEqual([9] * 20, long_request.result(timeout=10))
+    decoder.close()
+
+    self.assertEqual([[5, 5], [6, 6], [7, 7]], outputs)
+    # The short requests took turns in the slot next to the long one.
+    self.assertEqual([0, 1, 1, 1], session.admitted)
+    summary = decoder.metrics.summary()
+    self.assertEqual(4, summary["requests"])
+    self.assertEqual(26, summary["tokens"])
+    self.assertEqual(20, summary["batches"])
+
+  def testInputTooLong(self):
+    decoder = decode_server.ContinuousBatchingDecoder(EchoStepwiseSession())
+    with self.assertRaisesRegexp(ValueError, "longer than 32"):
+      decoder.submit([5] * 33)
+    decoder.close()
+
+
+class StepwiseDecodeSessionTest(tf.test.TestCase):
+
+  def testMatchesFastDecoding(self):
+    hparams = transformer.transformer_small()
+    hparams.hidden_size = 8
+    hparams.filter_size = 32
+    hparams.num_heads = 2
+    hparams.problems = [problem_hparams.test_problem_hparams(10, 10)]
+    decode_hp = decoding.decode_hparams("beam_size=1,extra_length=4")
+    inputs = np.array([[3, 4, 5, 1], [6, 7, 1, 0], [8, 1, 0, 0]],
+                      dtype=np.int32)
+
+    # Both sessions restore the same random weights.
+    checkpoint_path = os.path.join(self.get_temp_dir(), "model.ckpt")
+    with tf.Graph().as_default():
+      model = transformer.Transformer(
+          hparams, tf.estimator.ModeKeys.PREDICT, hparams.problems[0],
+          decode_hparams=decode_hp)
+      model.infer({"inputs": tf.constant(inputs[:, :, None])},
+                  decode_length=1)
+      with tf.Session() as session:
+        session.run(tf.global_variables_initializer())
+        tf.train.Saver().save(session, checkpoint_path)
+
+    fast = decode_server.FastDecodeSession(
+        "transformer", hparams, decode_hp, checkpoint_path=checkpoint_path)
+    expected = [[int(t) for t in row] for row in fast(inputs)]
+    fast.close()
+    # Fewer slots than requests, so that a slot is reused.
+    stepwise = decode_server.StepwiseDecodeSession(
+        "transformer", hparams, decode_hp, num_slots=2, max_input_length=6,
+        checkpoint_path=checkpoint_path)
+    decoder = decode_server.ContinuousBatchingDecoder(
+        stepwise, extra_length=decode_hp.extra_length)
+    requests = [decoder.submit(row) for row in inputs]
+    outputs = [r.result(timeout=60) for r in requests]
+    decoder.close()
+    stepwise.close()
+
+    self.assertEqual(expected, outputs)
+
+
+if __name__ == "__main__":
+  tf.test.main()
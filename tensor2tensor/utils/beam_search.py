@@ -169,6 +169,56 @@ def compute_topk_scores_and_seq(sequences, scores, scores_to_gather, flags,
   return topk_seq, topk_gathered_scores, topk_flags, topk_gathered_states
 
 
+def _continue_beam_search(i, alive_log_probs, finished_scores,
+                          finished_in_finished, decode_length, alpha,
+                          stop_early):
+  """Checking termination condition.
+
+  We terminate when we decoded up to decode_length or the lowest scoring item
+  in finished has a greater score that the higest prob item in alive divided
+  by the max length penalty
+
+  Args:
+    i: loop index
+    alive_log_probs: probabilities of the beams. [batch_size, beam_size]
+    finished_scores: scores for each of these sequences.
+      [batch_size, beam_size]
+    finished_in_finished: finished bools for each of these sequences.
+      [batch_size, beam_size]
+    decode_length: Number of steps to decode for.
+    alpha: alpha for length penalty.
+    stop_early: a boolean - stop once best sequence is provably determined.
+
+  Returns:
+    Bool.
+  """
+  if not stop_early:
+    return tf.less(i, decode_length)
+  max_length_penalty = tf.pow(((5. + tf.to_float(decode_length)) / 6.), alpha)
+  # The best possible score of the most likley alive sequence
+  lower_bound_alive_scores = alive_log_probs[:, 0] / max_length_penalty
+
+  # Now to compute the lowest score of a finished sequence in finished
+  # If the sequence isn't finished, we multiply it's score by 0. since
+  # scores are all -ve, taking the min will give us the score of the lowest
+  # finished item.
+  lowest_score_of_fininshed_in_finished = tf.reduce_min(
+      finished_scores * tf.to_float(finished_in_finished), axis=1)
+  # If none of the sequences have finished, then the min will be 0 and
+  # we have to replace it by -ve INF if it is. The score of any seq in alive
+  # will be much higher than -ve INF and the termination condition will not
+  # be met.
+  lowest_score_of_fininshed_in_finished += (
+      (1. - tf.to_float(tf.reduce_any(finished_in_finished, 1))) * -INF)
+
+  bound_is_met = tf.reduce_all(
+      tf.greater(lowest_score_of_fininshed_in_finished,
+                 lower_bound_alive_scores))
+
+  return tf.logical_and(
+      tf.less(i, decode_length), tf.logical_not(bound_is_met))
+
+
 def beam_search(symbols_to_logits_fn,
                 initial_ids,
                 beam_size,
@@ -456,48 +506,9 @@ def beam_search(symbols_to_logits_fn,
 
   def _is_finished(i, unused_alive_seq, alive_log_probs, unused_finished_seq,
                    finished_scores, finished_in_finished, unused_states):
-    """Checking termination condition.
-
-    We terminate when we decoded up to decode_length or the lowest scoring item
-    in finished has a greater score that the higest prob item in alive divided
-    by the max length penalty
-
-    Args:
-      i: loop index
-      alive_log_probs: probabilities of the beams. [batch_size, beam_size]
-      finished_scores: scores for each of these sequences.
-        [batch_size, beam_size]
-      finished_in_finished: finished bools for each of these sequences.
-        [batch_size, beam_size]
-
-    Returns:
-      Bool.
-    """
-    if not stop_early:
-      return tf.less(i, decode_length)
-    max_length_penalty = tf.pow(((5. + tf.to_float(decode_length)) / 6.), alpha)
-    # The best possible score of the most likley alive sequence
-    lower_bound_alive_scores = alive_log_probs[:, 0] / max_length_penalty
-
-    # Now to compute the lowest score of a finished sequence in finished
-    # If the sequence isn't finished, we multiply it's score by 0. since
-    # scores are all -ve, taking the min will give us the score of the lowest
-    # finished item.
-    lowest_score_of_fininshed_in_finished = tf.reduce_min(
-        finished_scores * tf.to_float(finished_in_finished), axis=1)
-    # If none of the sequences have finished, then the min will be 0 and
-    # we have to replace it by -ve INF if it is. The score of any seq in alive
-    # will be much higher than -ve INF and the termination condition will not
-    # be met.
-    lowest_score_of_fininshed_in_finished += (
-        (1. - tf.to_float(tf.reduce_any(finished_in_finished, 1))) * -INF)
-
-    bound_is_met = tf.reduce_all(
-        tf.greater(lowest_score_of_fininshed_in_finished,
-                   lower_bound_alive_scores))
-
-    return tf.logical_and(
-        tf.less(i, decode_length), tf.logical_not(bound_is_met))
+    return _continue_beam_search(i, alive_log_probs, finished_scores,
+                                 finished_in_finished, decode_length, alpha,
+                                 stop_early)
 
   (_, alive_seq, alive_log_probs, finished_seq, finished_scores,
    finished_flags, _) = tf.while_loop(
@@ -532,3 +543,225 @@ def beam_search(symbols_to_logits_fn,
   finished_scores = tf.where(
       tf.reduce_any(finished_flags, 1), finished_scores, alive_log_probs)
   return finished_seq, finished_scores
+
+
+def beam_search_with_back_pointers(symbols_to_logits_fn,
+                                   initial_ids,
+                                   beam_size,
+                                   decode_length,
+                                   vocab_size,
+                                   alpha,
+                                   states=None,
+                                   eos_id=EOS_ID,
+                                   stop_early=True):
+  """Beam search with length penalties, keeping back-pointers.
+
+  Finds the same beams as beam_search. Instead of carrying the decoded
+  sequences of the alive and finished beams through the loop, and gathering
+  and extending them every step, each step writes its 2 * beam_size candidate
+  ids, and the candidate of the previous step that each one extends, to
+  TensorArrays of decode_length elements. Alive and finished beams are then
+  only positions among the candidates, and their sequences are put together
+  once at the end by following the back-pointers, so that the cost of a step
+  does not grow with the decoded length.
+
+  Since sequences are not kept, symbols_to_logits_fn only gets the last
+  decoded id of each beam and must keep anything else it needs in states, as
+  incremental decoders such as the Transformer's fast decoding do.
+
+  Args:
+    symbols_to_logits_fn: Interface to the model, to provide logits.
+        Should take [batch_size * beam_size, 1] ids (and the loop index and
+        states, if states are given) and return
+        [batch_size * beam_size, vocab_size] logits.
+    initial_ids: Ids to start off the decoding, this will be the first thing
+        handed to symbols_to_logits_fn (after expanding to beam size)
+        [batch_size]
+    beam_size: Size of the beam.
+    decode_length: Number of steps to decode for.
+    vocab_size: Size of the vocab, must equal the size of the logits returned by
+        symbols_to_logits_fn
+    alpha: alpha for length penalty.
+    states: dict (possibly nested) of decoding states.
+    eos_id: ID for end of sentence.
+    stop_early: a boolean - stop once best sequence is provably determined.
+  Returns:
+    Tuple of
+    (decoded beams [batch_size, beam_size, decode_length]
+     decoding probablities [batch_size, beam_size])
+  """
+  batch_size = common_layers.shape_list(initial_ids)[0]
+  num_candidates = 2 * beam_size
+  beam_pos = compute_batch_indices(batch_size, beam_size)
+  candidate_batch_pos = compute_batch_indices(batch_size, num_candidates)
+
+  # Assume initial_ids are prob 1.0
+  initial_log_probs = tf.constant([[0.] + [-float("inf")] * (beam_size - 1)])
+  alive_log_probs = tf.tile(initial_log_probs, [batch_size, 1])
+  # The last id of each alive beam, and its position among the candidates of
+  # the previous step.
+  alive_ids = _expand_to_beam_size(initial_ids, beam_size)
+  alive_pos = tf.zeros([batch_size, beam_size], tf.int32)
+  if states:
+    states = nest.map_structure(
+        lambda state: _expand_to_beam_size(state, beam_size), states)
+  else:
+    states = {}
+
+  # Finished beams are the step and candidate position of their EOS. Step -1
+  # stands for the all zero sequences that beam_search starts finished with.
+  finished_step = -tf.ones([batch_size, beam_size], tf.int32)
+  finished_pos = tf.zeros([batch_size, beam_size], tf.int32)
+  finished_scores = tf.ones([batch_size, beam_size]) * -INF
+  finished_flags = tf.zeros([batch_size, beam_size], tf.bool)
+
+  candidate_ids = tf.TensorArray(tf.int32, size=decode_length)
+  candidate_parents = tf.TensorArray(tf.int32, size=decode_length)
+
+  def inner_loop(i, alive_ids, alive_pos, alive_log_probs, finished_step,
+                 finished_pos, finished_scores, finished_flags, candidate_ids,
+                 candidate_parents, states):
+    """One beam search step; see beam_search's inner_loop."""
+    flat_ids = tf.reshape(alive_ids, [batch_size * beam_size, 1])
+    if states:
+      flat_states = nest.map_structure(_merge_beam_dim, states)
+      flat_logits, flat_states = symbols_to_logits_fn(flat_ids, i, flat_states)
+      states = nest.map_structure(
+          lambda t: _unmerge_beam_dim(t, batch_size, beam_size), flat_states)
+    else:
+      flat_logits = symbols_to_logits_fn(flat_ids)
+    logits = tf.reshape(flat_logits, [batch_size, beam_size, -1])
+    log_probs = log_prob_from_logits(logits) + tf.expand_dims(
+        alive_log_probs, axis=2)
+    length_penalty = tf.pow(((5. + tf.to_float(i + 1)) / 6.), alpha)
+    flat_curr_scores = tf.reshape(log_probs / length_penalty,
+                                  [-1, beam_size * vocab_size])
+    topk_scores, topk_ids = tf.nn.top_k(flat_curr_scores, k=num_candidates)
+    topk_log_probs = topk_scores * length_penalty
+    topk_beam_index = topk_ids // vocab_size
+    topk_ids %= vocab_size
+    topk_finished = tf.equal(topk_ids, eos_id)
+
+    candidate_ids = candidate_ids.write(i, topk_ids)
+    candidate_parents = candidate_parents.write(i, tf.gather_nd(
+        alive_pos, tf.stack([candidate_batch_pos, topk_beam_index], axis=2)))
+
+    # The top beam_size unfinished candidates stay alive.
+    _, alive_pos = tf.nn.top_k(
+        topk_scores + tf.to_float(topk_finished) * -INF, k=beam_size)
+    alive_coordinates = tf.stack([beam_pos, alive_pos], axis=2)
+    alive_ids = tf.gather_nd(topk_ids, alive_coordinates)
+    alive_log_probs = tf.gather_nd(topk_log_probs, alive_coordinates)
+    if states:
+      # Gather the states of the alive beams' parents in one go.
+      parent_coordinates = tf.stack(
+          [beam_pos, tf.gather_nd(topk_beam_index, alive_coordinates)], axis=2)
+      states = nest.map_structure(
+          lambda state: tf.gather_nd(state, parent_coordinates), states)
+
+    # The top beam_size of the finished and the finished candidates.
+    curr_scores = topk_scores + (1. - tf.to_float(topk_finished)) * -INF
+    scores = tf.concat([finished_scores, curr_scores], axis=1)
+    _, finished_index = tf.nn.top_k(scores, k=beam_size)
+    finished_coordinates = tf.stack([beam_pos, finished_index], axis=2)
+
+    def gather_finished(finished, current):
+      return tf.gather_nd(tf.concat([finished, current], axis=1),
+                          finished_coordinates)
+
+    finished_step = gather_finished(
+        finished_step, tf.fill([batch_size, num_candidates], i))
+    finished_pos = gather_finished(
+        finished_pos, tf.tile(tf.expand_dims(tf.range(num_candidates), 0),
+                              [batch_size, 1]))
+    finished_flags = gather_finished(finished_flags, topk_finished)
+    finished_scores = tf.gather_nd(scores, finished_coordinates)
+
+    return (i + 1, alive_ids, alive_pos, alive_log_probs, finished_step,
+            finished_pos, finished_scores, finished_flags, candidate_ids,
+            candidate_parents, states)
+
+  def _is_finished(i, unused_alive_ids, unused_alive_pos, alive_log_probs,
+                   unused_finished_step, unused_finished_pos, finished_scores,
+                   finished_flags, unused_candidate_ids,
+                   unused_candidate_parents, unused_states):
+    return _continue_beam_search(i, alive_log_probs, finished_scores,
+                                 finished_flags, decode_length, alpha,
+                                 stop_early)
+
+  (num_steps, _, alive_pos, alive_log_probs, finished_step, finished_pos,
+   finished_scores, finished_flags, candidate_ids, candidate_parents,
+   _) = tf.while_loop(
+       _is_finished,
+       inner_loop, [
+           tf.constant(0), alive_ids, alive_pos, alive_log_probs,
+           finished_step, finished_pos, finished_scores, finished_flags,
+           candidate_ids, candidate_parents, states
+       ],
+       shape_invariants=[
+           tf.TensorShape([]),
+           alive_ids.get_shape(),
+           alive_pos.get_shape(),
+           alive_log_probs.get_shape(),
+           finished_step.get_shape(),
+           finished_pos.get_shape(),
+           finished_scores.get_shape(),
+           finished_flags.get_shape(),
+           tf.TensorShape(None),
+           tf.TensorShape(None),
+           nest.map_structure(
+               lambda tensor: tf.TensorShape(tensor.shape), states),
+       ],
+       parallel_iterations=1,
+       back_prop=False)
+
+  # As in beam_search, batch items without finished beams return the alive
+  # ones, which all run to the last step.
+  any_finished = tf.reduce_any(finished_flags, 1)
+  last_step = tf.where(any_finished, finished_step,
+                       tf.fill([batch_size, beam_size], num_steps - 1))
+  last_pos = tf.where(any_finished, finished_pos, alive_pos)
+  scores = tf.where(any_finished, finished_scores, alive_log_probs)
+
+  steps = tf.range(num_steps)
+  seq = _follow_back_pointers(candidate_ids.gather(steps),
+                              candidate_parents.gather(steps), last_step,
+                              last_pos)
+  initial_seq = tf.expand_dims(_expand_to_beam_size(initial_ids, beam_size), 2)
+  seq = tf.concat([initial_seq, seq], axis=2)
+  seq.set_shape((None, beam_size, None))
+  return seq, scores
+
+
+def _follow_back_pointers(ids, parents, last_step, last_pos):
+  """Puts together the sequences of beams from per-step back-pointers.
+
+  Args:
+    ids: candidate ids of each step, [num_steps, batch_size, num_candidates].
+    parents: position of the candidate each candidate extends, among those of
+      the previous step, [num_steps, batch_size, num_candidates].
+    last_step: step of each beam's last id, [batch_size, beam_size].
+    last_pos: position of each beam's last id among the candidates of
+      last_step, [batch_size, beam_size].
+
+  Returns:
+    [batch_size, beam_size, num_steps] ids, with 0 after each beam's last step.
+  """
+  num_steps = tf.shape(ids)[0]
+  batch_size, beam_size = common_layers.shape_list(last_pos)
+  batch_pos = compute_batch_indices(batch_size, beam_size)
+
+  def step_back(t, pos, seq):
+    coordinates = tf.stack([batch_pos, pos], axis=2)
+    active = tf.less_equal(t, last_step)
+    seq = seq.write(t, tf.where(active, tf.gather_nd(ids[t], coordinates),
+                                tf.zeros_like(pos)))
+    pos = tf.where(active, tf.gather_nd(parents[t], coordinates), pos)
+    return t - 1, pos, seq
+
+  _, _, seq = tf.while_loop(
+      lambda t, unused_pos, unused_seq: tf.greater_equal(t, 0),
+      step_back,
+      [num_steps - 1, last_pos, tf.TensorArray(tf.int32, size=num_steps)],
+      back_prop=False)
+  return tf.transpose(seq.stack(), [1, 2, 0])
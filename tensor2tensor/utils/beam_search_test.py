@@ -19,6 +19,8 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
+import time
+
 # Dependency imports
 
 import numpy as np
@@ -371,5 +373,79 @@ class BeamSearchTest(tf.test.TestCase):
       except tf.errors.InvalidArgumentError as e:
         raise AssertionError(e.message)
 
+  def testBackPointersMatchBeamSearch(self):
+    batch_size = 3
+    vocab_size = 6
+    decode_length = 5
+
+    initial_ids = tf.constant([0] * batch_size)  # GO
+    # Logits depend on the last id and, through the states, on the step.
+    transitions = tf.constant(
+        np.random.RandomState(0).randn(vocab_size, vocab_size), tf.float32)
+
+    def symbols_to_logits(ids, _, states):
+      logits = tf.gather(transitions, ids[:, -1]) + states["step"]
+      states["step"] += tf.to_float(tf.range(vocab_size)) / 10.
+      return logits, states
+
+    results = []
+    for beam_size, stop_early in [(1, True), (3, True), (3, False)]:
+      for search_fn in [beam_search.beam_search,
+                        beam_search.beam_search_with_back_pointers]:
+        states = {"step": tf.zeros((batch_size, vocab_size))}
+        states["step"]._shape = tf.TensorShape((None, vocab_size))
+        results.append(search_fn(
+            symbols_to_logits, initial_ids, beam_size, decode_length,
+            vocab_size, 0.6, states=states, eos_id=1, stop_early=stop_early))
+
+    with self.test_session() as sess:
+      results = sess.run(results)
+    for (ids, scores), (bp_ids, bp_scores) in zip(results[::2], results[1::2]):
+      self.assertAllEqual(ids, bp_ids)
+      self.assertAllClose(scores, bp_scores)
+
+
+class BeamSearchBenchmark(tf.test.Benchmark):
+  """Step time of beam search against beam size and decode length.
+
+  Run with: python utils/beam_search_test.py --benchmarks=BeamSearchBenchmark
+  """
+
+  def _benchmarkSearch(self, name, search_fn, beam_size, decode_length,
+                       batch_size=8, vocab_size=1000, num_runs=3):
+    with tf.Graph().as_default():
+      transitions = tf.random_normal([vocab_size, vocab_size], seed=1)
+
+      def symbols_to_logits(ids):
+        return tf.gather(transitions, ids[:, -1])
+
+      ids, _ = search_fn(symbols_to_logits, tf.zeros([batch_size], tf.int32),
+                         beam_size, decode_length, vocab_size, 0.6,
+                         stop_early=False)
+      with tf.Session() as sess:
+        sess.run(ids)
+        start = time.time()
+        for _ in range(num_runs):
+          sess.run(ids)
+        step_time = (time.time() - start) / (num_runs * decode_length)
+    self.report_benchmark(
+        iters=num_runs * decode_length, wall_time=step_time,
+        name="%s_beam%d_length%d" % (name, beam_size, decode_length))
+    return step_time
+
+  def benchmarkStepTime(self):
+    for beam_size in [4, 8, 16]:
+      for decode_length in [32, 128, 512]:
+        concat_time = self._benchmarkSearch(
+            "concat", beam_search.beam_search, beam_size, decode_length)
+        back_pointer_time = self._benchmarkSearch(
+            "back_pointers", beam_search.beam_search_with_back_pointers,
+            beam_size, decode_length)
+        tf.logging.info(
+            "beam %2d, length %3d: %.3f ms/step concat, "
+            "%.3f ms/step back-pointers", beam_size, decode_length,
+            concat_time * 1000, back_pointer_time * 1000)
+
+
 if __name__ == "__main__":
   tf.test.main()
@@ -18,6 +18,15 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
+import collections
+import copy
+import itertools
+import json
+import os
+import random
+import threading
+import time
+
 # Dependency imports
 
 import numpy as np
@@ -25,6 +34,8 @@ import numpy as np
 import six
 from six.moves import xrange  # pylint: disable=redefined-builtin
 
+from tensor2tensor.data_generators import generator_utils
+
 import tensorflow as tf
 
 
@@ -108,6 +119,123 @@ def bucket_by_sequence_length(dataset,
     return dataset
 
 
+def token_budget_batch_ends(lengths, batch_size, batch_multiple=1):
+  """Greedily cuts length-sorted examples into batches within a token budget.
+
+  A batch costs its number of examples times the length of its longest one,
+  i.e. padding counts. Each batch takes as many of the next examples as fit
+  in batch_size tokens, rounded down to a multiple of batch_multiple, and at
+  least batch_multiple. The last batch is rounded down too, so the fewer than
+  batch_multiple examples left over at the end are dropped.
+
+  Args:
+    lengths: a 1-d numpy array of example lengths, in increasing order.
+    batch_size: int, the number of tokens in a batch.
+    batch_multiple: int, the number of examples in every batch is a multiple
+      of this.
+
+  Returns:
+    an int32 numpy array of the (exclusive) end index of each batch. The
+    batches start at 0 and each one starts at the end of the one before.
+  """
+  num_examples = len(lengths)
+  ends = []
+  start = 0
+  while start < num_examples:
+    end = start + 1
+    while (end < num_examples and
+           (end + 1 - start) * lengths[end] <= batch_size):
+      end += 1
+    size = end - start
+    size = max(batch_multiple, size - size % batch_multiple)
+    if start + size > num_examples:
+      # Sharding splits every batch evenly, so drop the remainder.
+      break
+    end = start + size
+    ends.append(end)
+    start = end
+  return np.array(ends, dtype=np.int32)
+
+
+def sort_and_batch_by_token_budget(dataset,
+                                   example_length_fn,
+                                   batch_size,
+                                   buffer_size,
+                                   batch_multiple=1,
+                                   shuffle=True):
+  """Batch entries in dataset by length, filling a token budget.
+
+  Reads buffer_size examples at a time, sorts them by length and cuts them
+  greedily into batches of up to batch_size tokens, padding included (see
+  token_budget_batch_ends). Each batch is padded to its own longest example.
+  Unlike bucket_by_sequence_length, batch sizes are not tied to length
+  buckets or rounded to divisors of a window size, so batches come closer to
+  the budget.
+
+  Args:
+    dataset: Dataset of dict<feature name, Tensor>.
+    example_length_fn: function from example to int, determines the length of
+      the example.
+    batch_size: int, the number of tokens in a batch.
+    buffer_size: int, the number of examples sorted at a time.
+    batch_multiple: int, the number of examples in a batch is a multiple of
+      this; the fewer than batch_multiple examples left over at the end of a
+      buffer are dropped.
+    shuffle: bool, whether to shuffle the examples before they are sorted and
+      the batches of each buffer.
+
+  Returns:
+    Dataset of padded and batched examples.
+  """
+  with tf.name_scope("sort_and_batch_by_token_budget"):
+    padded_shapes = dict(
+        [(name, [None] * len(shape))
+         for name, shape in dataset.output_shapes.items()])
+    # Features that are padded, by the length of their first dimension.
+    sequence_names = [name for name, shape in dataset.output_shapes.items()
+                      if shape.ndims]
+
+    def add_lengths(example):
+      feature_lengths = dict(
+          [(name, tf.shape(example[name])[0]) for name in sequence_names])
+      return example, example_length_fn(example), feature_lengths
+
+    def batches_of_buffer(examples, lengths, feature_lengths):
+      """Sorts a buffer of examples and returns a Dataset of its batches."""
+      order = tf.nn.top_k(-lengths, k=tf.size(lengths)).indices
+      examples = dict([(name, tf.gather(v, order))
+                       for name, v in six.iteritems(examples)])
+      feature_lengths = dict([(name, tf.gather(v, order))
+                              for name, v in six.iteritems(feature_lengths)])
+      ends = tf.py_func(
+          lambda l: token_budget_batch_ends(l, batch_size, batch_multiple),
+          [tf.gather(lengths, order)], tf.int32, stateful=False)
+      ends.set_shape([None])
+      starts = tf.concat([[0], ends], 0)[:-1]
+      batch_bounds = tf.data.Dataset.from_tensor_slices((starts, ends))
+      if shuffle:
+        batch_bounds = batch_bounds.shuffle(buffer_size)
+
+      def slice_batch(start, end):
+        batch = {}
+        for name, v in six.iteritems(examples):
+          v = v[start:end]
+          if name in feature_lengths:
+            v = v[:, :tf.reduce_max(feature_lengths[name][start:end])]
+          batch[name] = v
+        return batch
+
+      return batch_bounds.map(slice_batch)
+
+    if shuffle:
+      dataset = dataset.shuffle(buffer_size)
+    dataset = dataset.map(add_lengths)
+    dataset = dataset.padded_batch(
+        buffer_size,
+        (padded_shapes, [], dict([(name, []) for name in sequence_names])))
+    return dataset.flat_map(batches_of_buffer)
+
+
 def padded_batch(dataset, batch_size, padded_shapes=None):
   padded_shapes = padded_shapes or dict(
       [(name, [None] * len(shape))
@@ -229,6 +357,402 @@ def hparams_to_batching_scheme(hparams,
       length_multiplier=length_multiplier)
 
 
+class InputPipelineStats(object):
+  """Throughput counters for the stages of an input pipeline.
+
+  count() makes a Dataset count the examples and tokens that pass through it
+  as a named stage, and timed_get_next() times how long the consumer waits
+  for each batch. Rates are measured between calls of rates(), e.g. at each
+  summary step. Counting goes through a tf.py_func per element, which slows
+  down fast pipelines somewhat, so this is meant for diagnosis.
+  """
+
+  def __init__(self):
+    self._lock = threading.Lock()
+    self._stages = []
+    self._drops = []
+    self._examples = {}
+    self._tokens = {}
+    self._wait_secs = 0.0
+    self._num_waits = 0
+    self._last = None
+    self._reset_rates()
+
+  def _reset_rates(self):
+    self._last = {
+        "time": time.time(),
+        "examples": dict(self._examples),
+        "tokens": dict(self._tokens),
+        "wait_secs": self._wait_secs,
+        "num_waits": self._num_waits,
+    }
+
+  def _add(self, stage, num_examples, num_tokens):
+    with self._lock:
+      self._examples[stage] += int(num_examples)
+      self._tokens[stage] += int(num_tokens)
+    return np.int64(0)
+
+  def _add_wait(self, start):
+    wait_secs = time.time() - start
+    with self._lock:
+      self._wait_secs += wait_secs
+      self._num_waits += 1
+    return np.float64(wait_secs)
+
+  def count(self, dataset, stage, batched=False):
+    """Returns dataset, counting its elements as stage.
+
+    Args:
+      dataset: Dataset of dict<feature name, Tensor>.
+      stage: str, the name of the stage.
+      batched: bool, whether the elements are batches. Tokens are then
+        counted with padding.
+
+    Returns:
+      the Dataset, with the same elements.
+    """
+    self._stages.append(stage)
+    self._examples[stage] = 0
+    self._tokens[stage] = 0
+
+    def count_example(example):
+      if batched:
+        features = ([v for v in example.values() if v.get_shape().ndims > 1]
+                    or list(example.values()))
+        num_examples = tf.shape(features[0])[0]
+        num_tokens = tf.reduce_max([tf.size(v) for v in features])
+      else:
+        num_examples = 1
+        num_tokens = example_length(example)
+      counted = tf.py_func(
+          lambda n, t: self._add(stage, n, t), [num_examples, num_tokens],
+          tf.int64)
+      with tf.control_dependencies([counted]):
+        return dict([(name, tf.identity(v))
+                     for name, v in six.iteritems(example)])
+
+    return dataset.map(count_example)
+
+  def count_drops(self, before, after):
+    """Reports the examples dropped between stages before and after."""
+    self._drops.append((before, after))
+
+  def timed_get_next(self, iterator):
+    """Returns iterator.get_next(), recording how long it waits."""
+    start = tf.py_func(time.time, [], tf.float64)
+    with tf.control_dependencies([start]):
+      features = iterator.get_next()
+    with tf.control_dependencies(list(features.values())):
+      wait_secs = tf.py_func(self._add_wait, [start], tf.float64)
+    with tf.control_dependencies([wait_secs]):
+      return dict([(name, tf.identity(v))
+                   for name, v in six.iteritems(features)])
+
+  def rate_names(self):
+    """The names of the values returned by rates(), in order."""
+    names = []
+    for stage in self._stages:
+      names += ["%s_examples_per_sec" % stage, "%s_tokens_per_sec" % stage]
+    names += ["%s_dropped_examples" % after for _, after in self._drops]
+    names += ["get_next_wait_secs", "get_next_wait_fraction"]
+    return names
+
+  def rates(self):
+    """Returns the values named by rate_names(), since the last call.
+
+    These are the examples and tokens per second of each stage, the examples
+    dropped between the stages of count_drops() (in total), and the mean
+    time waited per get_next() and its fraction of the elapsed time.
+    """
+    with self._lock:
+      now = time.time()
+      elapsed = max(now - self._last["time"], 1e-6)
+      values = []
+      for stage in self._stages:
+        values.append(
+            (self._examples[stage] - self._last["examples"].get(stage, 0)) /
+            elapsed)
+        values.append(
+            (self._tokens[stage] - self._last["tokens"].get(stage, 0)) /
+            elapsed)
+      for before, after in self._drops:
+        values.append(self._examples[before] - self._examples[after])
+      wait_secs = self._wait_secs - self._last["wait_secs"]
+      num_waits = self._num_waits - self._last["num_waits"]
+      values.append(wait_secs / num_waits if num_waits else 0.0)
+      values.append(wait_secs / elapsed)
+      self._reset_rates()
+    return np.array(values, dtype=np.float32)
+
+  def add_summaries(self):
+    """Adds summaries of rates(), computed when the summaries are run."""
+    names = self.rate_names()
+    values = tf.py_func(self.rates, [], tf.float32)
+    with tf.name_scope("input_pipeline"):
+      for i, name in enumerate(names):
+        tf.summary.scalar(name, values[i])
+
+
+def _records_from(filename, start):
+  """Yields the records of a TFRecord file from record number start on."""
+  if generator_utils.read_record_index(filename) is not None:
+    return generator_utils.read_records_from(filename, start)
+  return itertools.islice(tf.python_io.tf_record_iterator(filename), start,
+                          None)
+
+
+class ResumableRecordReader(object):
+  """Reads TFRecord files in an order that can be saved and resumed.
+
+  Up to cycle_length files are read at a time, one record from each in turn,
+  in an order that only depends on the seed and the epoch. The state of the
+  reader is the epoch, the index of the next file to open, the (file index,
+  record offset) of each open file and the next of them to read from. It is
+  saved with each checkpoint by InputStateSaverHook, and a reader created for
+  the same directory resumes from the state of the latest checkpoint, seeking
+  straight to the record offsets rather than replaying the data.
+
+  The state holds the position the files were read up to, which is ahead of
+  the position training consumed up to: records still in the buffers of the
+  rest of the input pipeline when a checkpoint is saved are skipped on resume
+  rather than seen twice. The state also counts the records read and, through
+  count_consumed(), the examples training consumed, and a resumed reader logs
+  the difference as the number of records lost.
+  """
+
+  def __init__(self, state_dir, worker_id=0, seed=0, cycle_length=16):
+    """Create a ResumableRecordReader.
+
+    Args:
+      state_dir: directory of the checkpoints and of the saved states.
+      worker_id: int, the worker reading; each worker saves its own state.
+      seed: int, seed of the file order. Workers with different seeds read
+        the files in different orders.
+      cycle_length: int, number of files read at a time.
+    """
+    self._state_dir = state_dir
+    self._worker_id = worker_id
+    self._seed = seed
+    self._cycle_length = cycle_length
+    self._lock = threading.Lock()
+    self._state = self._load_latest_state()
+
+  def _state_filename(self, step):
+    return os.path.join(self._state_dir, "input_state-%d-worker%d.json" %
+                        (step, self._worker_id))
+
+  def _load_latest_state(self):
+    checkpoint = self._state_dir and tf.train.latest_checkpoint(
+        self._state_dir)
+    if not checkpoint:
+      return None
+    filename = self._state_filename(_checkpoint_step(checkpoint))
+    if not tf.gfile.Exists(filename):
+      tf.logging.warning("No input state for %s; reading from the start.",
+                         checkpoint)
+      return None
+    with tf.gfile.GFile(filename) as f:
+      state = json.loads(f.read())
+    num_lost = state.get("num_read", 0) - state.get("num_consumed", 0)
+    tf.logging.info(
+        "Resuming input from %s; skipping %d records read but not trained on "
+        "(buffered in the input pipeline, or dropped by its filters).",
+        filename, max(num_lost, 0))
+    # Count the records lost by the next resume only.
+    state["num_consumed"] = state.get("num_read", 0)
+    return state
+
+  def state(self):
+    """Returns a copy of the current state, a JSON-serializable dict."""
+    with self._lock:
+      return copy.deepcopy(self._state)
+
+  def set_state(self, state):
+    """Makes the next records() call resume from state."""
+    with self._lock:
+      self._state = copy.deepcopy(state)
+
+  def save_state(self, step, state):
+    """Saves state as the state of the checkpoint of step.
+
+    States of this worker for checkpoints that no longer exist are deleted.
+
+    Args:
+      step: int, global step of the checkpoint.
+      state: a dict returned by state().
+    """
+    with tf.gfile.GFile(self._state_filename(step), "w") as f:
+      f.write(json.dumps(state))
+    checkpoints = tf.train.get_checkpoint_state(self._state_dir)
+    if checkpoints is None:
+      return
+    kept = set(_checkpoint_step(path)
+               for path in checkpoints.all_model_checkpoint_paths)
+    kept.add(step)
+    pattern = os.path.join(self._state_dir,
+                           "input_state-*-worker%d.json" % self._worker_id)
+    for filename in tf.gfile.Glob(pattern):
+      old_step = int(os.path.basename(filename).split("-")[1])
+      if old_step not in kept:
+        tf.gfile.Remove(filename)
+
+  def _file_order(self, filenames, epoch, shuffle):
+    order = sorted(filenames)
+    if shuffle:
+      random.Random(self._seed + epoch).shuffle(order)
+    return order
+
+  def records(self, filenames, shuffle=True, repeat=True):
+    """Yields the records of filenames, from the current state on.
+
+    Args:
+      filenames: list of TFRecord files. A saved state is only resumed for
+        the same files.
+      shuffle: bool, whether to read the files in a random order each epoch.
+      repeat: bool, whether to start a new epoch after the last file.
+
+    Yields:
+      records, as strings.
+    """
+    files = sorted(filenames)
+    with self._lock:
+      if self._state is None or self._state["files"] != files:
+        if self._state is not None:
+          tf.logging.warning("Input files changed; reading from the start.")
+        self._state = {"files": files, "epoch": 0, "next_file": 0,
+                       "slots": [], "next_slot": 0, "num_read": 0,
+                       "num_consumed": 0}
+      state = self._state
+    while True:
+      order = self._file_order(files, state["epoch"], shuffle)
+      readers = [_records_from(order[i], offset)
+                 for i, offset in state["slots"]]
+      while True:
+        with self._lock:
+          while (len(state["slots"]) < self._cycle_length and
+                 state["next_file"] < len(order)):
+            state["slots"].append([state["next_file"], 0])
+            readers.append(_records_from(order[state["next_file"]], 0))
+            state["next_file"] += 1
+        if not state["slots"]:
+          break
+        slot = state["next_slot"] % len(state["slots"])
+        try:
+          record = next(readers[slot])
+        except StopIteration:
+          with self._lock:
+            # The next file takes the place of a finished one.
+            if state["next_file"] < len(order):
+              state["slots"][slot] = [state["next_file"], 0]
+              readers[slot] = _records_from(order[state["next_file"]], 0)
+              state["next_file"] += 1
+            else:
+              del state["slots"][slot]
+              del readers[slot]
+              state["next_slot"] = slot
+          continue
+        with self._lock:
+          state["slots"][slot][1] += 1
+          state["next_slot"] = slot + 1
+          state["num_read"] = state.get("num_read", 0) + 1
+        yield record
+      if not repeat:
+        return
+      with self._lock:
+        state["epoch"] += 1
+        state["next_file"] = 0
+        state["next_slot"] = 0
+
+  def dataset(self, filenames, shuffle=True, repeat=True):
+    """Returns a Dataset of the records of filenames; see records()."""
+    return tf.data.Dataset.from_generator(
+        lambda: self.records(filenames, shuffle, repeat), tf.string,
+        tf.TensorShape([]))
+
+  def _add_consumed(self, num_examples):
+    with self._lock:
+      if self._state is not None:
+        self._state["num_consumed"] = (
+            self._state.get("num_consumed", 0) + int(num_examples))
+    return np.int64(0)
+
+  def count_consumed(self, features):
+    """Returns features, counting their examples as consumed when evaluated.
+
+    Args:
+      features: dict<feature name, Tensor>, a batch from the iterator of the
+        input pipeline reading through this reader.
+
+    Returns:
+      the features, with the same values.
+    """
+    counted = tf.py_func(self._add_consumed,
+                         [tf.shape(features["targets"])[0]], tf.int64)
+    with tf.control_dependencies([counted]):
+      return dict([(name, tf.identity(v))
+                   for name, v in six.iteritems(features)])
+
+
+def _checkpoint_step(checkpoint_path):
+  return int(checkpoint_path.split("-")[-1])
+
+
+class InputStateSaverHook(tf.train.SessionRunHook):
+  """Saves the state of a ResumableRecordReader with each checkpoint.
+
+  The reader's state is kept for the recent steps, and when a new checkpoint
+  appears in the directory, the state of the latest step not after it is
+  saved next to it. The state at the last step is saved at the end of
+  training, when the final checkpoint is written.
+  """
+
+  def __init__(self, reader, checkpoint_dir, every_n_steps=10):
+    """Create an InputStateSaverHook.
+
+    Args:
+      reader: the ResumableRecordReader of the training input.
+      checkpoint_dir: directory of the checkpoints.
+      every_n_steps: int, how often to look for a new checkpoint.
+    """
+    self._reader = reader
+    self._checkpoint_dir = checkpoint_dir
+    self._every_n_steps = every_n_steps
+    self._states = collections.deque(maxlen=2 * every_n_steps + 1)
+    self._global_step = None
+    self._last_checkpoint = None
+    self._num_runs = 0
+
+  def begin(self):
+    self._global_step = tf.train.get_global_step()
+    self._last_checkpoint = tf.train.latest_checkpoint(self._checkpoint_dir)
+
+  def before_run(self, run_context):
+    del run_context
+    return tf.train.SessionRunArgs(self._global_step)
+
+  def after_run(self, run_context, run_values):
+    del run_context
+    # The global step is fetched before the train op increments it.
+    step = run_values.results + 1
+    self._states.append((step, self._reader.state()))
+    self._num_runs += 1
+    if self._num_runs % self._every_n_steps:
+      return
+    checkpoint = tf.train.latest_checkpoint(self._checkpoint_dir)
+    if not checkpoint or checkpoint == self._last_checkpoint:
+      return
+    self._last_checkpoint = checkpoint
+    checkpoint_step = _checkpoint_step(checkpoint)
+    saved = [(s, state) for s, state in self._states if s <= checkpoint_step]
+    if saved:
+      self._reader.save_state(checkpoint_step, saved[-1][1])
+
+  def end(self, session):
+    step = session.run(self._global_step)
+    self._reader.save_state(step, self._reader.state())
+
+
 class DummyQueueRunner(object):
   """Can stand-in for a QueueRunner but does nothing."""
 
@@ -19,6 +19,8 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
+import collections
+import itertools
 import os
 import tempfile
 
@@ -29,7 +31,9 @@ from six.moves import xrange  # pylint: disable=redefined-builtin
 
 from tensor2tensor.data_generators import generator_utils
 from tensor2tensor.data_generators import problem as problem_mod
+from tensor2tensor.layers import common_hparams
 from tensor2tensor.utils import data_reader
+from tensor2tensor.utils import expert_utils
 from tensor2tensor.utils import registry
 
 import tensorflow as tf
@@ -108,6 +112,20 @@ class DataReaderTest(tf.test.TestCase):
         for field in [inputs, targets, floats]:
           self.assertGreater(len(field), 0)
 
+  def testShuffledFirstEpochHasNoDuplicates(self):
+    dataset = self.problem.dataset(tf.estimator.ModeKeys.TRAIN,
+                                   data_dir=self.data_dir,
+                                   repeat=False,
+                                   shuffle_files=True)
+    examples = dataset.make_one_shot_iterator().get_next()
+    targets = []
+    with tf.train.MonitoredSession() as sess:
+      # Until OutOfRangeError
+      while True:
+        targets.append(sess.run(examples)["targets"][0])
+    # The random skip drops records, it does not repeat any.
+    self.assertEqual(len(set(targets)), len(targets))
+
   def testPreprocess(self):
     dataset = self.problem.dataset(tf.estimator.ModeKeys.TRAIN,
                                    data_dir=self.data_dir,
@@ -249,6 +267,180 @@ class DataReaderTest(tf.test.TestCase):
     # Check that we saw variable batch size
     self.assertTrue(len(set(obs_batch_sizes)) > 1)
 
+  def testTokenBudgetBatchEnds(self):
+    lengths = np.array([1, 2, 2, 3, 5, 5, 9, 12])
+    self.assertAllEqual([3, 5, 6, 7, 8],
+                        data_reader.token_budget_batch_ends(lengths, 10))
+    self.assertAllEqual([2, 4, 6, 8],
+                        data_reader.token_budget_batch_ends(lengths, 10, 2))
+    # The last two examples are not a batch of 3 and are dropped.
+    self.assertAllEqual([3, 6],
+                        data_reader.token_budget_batch_ends(lengths, 10, 3))
+    self.assertAllEqual([],
+                        data_reader.token_budget_batch_ends(lengths[:2], 10, 3))
+
+  def testSortAndBatchByTokenBudget(self):
+    dataset = self.problem.dataset(tf.estimator.ModeKeys.TRAIN,
+                                   data_dir=self.data_dir,
+                                   repeat=False,
+                                   shuffle_files=False)
+    dataset = data_reader.sort_and_batch_by_token_budget(
+        dataset, data_reader.example_length, batch_size=40, buffer_size=12)
+    batch = dataset.make_one_shot_iterator().get_next()
+
+    input_vals = []
+    with tf.train.MonitoredSession() as sess:
+      # Until OutOfRangeError
+      while True:
+        batch_val = sess.run(batch)
+        batch_inputs = batch_val["inputs"]
+        batch_size, max_len = batch_inputs.shape
+        # Each batch is padded to its longest example and fits the budget,
+        # unless it holds a single longer example.
+        self.assertEqual(max_len, max(batch_inputs[:, 0]) + 1)
+        self.assertTrue(batch_size * max_len <= 40 or batch_size == 1)
+        for inputs in batch_inputs:
+          input_val = inputs[0]
+          input_vals.append(input_val)
+          repeat = input_val + 1
+          self.assertAllEqual([input_val] * repeat + [0] * (max_len - repeat),
+                              inputs)
+
+    self.assertEqual(list(range(30)), sorted(input_vals))
+
+  def testSortAndBatchByTokenBudgetBatchMultiple(self):
+    dataset = self.problem.dataset(tf.estimator.ModeKeys.TRAIN,
+                                   data_dir=self.data_dir,
+                                   repeat=False,
+                                   shuffle_files=False)
+    dataset = data_reader.sort_and_batch_by_token_budget(
+        dataset, data_reader.example_length, batch_size=40, buffer_size=12,
+        batch_multiple=3)
+    batch = dataset.make_one_shot_iterator().get_next()
+
+    input_vals = []
+    with tf.train.MonitoredSession() as sess:
+      # Until OutOfRangeError
+      while True:
+        batch_inputs = sess.run(batch)["inputs"]
+        # Every batch splits evenly across 3 shards.
+        self.assertEqual(0, batch_inputs.shape[0] % 3)
+        input_vals.extend(batch_inputs[:, 0])
+
+    # Each of the 3 buffers drops fewer than 3 examples.
+    self.assertEqual(len(input_vals), len(set(input_vals)))
+    self.assertLessEqual(30 - 3 * 2, len(input_vals))
+
+  def testSortedBufferEvalKeepsAllExamples(self):
+    hparams = common_hparams.basic_params1()
+    hparams.batching_mode = "sorted_buffer"
+    hparams.batch_size = 40
+    hparams.sorted_buffer_size = 12
+    config = collections.namedtuple("Config", ["use_tpu", "data_parallelism"])(
+        use_tpu=False,
+        data_parallelism=expert_utils.Parallelism(["/device:CPU:0"] * 3))
+    features, _ = self.problem.input_fn(tf.estimator.ModeKeys.EVAL, hparams,
+                                        data_dir=self.data_dir, config=config)
+
+    float_vals = []
+    with tf.train.MonitoredSession() as sess:
+      # Until OutOfRangeError
+      while True:
+        floats = sess.run(features)["floats"]
+        # Batches are padded with all-zero examples to split across 3 shards.
+        self.assertEqual(0, floats.shape[0] % 3)
+        float_vals.extend(f for f in floats[:, 0] if f)
+
+    self.assertEqual([i + 0.5 for i in xrange(30)], sorted(float_vals))
+
+  def testInputPipelineStats(self):
+    input_stats = data_reader.InputPipelineStats()
+    dataset = self.problem.dataset(tf.estimator.ModeKeys.TRAIN,
+                                   data_dir=self.data_dir,
+                                   repeat=False,
+                                   shuffle_files=False)
+    dataset = input_stats.count(dataset, "read")
+    dataset = dataset.filter(
+        lambda ex: data_reader.example_valid_size(ex, 0, 10))
+    dataset = input_stats.count(dataset, "valid")
+    input_stats.count_drops("read", "valid")
+    dataset = data_reader.padded_batch(dataset, 4)
+    dataset = input_stats.count(dataset, "batched", batched=True)
+    batch = input_stats.timed_get_next(dataset.make_one_shot_iterator())
+
+    num_batches = 0
+    with tf.train.MonitoredSession() as sess:
+      # Until OutOfRangeError
+      while True:
+        sess.run(batch)
+        num_batches += 1
+
+    rates = dict(zip(input_stats.rate_names(), input_stats.rates()))
+    self.assertEqual(3, num_batches)
+    self.assertEqual(20, rates["valid_dropped_examples"])
+    self.assertTrue(rates["read_examples_per_sec"] >
+                    rates["valid_examples_per_sec"] > 0)
+    self.assertTrue(rates["get_next_wait_secs"] > 0)
+
+  def testWorkerSharding(self):
+    # The single training file is divided between 2 workers by records.
+    targets = []
+    for worker_id in xrange(2):
+      dataset = self.problem.dataset(tf.estimator.ModeKeys.TRAIN,
+                                     data_dir=self.data_dir,
+                                     repeat=False,
+                                     shuffle_files=False,
+                                     num_workers=2,
+                                     worker_id=worker_id)
+      example = dataset.make_one_shot_iterator().get_next()
+      with tf.train.MonitoredSession() as sess:
+        # Until OutOfRangeError
+        while True:
+          targets.append(sess.run(example)["targets"][0])
+    self.assertEqual(list(range(30)), sorted(targets))
+
+    # Files that divide evenly are divided between the workers.
+    tmp_dir = tempfile.mkdtemp(dir=self.get_temp_dir())
+    data_files = [os.path.join(tmp_dir, "records-%d" % i) for i in xrange(4)]
+    for filename in data_files:
+      generator_utils.write_records([b"record"], filename)
+    worker_files, shard_records = problem_mod._worker_data_files(  # pylint: disable=protected-access
+        data_files, 2, 1)
+    self.assertEqual(data_files[1::2], worker_files)
+    self.assertFalse(shard_records)
+
+  def testResumableRecordReader(self):
+    tmp_dir = tempfile.mkdtemp(dir=self.get_temp_dir())
+    filenames = []
+    for i, num_records in enumerate([5, 2, 7, 1]):
+      filenames.append(os.path.join(tmp_dir, "records-%d" % i))
+      generator_utils.write_records(
+          [("%d-%d" % (i, j)).encode("utf-8") for j in xrange(num_records)],
+          filenames[-1])
+
+    reader = data_reader.ResumableRecordReader(tmp_dir, seed=3,
+                                               cycle_length=2)
+    records = list(itertools.islice(reader.records(filenames), 40))
+    # Each epoch reads every record once.
+    self.assertEqual(15, len(set(records[:15])))
+
+    # Stop after 9 records and save the state with a checkpoint.
+    reader = data_reader.ResumableRecordReader(tmp_dir, seed=3,
+                                               cycle_length=2)
+    head = list(itertools.islice(reader.records(filenames), 9))
+    self.assertEqual(9, reader.state()["num_read"])
+    reader.save_state(9, reader.state())
+    tf.train.update_checkpoint_state(tmp_dir,
+                                     os.path.join(tmp_dir, "model.ckpt-9"))
+
+    resumed = data_reader.ResumableRecordReader(tmp_dir, seed=3,
+                                                cycle_length=2)
+    # The records read but not consumed before the checkpoint are not counted
+    # again.
+    self.assertEqual(9, resumed.state()["num_consumed"])
+    tail = list(itertools.islice(resumed.records(filenames), 31))
+    self.assertEqual(records, head + tail)
+
 
 if __name__ == "__main__":
   tf.test.main()
@@ -0,0 +1,143 @@
+# coding=utf-8
+# Copyright 2017 The Tensor2Tensor Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""On-disk cache of decodes, keyed by checkpoint, hparams and input."""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+
+# Dependency imports
+
+import numpy as np
+
+import tensorflow as tf
+
+
+# Hparams that only change how inputs are read and batched and how decodes
+# are written, not the decodes, so they are left out of the cache key.
+# decode_from_dataset copies decode_hp.batch_size into hparams.batch_size.
+_IO_HPARAMS = frozenset([
+    "batch_size", "shards", "shard_id", "num_samples", "delimiter",
+    "stream_window_size", "save_images", "cache_decodes"])
+
+
+def _key_values(hparams):
+  return dict((name, value) for name, value in hparams.values().items()
+              if name not in _IO_HPARAMS)
+
+
+class DecodeCache(object):
+  """Decodes of one checkpoint under one set of model and decode hparams.
+
+  Decodes are stored in an SQLite file, so it can be shared by all the
+  checkpoints of a model and all hparams. Each input maps to a list of
+  (output, score) beams, with score None unless beams were returned. Any
+  change to the hparams, even one that does not change the decodes, misses
+  the decodes cached before it, except for those that only change how inputs
+  are read and batched and how decodes are written, like batch_size or
+  shard_id.
+  """
+
+  def __init__(self, filename, checkpoint_path, hparams, decode_hp):
+    self._conn = sqlite3.connect(filename, check_same_thread=False)
+    self._conn.execute("CREATE TABLE IF NOT EXISTS decodes "
+                       "(key TEXT PRIMARY KEY, beams TEXT)")
+    self._lock = threading.Lock()
+    key = {
+        "checkpoint_path": checkpoint_path,
+        "hparams": _key_values(hparams),
+        "decode_hp": _key_values(decode_hp),
+    }
+    self._key_prefix = hashlib.sha1(json.dumps(
+        key, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+    self.hits = 0
+    self.misses = 0
+
+  def _key(self, input_ids):
+    ids = [int(i) for i in np.asarray(input_ids).flatten()]
+    # Batch padding is not part of the input.
+    while ids and ids[-1] == 0:
+      ids.pop()
+    key = "%s:%s" % (self._key_prefix, ",".join(str(i) for i in ids))
+    return hashlib.sha1(key.encode("utf-8")).hexdigest()
+
+  def get(self, input_ids):
+    """Returns the cached beams for input_ids, or None."""
+    with self._lock:
+      row = self._conn.execute("SELECT beams FROM decodes WHERE key = ?",
+                               (self._key(input_ids),)).fetchone()
+      if row is None:
+        self.misses += 1
+        return None
+      self.hits += 1
+      return [tuple(beam) for beam in json.loads(row[0])]
+
+  def put(self, input_ids, beams):
+    """Caches a list of (output, score) beams for input_ids."""
+    beams = [(output, None if score is None else float(score))
+             for output, score in beams]
+    with self._lock:
+      self._conn.execute("INSERT OR REPLACE INTO decodes VALUES (?, ?)",
+                         (self._key(input_ids), json.dumps(beams)))
+
+  def hit_rate(self):
+    lookups = self.hits + self.misses
+    return float(self.hits) / lookups if lookups else 0.0
+
+  def close(self):
+    """Commits the new decodes, logs the hit rate and closes the file."""
+    with self._lock:
+      self._conn.commit()
+      self._conn.close()
+    tf.logging.info("Decode cache: %d hits, %d misses (%.1f%% hit rate).",
+                    self.hits, self.misses, 100 * self.hit_rate())
+
+
+def open_decode_cache(estimator, hparams, decode_hp, checkpoint_path=None):
+  """Returns the DecodeCache of an estimator's model dir, or None.
+
+  Args:
+    estimator: the Estimator decoding.
+    hparams: the model hyperparameters.
+    decode_hp: decoding hyperparameters; the cache is off unless
+      decode_hp.cache_decodes is set.
+    checkpoint_path: the checkpoint decoded with; defaults to the latest one.
+
+  Returns:
+    a DecodeCache, or None if caching is off or not possible.
+  """
+  if not decode_hp.cache_decodes:
+    return None
+  if getattr(hparams, "sampling_method", "argmax") != "argmax":
+    tf.logging.warning("Not caching decodes: sampled decodes are random.")
+    return None
+  checkpoint_path = checkpoint_path or estimator.latest_checkpoint()
+  if not checkpoint_path:
+    tf.logging.warning("Not caching decodes: no checkpoint to key them by.")
+    return None
+  if "://" in estimator.model_dir:
+    tf.logging.warning("Not caching decodes: model dir %s is not local.",
+                       estimator.model_dir)
+    return None
+  filename = os.path.join(estimator.model_dir, "decodes.sqlite")
+  tf.logging.info("Caching decodes of %s in %s", checkpoint_path, filename)
+  return DecodeCache(filename, checkpoint_path, hparams, decode_hp)
@@ -0,0 +1,108 @@
+# coding=utf-8
+# Copyright 2017 The Tensor2Tensor Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests for the decode cache."""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import os
+import tempfile
+
+# Dependency imports
+
+import numpy as np
+
+from tensor2tensor.utils import decode_cache
+from tensor2tensor.utils import decoding
+
+import tensorflow as tf
+
+
+class DecodeCacheTest(tf.test.TestCase):
+
+  def testGetPut(self):
+    filename = os.path.join(tempfile.mkdtemp(dir=self.get_temp_dir()),
+                            "decodes.sqlite")
+    hparams = tf.contrib.training.HParams(sampling_method="argmax",
+                                          vocab_shortlist_size=0)
+    decode_hp = decoding.decode_hparams()
+    cache = decode_cache.DecodeCache(filename, "model.ckpt-100", hparams,
+                                     decode_hp)
+    self.assertIsNone(cache.get([4, 5, 1]))
+    cache.put([4, 5, 1], [("hallo", None)])
+    # Batch padding does not change the key.
+    self.assertEqual([("hallo", None)],
+                     cache.get(np.array([[4], [5], [1], [0], [0]])))
+    cache.close()
+    self.assertEqual(0.5, cache.hit_rate())
+
+    # Decodes persist, but only for the same checkpoint and hparams.
+    cache = decode_cache.DecodeCache(filename, "model.ckpt-100", hparams,
+                                     decode_hp)
+    self.assertEqual([("hallo", None)], cache.get([4, 5, 1]))
+    cache.close()
+    cache = decode_cache.DecodeCache(filename, "model.ckpt-200", hparams,
+                                     decode_hp)
+    self.assertIsNone(cache.get([4, 5, 1]))
+    cache.close()
+    hparams.vocab_shortlist_size = 100
+    cache = decode_cache.DecodeCache(filename, "model.ckpt-100", hparams,
+                                     decode_hp)
+    self.assertIsNone(cache.get([4, 5, 1]))
+    cache.close()
+    hparams.vocab_shortlist_size = 0
+    decode_hp.beam_size = 2
+    cache = decode_cache.DecodeCache(filename, "model.ckpt-100", hparams,
+                                     decode_hp)
+    self.assertIsNone(cache.get([4, 5, 1]))
+    cache.close()
+
+  def testBatchingDoesNotChangeKey(self):
+    filename = os.path.join(tempfile.mkdtemp(dir=self.get_temp_dir()),
+                            "decodes.sqlite")
+    hparams = tf.contrib.training.HParams(sampling_method="argmax",
+                                          batch_size=4096)
+    decode_hp = decoding.decode_hparams()
+    decode_hp.add_hparam("shards", 1)
+    decode_hp.add_hparam("shard_id", 0)
+    cache = decode_cache.DecodeCache(filename, "model.ckpt-100", hparams,
+                                     decode_hp)
+    cache.put([4, 5, 1], [("hallo", None)])
+    cache.close()
+
+    # As when decode_from_dataset copies decode_hp.batch_size to hparams.
+    hparams.batch_size = 32
+    decode_hp.batch_size = 32
+    decode_hp.shards = 2
+    decode_hp.shard_id = 1
+    cache = decode_cache.DecodeCache(filename, "model.ckpt-100", hparams,
+                                     decode_hp)
+    self.assertEqual([("hallo", None)], cache.get([4, 5, 1]))
+    cache.close()
+
+  def testNoCacheWhenSampling(self):
+    estimator = tf.contrib.training.HParams(
+        model_dir=tempfile.mkdtemp(dir=self.get_temp_dir()))
+    hparams = tf.contrib.training.HParams(sampling_method="random")
+    decode_hp = decoding.decode_hparams()
+    decode_hp.cache_decodes = True
+    self.assertIsNone(decode_cache.open_decode_cache(
+        estimator, hparams, decode_hp, checkpoint_path="model.ckpt-100"))
+
+
+if __name__ == "__main__":
+  tf.test.main()
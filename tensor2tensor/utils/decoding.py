@@ -18,6 +18,9 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
+import collections
+import itertools
+import json
 import operator
 import os
 
@@ -29,6 +32,7 @@ import six
 from six.moves import input  # pylint: disable=redefined-builtin
 
 from tensor2tensor.data_generators import text_encoder
+from tensor2tensor.utils import decode_cache
 import tensorflow as tf
 
 FLAGS = tf.flags.FLAGS
@@ -51,7 +55,14 @@ def decode_hparams(overrides=""):
       max_input_size=-1,
       identity_output=False,
       num_samples=-1,
-      delimiter="\n")
+      delimiter="\n",
+      stream_window_size=0,
+      cache_decodes=False,
+      # Greedy decoding with the proposals of a smaller draft model, a
+      # Transformer with this hparams set trained in draft_model_dir.
+      draft_hparams_set="",
+      draft_model_dir="",
+      num_draft_tokens=4)
   hp = hp.parse(overrides)
   return hp
 
@@ -96,6 +107,48 @@ def log_decode_results(inputs,
   return decoded_outputs, decoded_targets
 
 
+def _new_decode_steps():
+  return {"decodes": 0, "run": 0, "budget": 0, "tokens_per_step": 0.0}
+
+
+def _count_decode_steps(inputs, outputs, decode_hp, steps,
+                        tokens_per_step=None):
+  """Adds the steps a greedy decode ran and was allowed to run to steps.
+
+  Greedy fast decoding runs for up to the (batch padded) input length plus
+  decode_hp.extra_length steps, and stops early once every sequence in the
+  batch has ended.
+
+  Args:
+    inputs: the inputs of a prediction.
+    outputs: the outputs of a prediction.
+    decode_hp: decoding hyperparameters.
+    steps: a dict with keys "decodes", "run", "budget" and "tokens_per_step".
+    tokens_per_step: with a draft model, the ids decoded per model call in the
+      batch of the prediction.
+  """
+  if decode_hp.beam_size > 1:
+    return
+  steps["decodes"] += 1
+  steps["run"] += np.shape(outputs)[0]
+  steps["budget"] += np.shape(inputs)[0] + decode_hp.extra_length
+  if tokens_per_step is not None:
+    steps["tokens_per_step"] += float(tokens_per_step)
+
+
+def _log_decode_steps(steps):
+  if not steps["decodes"] or not steps["budget"]:
+    return
+  saved = steps["budget"] - steps["run"]
+  tf.logging.info(
+      "Early stopping saved %.1f decode steps per sequence on average "
+      "(%.1f%% of the step budget).", float(saved) / steps["decodes"],
+      100.0 * saved / steps["budget"])
+  if steps["tokens_per_step"]:
+    tf.logging.info("The draft model's proposals gave %.2f ids per step on "
+                    "average.", steps["tokens_per_step"] / steps["decodes"])
+
+
 def decode_from_dataset(estimator,
                         problem_names,
                         hparams,
@@ -119,10 +172,44 @@ def decode_from_dataset(estimator,
   }
 
   for problem_idx, problem_name in enumerate(problem_names):
+    problem_hparams = hparams.problems[problem_idx]
+    # Inputs vocabulary is set to targets if there are no inputs in the problem,
+    # e.g., for language models where the inputs are just a prefix of targets.
+    has_input = "inputs" in problem_hparams.vocabulary
+    inputs_vocab_key = "inputs" if has_input else "targets"
+    inputs_vocab = problem_hparams.vocabulary[inputs_vocab_key]
+    targets_vocab = problem_hparams.vocabulary["targets"]
+
+    # Examples with cached decodes are dropped from the input pipeline and
+    # queued here with their beams, to be written out as they come. They count
+    # toward num_samples, so the input stops after num_samples examples.
+    cache = None
+    if has_input:
+      cache = decode_cache.open_decode_cache(estimator, hparams, decode_hp)
+    cached_examples = collections.deque()
+    example_filter = None
+    max_examples = None
+    if cache:
+      if decode_hp.num_samples >= 0:
+        max_examples = decode_hp.num_samples
+
+      def is_uncached(inputs, targets):
+        beams = cache.get(inputs)
+        if beams is None:
+          return True
+        cached_examples.append((targets, beams))
+        return False
+
+      def example_filter(example):
+        keep = tf.py_func(is_uncached, [example["inputs"], example["targets"]],
+                          tf.bool)
+        return tf.reshape(keep, [])
+
     # Build the inference input function
     problem = hparams.problem_instances[problem_idx]
     infer_input_fn = problem.make_estimator_input_fn(
-        tf.estimator.ModeKeys.PREDICT, hparams, dataset_kwargs=dataset_kwargs)
+        tf.estimator.ModeKeys.PREDICT, hparams, dataset_kwargs=dataset_kwargs,
+        example_filter=example_filter, max_examples=max_examples)
 
     # Get the predictions as an iterable
     predictions = estimator.predict(infer_input_fn)
@@ -142,18 +229,44 @@ def decode_from_dataset(estimator,
       output_file = tf.gfile.Open(output_filepath, "w")
       target_file = tf.gfile.Open(target_filepath, "w")
 
-    problem_hparams = hparams.problems[problem_idx]
-    # Inputs vocabulary is set to targets if there are no inputs in the problem,
-    # e.g., for language models where the inputs are just a prefix of targets.
-    has_input = "inputs" in problem_hparams.vocabulary
-    inputs_vocab_key = "inputs" if has_input else "targets"
-    inputs_vocab = problem_hparams.vocabulary[inputs_vocab_key]
-    targets_vocab = problem_hparams.vocabulary["targets"]
-    for num_predictions, prediction in enumerate(predictions):
+    def write_decodes(decoded_outputs, decoded_scores):
+      # Write out predictions if decode_to_file passed
+      if decode_to_file:
+        for i, (decoded_output, decoded_target) in enumerate(decoded_outputs):
+          beam_score_str = ""
+          if decode_hp.write_beam_scores:
+            beam_score_str = "\t%.2f" % decoded_scores[i]
+          output_file.write(
+              str(decoded_output) + beam_score_str + decode_hp.delimiter)
+          target_file.write(str(decoded_target) + decode_hp.delimiter)
+
+    def write_cached_decodes():
+      num_written = 0
+      while cached_examples:
+        num_written += 1
+        targets, beams = cached_examples.popleft()
+        if decode_hp.identity_output:
+          decoded_target = "".join(map(str, targets.flatten()))
+        else:
+          decoded_target = targets_vocab.decode(
+              _save_until_eos(targets, "image" in problem_name))
+        for output, _ in beams:
+          tf.logging.info("Cached inference results OUTPUT: %s" % output)
+        write_decodes([(output, decoded_target) for output, _ in beams],
+                      [score for _, score in beams])
+      return num_written
+
+    decode_steps = _new_decode_steps()
+    num_predictions = 0
+    num_cached = 0
+    for prediction in predictions:
+      num_cached += write_cached_decodes()
       num_predictions += 1
       inputs = prediction["inputs"]
       targets = prediction["targets"]
       outputs = prediction["outputs"]
+      _count_decode_steps(inputs, outputs, decode_hp, decode_steps,
+                          prediction.get("tokens_per_step"))
 
       # Log predictions
       decoded_outputs = []
@@ -194,25 +307,27 @@ def decode_from_dataset(estimator,
             targets=targets)
         decoded_outputs.append(decoded)
 
-      # Write out predictions if decode_to_file passed
-      if decode_to_file:
-        for i, (decoded_output, decoded_target) in enumerate(decoded_outputs):
-          beam_score_str = ""
-          if decode_hp.write_beam_scores:
-            beam_score_str = "\t%.2f" % decoded_scores[i]
-          output_file.write(
-              str(decoded_output) + beam_score_str + decode_hp.delimiter)
-          target_file.write(str(decoded_target) + decode_hp.delimiter)
+      if cache:
+        beam_scores = decoded_scores or [None] * len(decoded_outputs)
+        cache.put(inputs, [(str(d), score and float(score)) for (d, _), score
+                           in zip(decoded_outputs, beam_scores)])
+      write_decodes(decoded_outputs, decoded_scores)
 
       if (decode_hp.num_samples >= 0 and
-          num_predictions >= decode_hp.num_samples):
+          num_predictions + num_cached >= decode_hp.num_samples):
         break
+    else:
+      num_cached += write_cached_decodes()
 
     if decode_to_file:
       output_file.close()
       target_file.close()
 
-    tf.logging.info("Completed inference on %d samples." % num_predictions)  # pylint: disable=undefined-loop-variable
+    tf.logging.info("Completed inference on %d samples (%d cached)." %
+                    (num_predictions + num_cached, num_cached))
+    _log_decode_steps(decode_steps)
+    if cache:
+      cache.close()
 
 
 def decode_from_file(estimator,
@@ -221,7 +336,22 @@ def decode_from_file(estimator,
                      decode_hp,
                      decode_to_file=None,
                      checkpoint_path=None):
-  """Compute predictions on entries in filename and write them out."""
+  """Compute predictions on entries in filename and write them out.
+
+  By default the whole file is read, sorted by length and decoded before any
+  output is written. If decode_hp.stream_window_size is positive, the file is
+  instead read and sorted in windows of that many lines, decodes are written
+  in input order as soon as they are done and progress is saved, so that
+  memory stays bounded and a rerun resumes after the last written line.
+
+  Args:
+    estimator: an Estimator to predict with.
+    filename: path to file with inputs, separated by decode_hp.delimiter.
+    hparams: model hyperparameters.
+    decode_hp: decoding hyperparameters.
+    decode_to_file: an optional output filename.
+    checkpoint_path: an optional checkpoint to decode with.
+  """
   if not decode_hp.batch_size:
     decode_hp.batch_size = 32
     tf.logging.info(
@@ -235,68 +365,245 @@ def decode_from_file(estimator,
   inputs_vocab = hparams.problems[problem_id].vocabulary[inputs_vocab_key]
   targets_vocab = hparams.problems[problem_id].vocabulary["targets"]
   problem_name = FLAGS.problems.split("-")[problem_id]
+  # If decode_to_file was provided use it as the output filename without change
+  # (except for adding shard_id if using more shards for decoding).
+  # Otherwise, use the input filename plus model, hp, problem, beam, alpha.
+  decode_filename = decode_to_file if decode_to_file else filename
+  if decode_hp.shards > 1:
+    decode_filename += "%.2d" % decode_hp.shard_id
+  if not decode_to_file:
+    decode_filename = _decode_filename(decode_filename, problem_name, decode_hp)
+
+  def result_to_beams(result):
+    return _decode_result_beams(result, decode_hp, problem_name, inputs_vocab,
+                                targets_vocab)
+
+  if decode_hp.stream_window_size > 0:
+    if decode_hp.cache_decodes:
+      tf.logging.warning("The decode cache is not used when streaming.")
+    _stream_decode_from_file(
+        estimator, filename, hparams, decode_hp, decode_filename, inputs_vocab,
+        lambda result: _format_decode_beams(result_to_beams(result), decode_hp),
+        checkpoint_path)
+    return
+
   tf.logging.info("Performing decoding from a file.")
   sorted_inputs, sorted_keys = _get_sorted_inputs(filename, decode_hp.shards,
                                                   decode_hp.delimiter)
-  num_decode_batches = (len(sorted_inputs) - 1) // decode_hp.batch_size + 1
+
+  # Decodes in sorted order, filled in from the cache first.
+  decodes = [None] * len(sorted_inputs)
+  cache = decode_cache.open_decode_cache(estimator, hparams, decode_hp,
+                                         checkpoint_path)
+  if cache:
+    input_ids = [_encode_decode_input(inputs, inputs_vocab,
+                                      decode_hp.max_input_size)
+                 for inputs in sorted_inputs]
+    for i, ids in enumerate(input_ids):
+      beams = cache.get(ids)
+      if beams is not None:
+        decodes[i] = _format_decode_beams(beams, decode_hp)
+  uncached = [i for i, decode in enumerate(decodes) if decode is None]
+  uncached_inputs = [sorted_inputs[i] for i in uncached]
+  num_decode_batches = (len(uncached_inputs) - 1) // decode_hp.batch_size + 1
 
   def input_fn():
     input_gen = _decode_batch_input_fn(
-        problem_id, num_decode_batches, sorted_inputs, inputs_vocab,
+        problem_id, num_decode_batches, uncached_inputs, inputs_vocab,
         decode_hp.batch_size, decode_hp.max_input_size)
     gen_fn = make_input_fn_from_generator(input_gen)
     example = gen_fn()
     return _decode_input_tensor_to_features_dict(example, hparams)
 
-  decodes = []
-  result_iter = estimator.predict(input_fn, checkpoint_path=checkpoint_path)
-  for result in result_iter:
-    if decode_hp.return_beams:
-      beam_decodes = []
-      beam_scores = []
-      output_beams = np.split(result["outputs"], decode_hp.beam_size, axis=0)
-      scores = None
-      if "scores" in result:
-        scores = np.split(result["scores"], decode_hp.beam_size, axis=0)
-      for k, beam in enumerate(output_beams):
-        tf.logging.info("BEAM %d:" % k)
-        score = scores and scores[k]
-        decoded_outputs, _ = log_decode_results(result["inputs"], beam,
-                                                problem_name, None,
-                                                inputs_vocab, targets_vocab)
-        beam_decodes.append(decoded_outputs)
-        if decode_hp.write_beam_scores:
-          beam_scores.append(score)
-      if decode_hp.write_beam_scores:
-        decodes.append("\t".join(
-            ["\t".join([d, "%.2f" % s]) for d, s
-             in zip(beam_decodes, beam_scores)]))
-      else:
-        decodes.append("\t".join(beam_decodes))
-    else:
-      decoded_outputs, _ = log_decode_results(result["inputs"],
-                                              result["outputs"], problem_name,
-                                              None, inputs_vocab, targets_vocab)
-      decodes.append(decoded_outputs)
+  if uncached_inputs:
+    decoded_beams = []
+    decode_steps = _new_decode_steps()
+    result_iter = estimator.predict(input_fn, checkpoint_path=checkpoint_path)
+    for result in result_iter:
+      _count_decode_steps(result["inputs"], result["outputs"], decode_hp,
+                          decode_steps, result.get("tokens_per_step"))
+      decoded_beams.append(result_to_beams(result))
+
+    _log_decode_steps(decode_steps)
+
+    # Reversing the decoded outputs because the inputs were reversed in
+    # _decode_batch_input_fn
+    decoded_beams.reverse()
+    for i, beams in zip(uncached, decoded_beams):
+      decodes[i] = _format_decode_beams(beams, decode_hp)
+      if cache:
+        cache.put(input_ids[i], beams)
+  if cache:
+    cache.close()
 
-  # Reversing the decoded inputs and outputs because they were reversed in
-  # _decode_batch_input_fn
-  sorted_inputs.reverse()
-  decodes.reverse()
-  # If decode_to_file was provided use it as the output filename without change
-  # (except for adding shard_id if using more shards for decoding).
-  # Otherwise, use the input filename plus model, hp, problem, beam, alpha.
-  decode_filename = decode_to_file if decode_to_file else filename
-  if decode_hp.shards > 1:
-    decode_filename += "%.2d" % decode_hp.shard_id
-  if not decode_to_file:
-    decode_filename = _decode_filename(decode_filename, problem_name, decode_hp)
   tf.logging.info("Writing decodes into %s" % decode_filename)
   outfile = tf.gfile.Open(decode_filename, "w")
   for index in range(len(sorted_inputs)):
     outfile.write("%s%s" % (decodes[sorted_keys[index]], decode_hp.delimiter))
 
 
+def _decode_result_beams(result, decode_hp, problem_name, inputs_vocab,
+                         targets_vocab):
+  """Logs a prediction and returns a list of its (output, score) beams."""
+  if decode_hp.return_beams:
+    beams = []
+    output_beams = np.split(result["outputs"], decode_hp.beam_size, axis=0)
+    scores = None
+    if "scores" in result:
+      scores = np.split(result["scores"], decode_hp.beam_size, axis=0)
+    for k, beam in enumerate(output_beams):
+      tf.logging.info("BEAM %d:" % k)
+      score = scores and float(scores[k])
+      decoded_outputs, _ = log_decode_results(result["inputs"], beam,
+                                              problem_name, None,
+                                              inputs_vocab, targets_vocab)
+      beams.append((decoded_outputs, score))
+    return beams
+  decoded_outputs, _ = log_decode_results(result["inputs"],
+                                          result["outputs"], problem_name,
+                                          None, inputs_vocab, targets_vocab)
+  return [(decoded_outputs, None)]
+
+
+def _format_decode_beams(beams, decode_hp):
+  """Joins (output, score) beams into one line of output."""
+  if not decode_hp.return_beams:
+    return beams[0][0]
+  if decode_hp.write_beam_scores:
+    return "\t".join(["\t".join([d, "%.2f" % s]) for d, s in beams])
+  return "\t".join([d for d, _ in beams])
+
+
+def _encode_decode_input(inputs, vocabulary, max_input_size):
+  """The input ids of a decode_from_file line, as in _make_decode_batch."""
+  input_ids = vocabulary.encode(inputs)
+  if max_input_size > 0:
+    # Subtract 1 for the EOS_ID.
+    input_ids = input_ids[:max_input_size - 1]
+  return input_ids + [text_encoder.EOS_ID]
+
+
+def _stream_decode_from_file(estimator, filename, hparams, decode_hp,
+                             decode_filename, inputs_vocab, result_to_string,
+                             checkpoint_path):
+  """Decodes filename in sorted windows, writing decodes as they finish.
+
+  Decodes come back in the order of the length-sorted window. They are held
+  in a reorder buffer, which never holds more than one window, until all
+  earlier lines are done, then written out. After every window the number of
+  lines and bytes written are saved next to the output, so that a rerun
+  truncates any partly written window and resumes after the saved line.
+
+  Args:
+    estimator: an Estimator to predict with.
+    filename: path to file with inputs.
+    hparams: model hyperparameters.
+    decode_hp: decoding hyperparameters.
+    decode_filename: the output filename.
+    inputs_vocab: a TextEncoder for the inputs.
+    result_to_string: a function from a prediction to its output line.
+    checkpoint_path: an optional checkpoint to decode with.
+  """
+  window_size = decode_hp.stream_window_size
+  progress_filename = decode_filename + ".progress"
+  num_written, num_bytes = read_decode_progress(progress_filename)
+  if num_written:
+    tf.logging.info("Resuming decoding of %s after line %d.", filename,
+                    num_written)
+  _truncate_file(decode_filename, num_bytes)
+
+  # Line numbers in the order their inputs are fed to the model.
+  fed_lines = collections.deque()
+  records = _read_records(_decode_input_filename(filename, decode_hp.shards),
+                          decode_hp.delimiter)
+  input_gen = _windowed_decode_batch_input_fn(
+      decode_hp.problem_idx, itertools.islice(records, num_written, None),
+      num_written, window_size, inputs_vocab, decode_hp.batch_size,
+      decode_hp.max_input_size, fed_lines)
+  try:
+    first_batch = six.next(input_gen)
+  except StopIteration:
+    tf.logging.info("Nothing left to decode in %s.", filename)
+    _remove_decode_progress(progress_filename)
+    return
+  input_gen = itertools.chain([first_batch], input_gen)
+
+  def input_fn():
+    gen_fn = make_input_fn_from_generator(input_gen)
+    example = gen_fn()
+    return _decode_input_tensor_to_features_dict(example, hparams)
+
+  tf.logging.info("Streaming decodes into %s" % decode_filename)
+  reorder_buffer = {}
+  decode_steps = _new_decode_steps()
+  with tf.gfile.Open(decode_filename, "a") as outfile:
+    for result in estimator.predict(input_fn, checkpoint_path=checkpoint_path):
+      _count_decode_steps(result["inputs"], result["outputs"], decode_hp,
+                          decode_steps, result.get("tokens_per_step"))
+      reorder_buffer[fed_lines.popleft()] = result_to_string(result)
+      flushed = False
+      while num_written in reorder_buffer:
+        line = "%s%s" % (reorder_buffer.pop(num_written), decode_hp.delimiter)
+        outfile.write(line)
+        num_bytes += len(tf.compat.as_bytes(line))
+        num_written += 1
+        flushed = flushed or num_written % window_size == 0
+      if flushed:
+        outfile.flush()
+        write_decode_progress(progress_filename, num_written, num_bytes)
+        tf.logging.info("Wrote %d decodes." % num_written)
+  _log_decode_steps(decode_steps)
+  _remove_decode_progress(progress_filename)
+  tf.logging.info("Finished decoding %d lines into %s", num_written,
+                  decode_filename)
+
+
+def read_decode_progress(progress_filename):
+  """Returns (lines, bytes) written so far by a streaming decode, or (0, 0)."""
+  if not tf.gfile.Exists(progress_filename):
+    return 0, 0
+  with tf.gfile.Open(progress_filename) as f:
+    progress = json.loads(f.read())
+  return progress["lines"], progress["bytes"]
+
+
+def write_decode_progress(progress_filename, num_lines, num_bytes):
+  """Atomically records that num_lines lines (num_bytes bytes) are written."""
+  tmp_filename = progress_filename + ".tmp"
+  with tf.gfile.Open(tmp_filename, "w") as f:
+    f.write(json.dumps({"lines": num_lines, "bytes": num_bytes}))
+  tf.gfile.Rename(tmp_filename, progress_filename, overwrite=True)
+
+
+def _remove_decode_progress(progress_filename):
+  if tf.gfile.Exists(progress_filename):
+    tf.gfile.Remove(progress_filename)
+
+
+def _truncate_file(filename, length, chunk_size=1 << 20):
+  """Cuts filename to its first length bytes, creating it if needed."""
+  if not tf.gfile.Exists(filename):
+    if length:
+      raise ValueError("%s is missing, but %d bytes of it were decoded." %
+                       (filename, length))
+    tf.gfile.Open(filename, "w").close()
+    return
+  if tf.gfile.Stat(filename).length == length:
+    return
+  tmp_filename = filename + ".tmp"
+  with tf.gfile.Open(filename, "rb") as f, tf.gfile.Open(tmp_filename,
+                                                        "wb") as out:
+    remaining = length
+    while remaining:
+      chunk = f.read(min(chunk_size, remaining))
+      if not chunk:
+        raise ValueError("%s is shorter than the %d decoded bytes." %
+                         (filename, length))
+      out.write(chunk)
+      remaining -= len(chunk)
+  tf.gfile.Rename(tmp_filename, filename, overwrite=True)
+
+
 def _decode_filename(base_filename, problem_name, decode_hp):
   return "{base}.{model}.{hp}.{problem}.beam{beam}.alpha{alpha}.decodes".format(
       base=base_filename,
@@ -374,27 +681,68 @@ def _decode_batch_input_fn(problem_id, num_decode_batches, sorted_inputs,
   sorted_inputs.reverse()
   for b in range(num_decode_batches):
     tf.logging.info("Decoding batch %d" % b)
-    batch_length = 0
-    batch_inputs = []
-    for inputs in sorted_inputs[b * batch_size:(b + 1) * batch_size]:
-      input_ids = vocabulary.encode(inputs)
-      if max_input_size > 0:
-        # Subtract 1 for the EOS_ID.
-        input_ids = input_ids[:max_input_size - 1]
-      input_ids.append(text_encoder.EOS_ID)
-      batch_inputs.append(input_ids)
-      if len(input_ids) > batch_length:
-        batch_length = len(input_ids)
-    final_batch_inputs = []
-    for input_ids in batch_inputs:
-      assert len(input_ids) <= batch_length
-      x = input_ids + [0] * (batch_length - len(input_ids))
-      final_batch_inputs.append(x)
-
-    yield {
-        "inputs": np.array(final_batch_inputs).astype(np.int32),
-        "problem_choice": np.array(problem_id).astype(np.int32),
-    }
+    yield _make_decode_batch(
+        problem_id, sorted_inputs[b * batch_size:(b + 1) * batch_size],
+        vocabulary, max_input_size)
+
+
+def _windowed_decode_batch_input_fn(problem_id, records, first_line,
+                                    window_size, vocabulary, batch_size,
+                                    max_input_size, fed_lines):
+  """Yields decode batches from windows of records sorted by length.
+
+  Args:
+    problem_id: index of the problem to decode.
+    records: an iterable of input strings.
+    first_line: line number of the first record.
+    window_size: number of records sorted together.
+    vocabulary: a TextEncoder for the inputs.
+    batch_size: an integer.
+    max_input_size: inputs are cut to this many ids if positive.
+    fed_lines: a deque; the line numbers of each batch are appended to it as
+      the batch is yielded.
+
+  Yields:
+    batches, as _decode_batch_input_fn.
+  """
+  records = iter(records)
+  line = first_line
+  while True:
+    window = list(itertools.islice(records, window_size))
+    if not window:
+      return
+    # Longest inputs first, so that an OOM shows up early in every window.
+    order = sorted(range(len(window)), key=lambda i: -len(window[i].split()))
+    for b in range(0, len(order), batch_size):
+      batch_order = order[b:b + batch_size]
+      fed_lines.extend(line + i for i in batch_order)
+      yield _make_decode_batch(problem_id, [window[i] for i in batch_order],
+                               vocabulary, max_input_size)
+    line += len(window)
+
+
+def _make_decode_batch(problem_id, inputs, vocabulary, max_input_size):
+  """Encodes and pads a list of input strings into a decode batch."""
+  batch_length = 0
+  batch_inputs = []
+  for input_ids in vocabulary.encode_batch(inputs):
+    if max_input_size > 0:
+      # Subtract 1 for the EOS_ID.
+      input_ids = input_ids[:max_input_size - 1]
+    input_ids.append(text_encoder.EOS_ID)
+    batch_inputs.append(input_ids)
+    if len(input_ids) > batch_length:
+      batch_length = len(input_ids)
+  final_batch_inputs = []
+  for input_ids in batch_inputs:
+    assert len(input_ids) <= batch_length
+    x = input_ids + [0] * (batch_length - len(input_ids))
+    final_batch_inputs.append(x)
+
+  return {
+      "inputs": np.array(final_batch_inputs).astype(np.int32),
+      "problem_choice": np.array(problem_id).astype(np.int32),
+  }
 
 
 def _interactive_input_fn(hparams):
@@ -517,10 +865,7 @@ def _get_sorted_inputs(filename, num_shards=1, delimiter="\n"):
   """
   tf.logging.info("Getting sorted inputs")
   # read file and sort inputs according them according to input length.
-  if num_shards > 1:
-    decode_filename = filename + ("%.2d" % FLAGS.worker_id)
-  else:
-    decode_filename = filename
+  decode_filename = _decode_input_filename(filename, num_shards)
 
   with tf.gfile.Open(decode_filename) as f:
     text = f.read()
@@ -540,6 +885,40 @@ def _get_sorted_inputs(filename, num_shards=1, delimiter="\n"):
   return sorted_inputs, sorted_keys
 
 
+def _decode_input_filename(filename, num_shards):
+  """The input shard of this worker: filename.XX with XX = FLAGS.worker_id."""
+  if num_shards > 1:
+    return filename + ("%.2d" % FLAGS.worker_id)
+  return filename
+
+
+def _read_records(filename, delimiter="\n", chunk_size=1 << 20):
+  """Yields the stripped records of filename without reading it all at once.
+
+  Like _get_sorted_inputs, a trailing empty record is dropped.
+
+  Args:
+    filename: path to the file.
+    delimiter: str, delimits records in the file.
+    chunk_size: number of characters read at a time.
+
+  Yields:
+    strings.
+  """
+  with tf.gfile.Open(filename) as f:
+    remainder = ""
+    while True:
+      chunk = f.read(chunk_size)
+      if not chunk:
+        break
+      records = (remainder + chunk).split(delimiter)
+      remainder = records.pop()
+      for record in records:
+        yield record.strip()
+    if remainder.strip():
+      yield remainder.strip()
+
+
 def _save_until_eos(hyp, is_image):
   """Strips everything after the first <EOS> token, which is normally 1."""
   hyp = hyp.flatten()
@@ -0,0 +1,73 @@
+# coding=utf-8
+# Copyright 2017 The Tensor2Tensor Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests for decoding utilities."""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import collections
+import os
+import tempfile
+
+# Dependency imports
+
+from tensor2tensor.data_generators import text_encoder
+from tensor2tensor.utils import decoding
+
+import tensorflow as tf
+
+
+class DecodingTest(tf.test.TestCase):
+
+  def testReadRecords(self):
+    tmp_dir = tempfile.mkdtemp(dir=self.get_temp_dir())
+    filename = os.path.join(tmp_dir, "inputs.txt")
+    with tf.gfile.Open(filename, "w") as f:
+      f.write("a b\n\n c \nd e f\n")
+    # A small chunk size splits records across reads.
+    self.assertEqual(["a b", "", "c", "d e f"],
+                     list(decoding._read_records(filename, chunk_size=3)))
+
+  def testWindowedDecodeBatches(self):
+    records = ["a", "b b b", "c c", "d", "e e e e", "f"]
+    fed_lines = collections.deque()
+    batches = list(decoding._windowed_decode_batch_input_fn(
+        0, records, 10, 4, text_encoder.ByteTextEncoder(), 3, -1, fed_lines))
+    # Windows of 4 and 2 records, longest first within each window.
+    self.assertEqual([11, 12, 10, 13, 14, 15], list(fed_lines))
+    self.assertEqual([(3, 6), (1, 2), (2, 8)],
+                     [b["inputs"].shape for b in batches])
+
+  def testDecodeProgress(self):
+    tmp_dir = tempfile.mkdtemp(dir=self.get_temp_dir())
+    decode_filename = os.path.join(tmp_dir, "decodes.txt")
+    progress_filename = decode_filename + ".progress"
+    self.assertEqual((0, 0), decoding.read_decode_progress(progress_filename))
+
+    with tf.gfile.Open(decode_filename, "w") as f:
+      f.write("one\ntwo\nthr")
+    decoding.write_decode_progress(progress_filename, 2, 8)
+    num_lines, num_bytes = decoding.read_decode_progress(progress_filename)
+    self.assertEqual((2, 8), (num_lines, num_bytes))
+    # A partly written line is dropped on resume.
+    decoding._truncate_file(decode_filename, num_bytes)
+    with tf.gfile.Open(decode_filename) as f:
+      self.assertEqual("one\ntwo\n", f.read())
+
+
+if __name__ == "__main__":
+  tf.test.main()
@@ -113,6 +113,8 @@ class T2TModel(base.Layer):
     self._num_datashards = self._data_parallelism.n
     self._ps_devices = self._data_parallelism.ps_devices
     self._eager_var_store = create_eager_var_store()
+    # Per-example Tensors about decoding, added to the predictions.
+    self.decode_stats = dict()
     if self._problem_hparams:
       self._create_modalities(self._problem_hparams, self._hparams)
 
@@ -904,6 +906,7 @@ class T2TModel(base.Layer):
         "targets": features.get("infer_targets"),
         "problem_choice": batched_problem_choice,
     }
+    predictions.update(self.decode_stats)
     _del_dict_nones(predictions)
 
     export_out = {"outputs": predictions["outputs"]}
@@ -26,6 +26,7 @@ import random
 
 import numpy as np
 
+from tensor2tensor.utils import data_reader
 from tensor2tensor.utils import devices
 from tensor2tensor.utils import metrics_hook
 from tensor2tensor.utils import registry
@@ -146,6 +147,7 @@ def create_run_config(master="",
   if not use_tpu:
     config.t2t_device_info = {
         "num_async_replicas": num_async_replicas,
+        "worker_id": worker_id,
     }
     config.data_parallelism = devices.data_parallelism(
         daisy_chain_variables=daisy_chain_variables,
@@ -256,8 +258,17 @@ def create_experiment(run_config,
 
   # Input fns from Problem
   problem = hparams.problem_instances[0]
+  record_reader = None
+  train_dataset_kwargs = None
+  if hparams.resumable_input_pipeline and not use_tpu:
+    worker_id = run_config.t2t_device_info["worker_id"]
+    record_reader = data_reader.ResumableRecordReader(
+        run_config.model_dir, worker_id=worker_id,
+        seed=(run_config.tf_random_seed or 0) + worker_id)
+    train_dataset_kwargs = {"record_reader": record_reader}
   train_input_fn = problem.make_estimator_input_fn(
-      tf.estimator.ModeKeys.TRAIN, hparams)
+      tf.estimator.ModeKeys.TRAIN, hparams,
+      dataset_kwargs=train_dataset_kwargs)
   eval_input_fn = problem.make_estimator_input_fn(
       tf.estimator.ModeKeys.EVAL, hparams)
 
@@ -300,6 +311,9 @@ def create_experiment(run_config,
         use_early_stopping=use_early_stopping,
         validation_monitor_kwargs=validation_monitor_kwargs,
         early_stopping_kwargs=early_stopping_kwargs)
+    if record_reader:
+      train_monitors.append(data_reader.InputStateSaverHook(
+          record_reader, run_config.model_dir))
     hooks_kwargs = {"train_monitors": train_monitors, "eval_hooks": eval_hooks}
 
   # Experiment